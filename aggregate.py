@@ -0,0 +1,241 @@
+"""aggregate.py
+
+This file contains the streaming aggregation used by data_pool.py while it receives the sensor readings.
+Only the strongest signal of each second, target device and sensor is stored, so instead of keeping
+every reading until the next store and grouping them with pandas, each batch of parsed readings is
+reduced to the strongest signal of each key, i.e. the second, the integer MAC address of the target
+device and the AP-ID of the sensor, with one lexsort and one maximum.reduceat over its numpy columns as
+soon as it is received. The reduced batches are reduced again together when the closed seconds are read
+out, so the aggregation never loops over the readings in Python and never builds a pandas object.
+
+Only closed seconds are stored: a second is closed once a reading `lateness` seconds newer is received,
+and the readings of a second which is already stored are dropped and counted as late. As each key is
+stored once, the readers do not need to group the readings again.
+
+The Emitter passes the closed seconds to a publish function, e.g. the ring buffer read by the processing
+scripts, every publish_interval seconds, and the readings published since the last store to the save
+function every store_interval seconds, both as a dictionary of numpy columns.
+
+This script requires that `numpy` be installed within the Python environment you are running this
+script in.
+"""
+
+import time
+import numpy as np
+
+TIME_OFFSET         = 8*60*60 # srvTime is in milliseconds since epoch, the readings are stored in Hong Kong time
+STRENGTH_OFFSET     = 100 # the signal strengths are stored as rssi + STRENGTH_OFFSET
+FIELDS              = {'Second':np.int64, 'Target':np.uint64, 'Receiver':np.int64, 'Strength':np.int64} # the columns aggregated
+
+
+def concat_columns(batches):
+    """Concatenate the batches of columns with the same fields, e.g. the readings passed from data_pool.py to the flush stage"""
+    return {field:np.concatenate([batch[field] for batch in batches]) for field in batches[0]}
+
+
+def empty_columns():
+    """Return the columns of no readings"""
+    return {field:np.zeros(0, dtype=dtype) for field, dtype in FIELDS.items()}
+
+
+def strongest(columns):
+    """Reduce the columns Second, Target, Receiver and Strength to the strongest signal of each key, sorted by key"""
+    if not len(columns['Second']):
+        return columns
+    order = np.lexsort((columns['Receiver'], columns['Target'], columns['Second']))
+    second, target, receiver = columns['Second'][order], columns['Target'][order], columns['Receiver'][order]
+    first = np.flatnonzero(np.r_[True, (second[1:] != second[:-1]) | (target[1:] != target[:-1]) | (receiver[1:] != receiver[:-1])])
+    return {'Second':second[first], 'Target':target[first], 'Receiver':receiver[first],
+            'Strength':np.maximum.reduceat(columns['Strength'][order], first)}
+
+
+class SecondMax:
+    """
+    A class used to represent the strongest signal of each second, target device and sensor not stored yet
+
+    ...
+
+    Attributes
+    ----------
+    lateness : int
+        a second is closed once a reading this many seconds newer is received
+    batches : list
+        the columns Second, Target, Receiver and Strength of the batches added, each reduced to the strongest signal of each key
+    newest : int
+        the newest second received
+    watermark : int
+        the seconds before the watermark are stored, their readings are dropped
+    late : int
+        the number of readings dropped as their seconds are already stored
+
+    Methods
+    -------
+    add_columns(columns)
+        keeps the stronger signals of the columns parsed by datagram.py
+    merge(columns)
+        adds the columns aggregated by another SecondMax
+    drain()
+        removes and returns all keys without closing their seconds
+    pop(final=False)
+        removes and returns the closed seconds, or all seconds if final
+    emit(final=False)
+        removes and returns the closed seconds as the columns of readings
+    """
+    def __init__(self, lateness):
+        self.lateness = lateness
+        self.batches = []
+        self.newest = None
+        self.watermark = None
+        self.late = 0
+
+    def add_columns(self, columns):
+        """Keep the stronger signals of the columns Second, Target, Receiver and Strength returned by datagram.parse_datagrams"""
+        columns = {field:np.asarray(columns[field]).astype(dtype, copy=False) for field, dtype in FIELDS.items()}
+        seconds = columns['Second']
+        if self.watermark is not None:
+            late = seconds < self.watermark
+            if late.any():
+                self.late += int(late.sum())
+                columns = {field:values[~late] for field, values in columns.items()}
+                seconds = columns['Second']
+        if not len(seconds):
+            return
+        newest = int(seconds.max())
+        if self.newest is None or newest > self.newest:
+            self.newest = newest
+        self.batches.append(strongest(columns))
+
+    def merge(self, columns):
+        """Add the columns returned by drain of another SecondMax"""
+        self.add_columns(columns)
+
+    def reduce(self):
+        """Reduce the batches added to a single batch and return it"""
+        columns = strongest(concat_columns(self.batches)) if self.batches else empty_columns()
+        self.batches = [columns] if len(columns['Second']) else []
+        return columns
+
+    def drain(self):
+        """Remove and return the columns of all seconds without closing them, e.g. to merge them into another SecondMax"""
+        columns = self.reduce()
+        self.batches = []
+        return columns
+
+    def pop(self, final=False):
+        """Remove and return the closed seconds
+
+        Parameters
+        ----------
+        final : bool
+            if True, all seconds are returned, e.g. when the service is stopped
+
+        Returns
+        -------
+        dict
+            the columns Second, Target, Receiver and Strength of the closed seconds, sorted by key
+        """
+        if self.newest is None:
+            return empty_columns()
+        watermark = self.newest + 1 if final else self.newest - self.lateness + 1
+        columns = self.reduce()
+        closed = int(np.searchsorted(columns['Second'], watermark)) # the keys are sorted by second first
+        self.batches = [{field:values[closed:] for field, values in columns.items()}] if closed < len(columns['Second']) else []
+        self.watermark = watermark if self.watermark is None else max(self.watermark, watermark)
+        return {field:values[:closed] for field, values in columns.items()}
+
+    def emit(self, final=False):
+        """Remove and return the closed seconds as the columns of readings
+
+        Parameters
+        ----------
+        final : bool
+            if True, all seconds are returned, e.g. when the service is stopped
+
+        Returns
+        -------
+        dict
+            the columns Time, Target, Receiver and Strength of the readings as stored in raw_data
+        """
+        return to_readings(self.pop(final))
+
+
+def to_readings(columns):
+    """Convert the columns returned by pop to the columns of readings
+
+    Parameters
+    ----------
+    columns : dict
+        the columns Second, Target, Receiver and Strength
+
+    Returns
+    -------
+    dict
+        the columns Time, Target, Receiver and Strength of the readings as stored in raw_data
+    """
+    return {'Time':(columns['Second'] + TIME_OFFSET).astype('datetime64[s]').astype('datetime64[ns]'),
+            'Target':columns['Target'], 'Receiver':columns['Receiver'], 'Strength':columns['Strength']}
+
+
+class Emitter:
+    """
+    A class used to represent the periodic emission of the closed seconds of a SecondMax
+
+    ...
+
+    Attributes
+    ----------
+    aggregator : SecondMax
+        the strongest signals not emitted yet
+    save : function
+        called with the columns of the readings emitted in every store_interval seconds
+    store_interval : float
+        the interval between the calls of save in seconds
+    publish : function
+        called with the columns of the readings emitted in every publish_interval seconds, None if they are only saved
+    publish_interval : float
+        the interval between the calls of publish in seconds
+    pending : list
+        the columns emitted since the last call of save
+
+    Methods
+    -------
+    tick(final=False)
+        emits the closed seconds if an interval is passed, or all seconds if final
+    """
+    def __init__(self, aggregator, save, store_interval, publish=None, publish_interval=1):
+        self.aggregator = aggregator
+        self.save = save
+        self.store_interval = store_interval
+        self.publish = publish
+        self.publish_interval = publish_interval if publish is not None else store_interval
+        self.pending = []
+        self.published = self.stored = time.time()
+
+    def tick(self, final=False):
+        """Emit the closed seconds to publish and save if their intervals are passed
+
+        Parameters
+        ----------
+        final : bool
+            if True, all seconds are emitted to publish and save, e.g. when the service is stopped
+
+        Returns
+        -------
+        bool
+            True if the store interval is passed
+        """
+        now = time.time()
+        if final or now - self.published >= self.publish_interval:
+            readings = self.aggregator.emit(final)
+            if len(readings['Time']):
+                if self.publish is not None:
+                    self.publish(readings)
+                self.pending.append(readings)
+            self.published = now
+        if not final and now - self.stored < self.store_interval:
+            return False
+        if self.pending:
+            self.save(self.pending[0] if len(self.pending) == 1 else concat_columns(self.pending))
+            self.pending = []
+        self.stored = now
+        return True
@@ -0,0 +1,45 @@
+"""bench_classifier.py
+
+This script compares the torch and numpy backends of the zone classifier. Each backend is started
+in a new python process to measure the time used to import the backend and load the weightings,
+the peak resident memory of the process and the time used to classify N_ROWS rows, and checks that
+both backends return the same zones.
+
+This script requires that `numpy` and `torch` be installed within the Python
+environment you are running this script in.
+
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+ROOT_DIR            = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESOURCES_DIR       = os.path.join(ROOT_DIR, 'resources')
+N_ROWS              = 20000
+MODEL_FILE          = {'numpy':'model.npz', 'torch':'model'}
+
+CHILD = """
+import time
+start = time.time()
+import resource, json
+import numpy as np
+from classifier import ZoneClassifier
+classifier = ZoneClassifier({path!r}, n_feature = 7, n_zone = 4, backend = {backend!r})
+startup = time.time() - start
+X = np.random.RandomState(0).rand({n_rows}, 7)
+zones = classifier.predict(X)
+print(json.dumps({{'startup':startup, 'inference':classifier.inference_time,
+                  'rss':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'zones':zones.tolist()}}))
+"""
+
+results = {}
+for backend in ['torch', 'numpy']:
+    code = CHILD.format(path=os.path.join(RESOURCES_DIR, MODEL_FILE[backend]), backend=backend, n_rows=N_ROWS)
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT_DIR)
+    results[backend] = json.loads(output.decode().strip().splitlines()[-1])
+    print('{:6s} startup {:7.3f} s  inference ({} rows) {:7.4f} s  peak RSS {:8.1f} MB'.format(
+        backend, results[backend]['startup'], N_ROWS, results[backend]['inference'], results[backend]['rss']/1024))
+
+print('same zones: {}'.format(results['torch']['zones'] == results['numpy']['zones']))
@@ -0,0 +1,95 @@
+"""bench_datagram.py
+
+This script measures the time used to parse a datagram of the sensors and add it to the aggregation
+of data_pool.py, comparing the previous path, which decoded each datagram to a string, parsed it into
+a dictionary with json.loads and added its key to the aggregation one by one, with the parser in
+datagram.py, which parses the datagrams of each BATCH_SIZE at once into typed columns, with the json
+module and with `orjson` if it is installed. Both paths are checked to keep the same strongest signals.
+
+The datagrams are read from the file given as the first argument, one datagram per line, e.g. captured
+from the feed of the sensors. Otherwise N_DATAGRAMS datagrams are generated, of which MALFORMED_RATE
+are malformed.
+
+This script requires that `numpy` be installed within the Python environment you are running
+this script in, and optionally `orjson`.
+
+"""
+
+import os
+import sys
+import json
+import time
+import numpy as np
+
+ROOT_DIR            = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import config
+import datagram
+from aggregate import SecondMax
+from ingest import BATCH_SIZE
+
+N_DATAGRAMS         = 200000
+N_DEVICES           = 2000
+MALFORMED_RATE      = 0.01
+SENSORS             = {v:k for k,v in config.SENSOR.items()}
+
+
+def generate(n):
+    """Generate n datagrams in the format of the sensors, some of them malformed"""
+    rng = np.random.RandomState(0)
+    macs = ['{:012X}'.format(mac) for mac in rng.randint(0, 2**47, N_DEVICES)]
+    start = int(time.time()*1000)
+    datagrams = []
+    for i in range(n):
+        reading = {'srvTime':start + i*5, 'txAddr':macs[rng.randint(N_DEVICES)], 'rxAddr':config.SENSOR[rng.randint(1, 12)],
+                   'rssi':int(rng.randint(-95, -20)), 'channel':int(rng.randint(1, 14)), 'type':'probe'}
+        if rng.rand() < MALFORMED_RATE:
+            datagrams.append(json.dumps(reading).encode()[:-10]) # truncated
+        else:
+            datagrams.append(json.dumps(reading).encode())
+    return datagrams
+
+
+def previous(datagrams):
+    """Parse and aggregate the datagrams one by one as the previous version of data_pool.py"""
+    strengths = {}
+    for content in datagrams:
+        try:
+            reading = json.loads(content.decode())
+            key = (int(reading['srvTime'])//1000, int(reading['txAddr'], 16), SENSORS[reading['rxAddr']])
+            strengths[key] = max(strengths.get(key, 0), int(reading['rssi']) + 100)
+        except Exception:
+            pass
+    return strengths
+
+
+def columns(datagrams):
+    """Parse the datagrams of each BATCH_SIZE into columns and aggregate them at once"""
+    aggregator = SecondMax(0)
+    malformed = dict.fromkeys(datagram.MALFORMED, 0)
+    for first in range(0, len(datagrams), BATCH_SIZE):
+        aggregator.add_columns(datagram.parse_datagrams(datagrams[first:first+BATCH_SIZE], SENSORS, malformed))
+    items = aggregator.drain()
+    return dict(zip(zip(items['Second'].tolist(), items['Target'].tolist(), items['Receiver'].tolist()), items['Strength'].tolist())), malformed
+
+
+if len(sys.argv) > 1:
+    with open(sys.argv[1], 'rb') as fp:
+        datagrams = [line.strip() for line in fp if line.strip()]
+else:
+    datagrams = generate(N_DATAGRAMS)
+
+begin = time.perf_counter()
+expected = previous(datagrams)
+print('{:16s} {:7.3f} us per datagram'.format('previous', (time.perf_counter() - begin)/len(datagrams)*1e6))
+
+parsers = [('columns json', lambda datagram: json.loads(datagram.decode()))]
+if datagram.orjson is not None:
+    parsers.append(('columns orjson', datagram.orjson.loads))
+for name, loads in parsers:
+    datagram.loads = loads
+    begin = time.perf_counter()
+    strengths, malformed = columns(datagrams)
+    print('{:16s} {:7.3f} us per datagram  same readings: {}  malformed: {}'.format(
+        name, (time.perf_counter() - begin)/len(datagrams)*1e6, strengths == expected, malformed))
@@ -0,0 +1,89 @@
+"""bench_noise.py
+
+This script measures the time used by the stages of gen_filter_list.py identifying the frequently existing
+devices and the long staying devices from the readings of the past 3 days, comparing the previous path,
+which grouped the readings by date and device with a python function for each group and looped over the
+devices to find the long staying ones, with the grouped passes over the readings sorted by device in
+noise_state.py. Both paths are checked to identify the same devices.
+
+The readings of 1k, 10k and 100k distinct devices are generated, READINGS_PER_DEVICE on average, a share
+of them staying long or seen frequently. The previous path scans all readings for each device, so it is
+only run up to PREVIOUS_LIMIT devices.
+
+This script requires that `numpy` and `pandas` be installed within the Python environment you are running
+this script in.
+
+"""
+
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+ROOT_DIR            = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from noise_state import sort_by_device, frequent_devices, long_staying_devices, LONG_STAY_HOURS
+
+N_DEVICES           = [1000, 10000, 100000]
+READINGS_PER_DEVICE = 40
+PREVIOUS_LIMIT      = 10000
+READ_INTERVAL       = 60*60*24*3
+
+
+def generate(n_devices):
+    """Generate the readings of the devices within the past 3 days, sorted by time"""
+    rng = np.random.RandomState(0)
+    end = int(np.datetime64('2021-01-04T08:00:00', 's').astype(np.int64))
+    targets = rng.randint(0, 2**47, n_devices).astype(np.uint64)
+    counts = rng.poisson(READINGS_PER_DEVICE, n_devices) + 2
+    device = np.repeat(np.arange(n_devices), counts)
+    arrival = rng.randint(end - READ_INTERVAL, end, n_devices)
+    stay = np.where(rng.rand(n_devices) < 0.1, rng.randint(60*60, 60*60*12, n_devices), rng.randint(60, 60*30, n_devices))
+    seconds = np.minimum(arrival[device] + (rng.rand(len(device))*stay[device]).astype(np.int64), end)
+    order = np.argsort(seconds, kind='mergesort')
+    return pd.DataFrame({'Time':seconds[order].astype('datetime64[s]').astype('datetime64[ns]'), 'Target':targets[device][order]})
+
+
+def previous(data):
+    """Identify the devices as the previous version of gen_filter_list.py"""
+    data = data.assign(Date = data['Time'].dt.date)
+    freq_df = data.groupby(['Date','Target']).agg({'Time':lambda x:x.dt.hour.unique().size}).reset_index()
+    noise_target = freq_df[freq_df['Time'] >= 6]['Target'].unique().tolist()
+    data = data[~data['Target'].isin(noise_target)]
+
+    data = data[data['Time'] > data['Time'].max()-pd.Timedelta(hours=LONG_STAY_HOURS)]
+    counts = data['Target'].value_counts()
+    data = data[~data['Target'].isin(counts[counts<=10].index)]
+    for target in data['Target'].unique().tolist():
+        time_diff = data[data['Target'] == target]['Time'].diff()
+        time_diff = time_diff[time_diff <= pd.Timedelta(minutes=30)]
+        if time_diff.sum() > pd.Timedelta(minutes=90):
+            noise_target.append(target)
+    return noise_target
+
+
+def grouped(data):
+    """Identify the devices with the grouped passes as gen_filter_list.py"""
+    seconds, targets = sort_by_device(data['Time'].values.astype('datetime64[s]').astype(np.int64), data['Target'].values)
+    noise_target = frequent_devices(seconds, targets).tolist()
+    remaining = ~np.isin(targets, np.array(noise_target, dtype=np.uint64))
+    if remaining.any():
+        recent = remaining & (seconds > seconds[remaining].max() - LONG_STAY_HOURS*60*60)
+        noise_target.extend(long_staying_devices(seconds[recent], targets[recent]).tolist())
+    return noise_target
+
+
+for n_devices in N_DEVICES:
+    data = generate(n_devices)
+    begin = time.perf_counter()
+    noise_target = grouped(data)
+    grouped_time = time.perf_counter() - begin
+    if n_devices <= PREVIOUS_LIMIT:
+        begin = time.perf_counter()
+        expected = previous(data)
+        result = 'previous {:8.3f} s  same devices: {}'.format(time.perf_counter() - begin, set(expected) == set(noise_target))
+    else:
+        result = 'previous skipped'
+    print('{:7d} devices {:9d} readings  grouped {:7.3f} s  {} noise  {}'.format(n_devices, len(data), grouped_time, len(noise_target), result))
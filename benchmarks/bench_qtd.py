@@ -0,0 +1,94 @@
+"""bench_qtd.py
+
+This script measures the time used to derive the queue time distributions of all zones of the South Gate
+from the sessions, comparing the previous path, which reduced the sessions of each device with a groupby,
+classified each queue time with queue_dist and pivoted the devices of each status and zone with
+qtd_transformation, with queue_time_distribution in sessions.py. Both paths are checked to return the
+same counts.
+
+The sessions of N_DEVICES devices are generated at 1, 10 and 100 times the traffic of a peak hour.
+
+This script requires that `numpy` and `pandas` be installed within the Python environment you are running
+this script in.
+
+"""
+
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+ROOT_DIR            = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import config
+from sessions import queue_time_distribution
+
+N_DEVICES           = 2000
+SCALES              = [1, 10, 100]
+SESSIONS_PER_DEVICE = 1.5
+ZONES               = list(config.GATES['south']['qtd_current'])
+QTD_GROUP           = config.QTD_GROUP
+CURRENT_INTERVAL    = config.PROCESS_CYCLE
+
+
+def queue_dist(timedelta):
+    """Classify a queue time to a group as the previous config.queue_dist"""
+    for item, bound in zip(QTD_GROUP, config.QTD_BOUNDS):
+        if timedelta < pd.Timedelta(minutes=bound):
+            return item
+    return QTD_GROUP[-1]
+
+
+def qtd_transformation(df, timestamp):
+    """Pivot the queue time groups of the devices to a one-row table as the previous config.qtd_transformation"""
+    df = df['Queue_Time'].value_counts().reset_index().transpose()
+    df = df.rename(columns=df.iloc[0]).drop(df.index[0]).reset_index(drop=True)
+    if df.empty:
+        df = pd.DataFrame({item:[0] for item in QTD_GROUP})
+    df['Time'] = timestamp
+    for item in QTD_GROUP:
+        if item not in df.columns:
+            df[item] = 0
+    return df[['Time']+QTD_GROUP]
+
+
+def previous(sessions, server_time):
+    """Derive the queue time distributions as the previous version of pipeline.py"""
+    end = sessions['End'].dt.floor('s')
+    sessions = sessions.assign(Start = sessions['Start'].dt.floor('s'), End = end.where(end <= server_time, server_time))
+    queue = sessions.groupby('Target').agg({'Zone':'first','Start':'min','End':'max'}).reset_index()
+    queue = queue.assign(Queue_Time = (queue['End'] - queue['Start']).apply(queue_dist))
+    current = queue['End'] >= server_time - pd.Timedelta(seconds=CURRENT_INTERVAL)
+    qtd = {'current':{}, 'boarded':{}}
+    for status, selected in [('current', queue[current]), ('boarded', queue[~current])]:
+        for zone in ZONES:
+            qtd[status][zone] = qtd_transformation(selected[selected['Zone'] == zone][['Target','Queue_Time']], server_time.floor('min'))
+    return qtd
+
+
+def generate(n_devices):
+    """Generate the sessions of the devices within the past 30 minutes"""
+    rng = np.random.RandomState(0)
+    server_time = pd.Timestamp('2021-01-01 08:00:37')
+    n = int(n_devices*SESSIONS_PER_DEVICE)
+    device = rng.randint(0, n_devices, n)
+    targets = rng.randint(0, 2**47, n_devices).astype(np.uint64)[device]
+    zones = rng.choice(ZONES + [0], n_devices)[device]
+    start = server_time - pd.to_timedelta(rng.randint(0, 1800, n), unit='s')
+    return pd.DataFrame({'Target':targets, 'Start':start, 'End':start + pd.to_timedelta(rng.randint(60, 2400, n), unit='s'),
+                         'Zone':zones}), server_time
+
+
+for scale in SCALES:
+    sessions, server_time = generate(N_DEVICES*scale)
+    begin = time.perf_counter()
+    expected = previous(sessions, server_time)
+    previous_time = time.perf_counter() - begin
+    begin = time.perf_counter()
+    qtd = queue_time_distribution(sessions, server_time, server_time - pd.Timedelta(seconds=CURRENT_INTERVAL), ZONES)
+    engine_time = time.perf_counter() - begin
+    same = all(expected[status][zone][QTD_GROUP].iloc[0].astype(int).tolist() == [qtd[status][zone][item] for item in QTD_GROUP]
+               for status in qtd for zone in ZONES)
+    print('{:7d} devices  previous {:8.3f} s  engine {:8.4f} s  same counts: {}'.format(N_DEVICES*scale, previous_time, engine_time, same))
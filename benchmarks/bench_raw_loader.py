@@ -0,0 +1,79 @@
+"""bench_raw_loader.py
+
+This script compares the columnar loader in raw_loader.py with the previous way of reading the
+raw_data collection, i.e. building a python dictionary for each document and a dataframe from the
+list of dictionaries. The documents are encoded to raw BSON batches in memory, so only the decoding
+done by the client is measured. Each path and volume is run in a new python process to measure the
+time used and the peak resident memory of the process, and both paths are checked to return the
+same readings.
+
+The volumes are multiples of N_DOCS readings, the readings of a 30-minute window at the current
+traffic. Another N_DOCS can be given as the first argument.
+
+This script requires that `numpy`, `pandas` and `pymongo` be installed within the Python
+environment you are running this script in.
+
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+ROOT_DIR            = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+N_DOCS              = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+SCALES              = [1, 10, 100]
+BATCH_SIZE          = 100000 # the number of documents of each raw batch, about the 16 MB limit of a batch
+
+CHILD = """
+import time, resource, json, hashlib
+from base64 import b64encode, b64decode
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import bson
+import config
+
+rng = np.random.RandomState(0)
+macs = [b64encode(bytes(mac)).decode() for mac in rng.randint(0, 256, (max({n_docs}//50, 1), 6), dtype=np.uint8)]
+start = datetime(2021, 1, 1)
+batches = []
+for first in range(0, {n_docs}, {batch_size}):
+    n = min({batch_size}, {n_docs} - first)
+    seconds, targets = np.sort(rng.randint(0, 1800, n)), rng.randint(0, len(macs), n)
+    receivers, strengths = rng.randint(1, 12, n), rng.randint(10, 90, n)
+    batches.append(b''.join(bson.encode({{'Time':start + timedelta(seconds=int(seconds[i])), 'Target':macs[targets[i]],
+                                        'Receiver':int(receivers[i]), 'Strength':int(strengths[i])}}) for i in range(n)))
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+begin = time.time()
+if {path!r} == 'dicts':
+    data = pd.DataFrame([doc for raw in batches for doc in bson.decode_all(raw)])
+    data = data.dropna()
+    data = pd.DataFrame(data.groupby(['Time','Target','Receiver']).max().reset_index())
+    data = data.assign(Target = data['Target'].apply(lambda s: b64decode(s.encode()).hex().upper()))
+    data = data.assign(Receiver = data['Receiver'].map(config.SENSOR))
+    data = data.assign(Strength = data['Strength']-100)
+else:
+    from raw_loader import decode_batches, decode_readings
+    data = decode_readings(decode_batches(batches))
+elapsed = time.time() - begin
+
+if {path!r} == 'columns': # compare the MAC addresses in the same format
+    from mac_codec import int_to_hex
+    data = data.assign(Target = int_to_hex(data['Target']))
+
+data = data.astype({{'Time':'datetime64[ns]', 'Strength':'int64'}}).sort_values(['Time','Target','Receiver']).reset_index(drop=True)
+digest = hashlib.md5(pd.util.hash_pandas_object(data, index=False).values.tobytes()).hexdigest()
+print(json.dumps({{'time':elapsed, 'rss':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss, 'digest':digest}}))
+"""
+
+for scale in SCALES:
+    results = {}
+    for path in ['dicts', 'columns']:
+        code = CHILD.format(path=path, n_docs=N_DOCS*scale, batch_size=BATCH_SIZE)
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT_DIR)
+        results[path] = json.loads(output.decode().strip().splitlines()[-1])
+        print('{:4d}x {:8d} docs  {:7s} {:8.3f} s  peak RSS growth {:8.1f} MB'.format(
+            scale, N_DOCS*scale, path, results[path]['time'], results[path]['rss']/1024))
+    print('same readings: {}'.format(results['dicts']['digest'] == results['columns']['digest']))
@@ -0,0 +1,208 @@
+"""buckets.py
+
+This file contains the storage schemas of the sensor readings selected by RAW_SCHEMA in config.py:
+
+- 'document' stores one document for each second, target device and sensor in raw_data.
+- 'bucket' stores one document for each sensor and bucket of BUCKET_SECONDS seconds in raw_buckets. A bucket
+  holds the readings as packed arrays: the offsets of the seconds from the start of the bucket and the signal
+  strengths as bytes, and the MAC addresses of the target devices as 6-byte integers. As data_pool.py stores
+  the closed seconds every STORE_INTERVAL seconds, the readings of a sensor in a bucket may be split into a
+  few documents, which are read together.
+- 'timeseries' stores one document for each reading, as in raw_data, in the MongoDB time-series collection
+  raw_series with the sensor as the metaField, which MongoDB groups into compressed buckets internally.
+  It requires MongoDB 5.0 or later, and as the _id of a time-series collection is not unique, a batch
+  replayed from the spill log after a crash may be stored twice.
+
+The buckets are unpacked straight into the numpy columns returned by raw_loader.py, and the readers
+without MONGO_FILTERS read the three schemas alike. migrate_raw.py copies the readings stored in raw_data
+to the other schemas.
+
+This script requires that `numpy`, `pandas` and `pymongo` be installed within the Python environment you are
+running this script in.
+"""
+
+import numpy as np
+import pandas as pd
+import pymongo
+from bson import Binary
+from mac_codec import int_to_b64
+from raw_loader import COLUMNS, DTYPES
+
+COLLECTIONS         = {'document':'raw_data', 'bucket':'raw_buckets', 'timeseries':'raw_series'} # the collection of each schema
+RETENTION           = 633600 # the readings are kept for this time in seconds
+TARGET_BYTES        = 6 # the bytes of a MAC address in a bucket
+MAX_BUCKET_SECONDS  = 256 # the offsets of the seconds are stored as single bytes
+
+
+def create_collection(database, schema, bucket_seconds=60):
+    """Create the collection of the schema with its indexes if it does not exist
+
+    Parameters
+    ----------
+    database : Database
+        the MongoDB database
+
+    schema : str
+        'document', 'bucket' or 'timeseries'
+
+    bucket_seconds : int
+        the length of a bucket in seconds for the 'bucket' schema
+
+    Returns
+    -------
+    Collection
+        the collection storing the readings
+    """
+    if schema not in COLLECTIONS:
+        raise ValueError('Unknown schema: {}'.format(schema))
+    name = COLLECTIONS[schema]
+    if schema == 'timeseries' and name not in database.list_collection_names():
+        database.create_collection(name, timeseries={'timeField':'Time', 'metaField':'Receiver', 'granularity':'seconds'},
+                                   expireAfterSeconds=RETENTION)
+    collection = database[name]
+    if schema == 'bucket':
+        if bucket_seconds > MAX_BUCKET_SECONDS:
+            raise ValueError('A bucket cannot be longer than {} seconds'.format(MAX_BUCKET_SECONDS))
+        collection.create_index([('Time',pymongo.ASCENDING)], expireAfterSeconds=RETENTION + bucket_seconds)
+    if schema != 'timeseries':
+        collection.create_index([('Receiver',pymongo.ASCENDING),('Time',pymongo.ASCENDING)])
+    return collection
+
+
+def pack_buckets(readings, bucket_seconds=60):
+    """Pack the readings into a document for each sensor and bucket
+
+    Parameters
+    ----------
+    readings : DataFrame or dict
+        the readings with the columns Time, Target, Receiver and Strength as stored in raw_data, and optionally _id,
+        the smallest _id of the readings of a bucket is the _id of the bucket
+
+    bucket_seconds : int
+        the length of a bucket in seconds
+
+    Returns
+    -------
+    list
+        the documents with the fields Time (the start of the bucket), Receiver, Count, Offset, Target and Strength
+    """
+    if not len(readings['Time']):
+        return []
+    seconds = np.asarray(readings['Time']).astype('datetime64[s]').astype(np.int64)
+    receivers = np.asarray(readings['Receiver']).astype(np.int64)
+    order = np.lexsort((seconds, receivers, seconds // bucket_seconds))
+    seconds, receivers = seconds[order], receivers[order]
+    starts = seconds // bucket_seconds * bucket_seconds
+    targets = np.asarray(readings['Target']).astype('<u8')[order]
+    strengths = np.clip(np.asarray(readings['Strength'])[order], 0, 255).astype(np.uint8)
+    ids = np.asarray(readings['_id'])[order] if '_id' in readings else None
+
+    # --- split the sorted readings at each new sensor or bucket --- #
+    bounds = np.flatnonzero((np.diff(starts) != 0) | (np.diff(receivers) != 0)) + 1
+    bounds = np.concatenate([[0], bounds, [len(order)]])
+    docs = []
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        doc = {'Time':pd.Timestamp(int(starts[first]), unit='s').to_pydatetime(), 'Receiver':int(receivers[first]), 'Count':int(last - first),
+               'Offset':Binary((seconds[first:last] - starts[first]).astype(np.uint8).tobytes()),
+               'Target':Binary(targets[first:last].view(np.uint8).reshape(-1, 8)[:, :TARGET_BYTES].tobytes()),
+               'Strength':Binary(strengths[first:last].tobytes())}
+        if ids is not None:
+            doc['_id'] = int(ids[first:last].min())
+        docs.append(doc)
+    return docs
+
+
+def unpack_buckets(docs):
+    """Unpack the documents of the buckets into a numpy column for each field
+
+    Parameters
+    ----------
+    docs : iterable
+        the documents of the buckets
+
+    Returns
+    -------
+    dict
+        a dictionary where the keys are Time, Target, Receiver and Strength and the values are numpy arrays of DTYPES
+    """
+    docs = list(docs)
+    counts = np.array([doc['Count'] for doc in docs], dtype=np.int64)
+    starts = np.array([doc['Time'] for doc in docs], dtype='datetime64[ms]').astype(np.int64)
+    offsets = np.frombuffer(b''.join(doc['Offset'] for doc in docs), dtype=np.uint8)
+    targets = np.zeros((counts.sum(), 8), dtype=np.uint8)
+    targets[:, :TARGET_BYTES] = np.frombuffer(b''.join(doc['Target'] for doc in docs), dtype=np.uint8).reshape(-1, TARGET_BYTES)
+    return {'Time':(np.repeat(starts, counts) + offsets.astype(np.int64)*1000).astype('datetime64[ms]').astype(DTYPES['Time']),
+            'Target':targets.view('<u8').ravel().astype(DTYPES['Target']),
+            'Receiver':np.repeat(np.array([doc['Receiver'] for doc in docs], dtype=np.int64), counts).astype(DTYPES['Receiver']),
+            'Strength':np.frombuffer(b''.join(doc['Strength'] for doc in docs), dtype=np.uint8).astype(DTYPES['Strength'])}
+
+
+def find_bucket_columns(collection, start, end, receivers=None, bucket_seconds=60, strength_below=None):
+    """Read the readings within the time interval from the buckets as a typed numpy column for each field
+
+    Parameters
+    ----------
+    collection : Collection
+        the collection of the buckets
+
+    start : datetime
+        the starting time
+
+    end : datetime
+        the ending time
+
+    receivers : list
+        the AP-IDs of the sensors to be read, None to read all sensors
+
+    bucket_seconds : int
+        the length of a bucket in seconds
+
+    strength_below : int
+        if given, only the readings with a stored signal strength below it are kept
+
+    Returns
+    -------
+    dict
+        the raw columns Time, Target, Receiver and Strength as returned by raw_loader.find_columns
+    """
+    query = {'Time':{'$gte':pd.Timestamp(start).floor('{}s'.format(bucket_seconds)).to_pydatetime(), '$lte':end}}
+    if receivers is not None:
+        query['Receiver'] = {'$in':list(receivers)}
+    columns = unpack_buckets(collection.find(query, {'_id':0}))
+    keep = (columns['Time'] >= np.datetime64(start)) & (columns['Time'] <= np.datetime64(end))
+    if strength_below is not None:
+        keep &= columns['Strength'] < strength_below
+    return {field:columns[field][keep] for field in COLUMNS}
+
+
+def documents(readings, schema, target_format='base64', bucket_seconds=60):
+    """Convert the readings to the documents stored in the collection of the schema
+
+    Parameters
+    ----------
+    readings : DataFrame or dict
+        the readings with the columns Time, Target, Receiver and Strength as stored in raw_data, and optionally _id,
+        e.g. the columns emitted by aggregate.py
+
+    schema : str
+        'document', 'bucket' or 'timeseries'
+
+    target_format : str
+        'base64' or 'int64', the format of the MAC addresses in the documents of a reading
+
+    bucket_seconds : int
+        the length of a bucket in seconds for the 'bucket' schema
+
+    Returns
+    -------
+    list
+        the documents to be inserted
+    """
+    if schema == 'bucket':
+        return pack_buckets(readings, bucket_seconds)
+    fields = [field for field in ['_id'] + COLUMNS if field in readings]
+    targets = np.asarray(readings['Target'])
+    values = {'Time':np.asarray(readings['Time']).astype('datetime64[ms]').tolist(), # as datetime
+              'Target':(targets.astype(np.int64) if target_format == 'int64' else int_to_b64(targets)).tolist()}
+    columns = [values[field] if field in values else np.asarray(readings[field]).tolist() for field in fields]
+    return [dict(zip(fields, row)) for row in zip(*columns)]
@@ -0,0 +1,55 @@
+"""classification.py
+
+This file contains the Neural Network structure of the classification model used by
+process_south.py. It is only imported by classifier.py when the torch backend is used
+or when the weightings are exported by export_model.py.
+
+This script requires that `torch` be installed within the Python
+environment you are running this script in.
+"""
+
+import torch.nn as nn
+
+
+# --- Class set up of Neural Network model for classification --- #
+class Classification(nn.Module):
+    """
+    A class used to represent the Neural Network structure for the classification model
+
+    ...
+
+    Attributes
+    ----------
+    layer_1 : Linear (n_feature to 256)
+    layer_2 : Linear (256 to 128)
+    layer_3:  Linear (128 to 64)
+    layer_out: Linear (64 to n_zone)
+
+    Methods
+    -------
+    forward(x)
+        step forward
+    """
+    def __init__(self, n_feature, n_zone):
+        super(Classification, self).__init__()
+
+        self.layer_1 = nn.Linear(n_feature, 256)
+        self.layer_2 = nn.Linear(256,128)
+        self.layer_3 = nn.Linear(128,64)
+        self.layer_out = nn.Linear(64, n_zone)
+
+        self.ReLU = nn.ReLU()
+
+    def forward(self, x):
+        x = self.layer_1(x)
+        x = self.ReLU(x)
+
+        x = self.layer_2(x)
+        x = self.ReLU(x)
+
+        x = self.layer_3(x)
+        x = self.ReLU(x)
+
+        x = self.layer_out(x)
+
+        return x
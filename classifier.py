@@ -0,0 +1,245 @@
+"""classifier.py
+
+This file contains the classifier used by process_south.py to classify the pooled sensor
+readings to the 4 zones of the South Gate. The weightings of the model are loaded once
+and are only loaded again when the model file is modified, and all readings of a cycle are
+classified in a single forward pass. The predicted zones are cached for each 2-minute bucket
+of each device, so only the buckets with new readings are classified in each cycle.
+
+Two backends are supported. The torch backend runs the Classification model on the weightings
+in resources/model. The numpy backend runs the same layers with numpy on the weightings exported
+to resources/model.npz by export_model.py, so that torch is not required to run process_south.py.
+
+This script requires that `numpy` be installed within the Python environment you are running this
+script in, and `torch` for the torch backend and export_model.
+"""
+
+import os
+import time
+import numpy as np
+
+LAYERS = ['layer_1','layer_2','layer_3','layer_out'] # the linear layers of the Classification model in order
+
+
+class NumpyClassification:
+    """
+    A class used to represent the classification model running on numpy
+
+    ...
+
+    Attributes
+    ----------
+    weights : list
+        the transposed weighting matrix and the bias of each linear layer
+
+    Methods
+    -------
+    __call__(x)
+        returns the output of the last layer, ReLU is applied after all the other layers
+    """
+    def __init__(self, state):
+        self.weights = [(np.ascontiguousarray(state[layer+'.weight'].T, dtype=np.float32),
+                        np.asarray(state[layer+'.bias'], dtype=np.float32)) for layer in LAYERS]
+
+    def __call__(self, x):
+        for weight, bias in self.weights[:-1]:
+            x = np.maximum(np.dot(x, weight) + bias, 0)
+        weight, bias = self.weights[-1]
+        return np.dot(x, weight) + bias
+
+
+def export_model(path, npz_path):
+    """Export the weightings of the torch model file to a .npz file for the numpy backend
+
+    The file is written to a temporary file first and then renamed, so that a running
+    classifier never loads a partially written file.
+
+    Parameters
+    ----------
+    path : str
+        the path of the torch model file
+
+    npz_path : str
+        the path of the exported .npz file
+    """
+    import torch
+    state = torch.load(path, map_location=torch.device('cpu'))
+    tmp_path = npz_path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+        np.savez(fp, **{name: value.numpy().astype(np.float32) for name, value in state.items()})
+    os.replace(tmp_path, npz_path)
+
+
+class ZoneClassifier:
+    """
+    A class used to classify the pooled sensor readings to zones with the weightings in the model file
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        the path of the model file, resources/model for the torch backend or resources/model.npz for the numpy backend
+    n_feature : int
+        the number of features, i.e. the number of sensors
+    n_zone : int
+        the number of zones
+    backend : str
+        'torch' or 'numpy'
+    model : Classification or NumpyClassification
+        the classification model with the loaded weightings
+    mtime : float
+        the modification time of the model file when it was loaded
+    inference_time : float
+        the time used by the latest call of predict in seconds
+
+    Methods
+    -------
+    load()
+        loads the weightings if the model file is modified since it was loaded
+    predict(X, reload=True)
+        returns the zone of each row of X, starting from 1
+    """
+    def __init__(self, path, n_feature, n_zone, backend='torch'):
+        if backend not in ('torch', 'numpy'):
+            raise ValueError('Unknown classifier backend: {}'.format(backend))
+        self.path = path
+        self.n_feature = n_feature
+        self.n_zone = n_zone
+        self.backend = backend
+        self.model = None
+        self.mtime = None
+        self.inference_time = 0.0
+        self.load()
+
+    def load(self):
+        """Load the weightings if the model file is modified since it was loaded
+
+        Returns
+        -------
+        bool
+            True if the weightings are loaded
+        """
+        mtime = os.path.getmtime(self.path)
+        if mtime == self.mtime:
+            return False
+        if self.backend == 'numpy':
+            with np.load(self.path) as state:
+                model = NumpyClassification(state)
+        else:
+            import torch
+            from classification import Classification
+            model = Classification(n_feature = self.n_feature, n_zone = self.n_zone)
+            model.load_state_dict(torch.load(self.path, map_location=torch.device('cpu')))
+            model.eval()
+        self.model = model
+        self.mtime = mtime
+        return True
+
+    def predict(self, X, reload=True):
+        """Classify all rows of the scaled features in a single forward pass
+
+        Parameters
+        ----------
+        X : ndarray
+            the scaled features with one column for each sensor
+
+        reload : bool
+            if True, the weightings are loaded first if the model file is modified, False if the caller has loaded them
+
+        Returns
+        -------
+        ndarray
+            the zone of each row, starting from 1
+        """
+        start = time.time()
+        if reload:
+            try:
+                self.load()
+            except Exception as e: # keep the loaded weightings if the model file cannot be read, e.g. while it is being replaced
+                print(e)
+        X = np.asarray(X, dtype=np.float32)
+        if self.backend == 'numpy':
+            predicted = np.argmax(self.model(X), axis=1)
+        else:
+            import torch
+            with torch.no_grad():
+                _, predicted = torch.max(self.model(torch.from_numpy(X)), 1)
+            predicted = predicted.numpy()
+        self.inference_time = time.time() - start
+        return predicted + 1
+
+
+class ZoneCache:
+    """
+    A class used to cache the predicted zone of each pooled bucket, keyed by Time_I and Target
+
+    The features are scaled with the fixed range feature_range instead of being fitted to each
+    batch, so the zone predicted for a bucket stays valid until the bucket receives new readings.
+    Buckets whose pooled features are unchanged take the cached zone, the others are classified
+    again, and the buckets that are no longer in the window are evicted.
+
+    ...
+
+    Attributes
+    ----------
+    classifier : ZoneClassifier
+        the classifier used for the buckets which are not in the cache
+    features : list
+        the names of the feature columns
+    feature_range : tuple
+        the minimum and maximum of the features, scaled to 0 and 1
+    cache : DataFrame
+        the buckets of the previous cycle with the columns Time_I, Target, the features and Zone
+    n_predicted : int
+        the number of buckets classified in the latest call of classify
+
+    Methods
+    -------
+    classify(grouped)
+        returns the zone of each bucket in grouped
+    """
+    def __init__(self, classifier, features, feature_range):
+        self.classifier = classifier
+        self.features = list(features)
+        self.feature_range = feature_range
+        self.cache = None
+        self.mtime = None
+        self.n_predicted = 0
+
+    def classify(self, grouped):
+        """Classify the buckets which are new or have received new readings and reuse the others
+
+        Parameters
+        ----------
+        grouped : DataFrame
+            the pooled readings with the columns Time_I, Target and the features
+
+        Returns
+        -------
+        ndarray
+            the zone of each row of grouped, starting from 1
+        """
+        try:
+            self.classifier.load()
+        except Exception as e: # keep the loaded weightings if the model file cannot be read, e.g. while it is being replaced
+            print(e)
+        if self.classifier.mtime != self.mtime: # the cached zones are invalid once the weightings are loaded again
+            self.cache = None
+            self.mtime = self.classifier.mtime
+
+        key = ['Time_I','Target'] + self.features
+        if self.cache is None:
+            merged = grouped[key].assign(Zone = np.nan)
+        else:
+            merged = grouped[key].merge(self.cache, how='left', on=key)
+        missing = merged['Zone'].isna().values
+
+        low, high = self.feature_range
+        X = np.clip((merged.loc[missing, self.features].values.astype(np.float32) - low) / (high - low), 0, 1)
+        zones = merged['Zone'].values.copy()
+        zones[missing] = self.classifier.predict(X, reload=False) # the weightings are loaded above
+        self.n_predicted = int(missing.sum())
+
+        self.cache = merged.assign(Zone = zones) # the buckets no longer in grouped are evicted
+        return zones.astype(int)
@@ -12,19 +12,82 @@ import pandas as pd
 
 READ_INTERVAL       = 60*30 # The read inteval is set to half an hour, all data in the past half hour is read by the script
 PROCESS_CYCLE       = 60*1 # The cycle for each loop of the script, the script is set to loop every 60 seconds
+INCREMENTAL_MODE    = True # if True, the readings of the past READ_INTERVAL are kept in memory and only the new readings are read in each cycle
+LATE_INTERVAL       = 60*2 # the readings within this interval before the latest reading are read again in each cycle, it must cover the STORE_INTERVAL of data_pool.py
+REFRESH_INTERVAL    = 60*10 # with INCREMENTAL_MODE, the readings of the past READ_INTERVAL older than LATE_INTERVAL are read from MongoDB again every this number of seconds to pick up the readings stored later, e.g. replayed from the spill log
+MONGO_FILTERS       = False # if True and INCREMENTAL_MODE is False, the weak signal and single reading filters run in MongoDB as an aggregation pipeline
+WEAK_SIGNAL         = -70 # the devices whose strongest signal in a gate is weaker than this are filtered
+TARGET_FORMAT       = 'base64' # the format of the MAC addresses stored by data_pool.py, 'base64' for base64 strings or 'int64' for integers, the readers accept both, but MONGO_FILTERS groups the two formats of a device separately until the other format leaves the window
+INGEST_WORKERS      = 0 # the number of processes receiving the sensor readings in data_pool.py on the same port with SO_REUSEPORT, 0 receives them in a single thread
+UDP_RCVBUF          = 8*1024*1024 # the kernel receive buffer of each socket receiving the sensor readings in bytes
+AGGREGATE_LATENESS  = 5 # data_pool.py stores the strongest signal of a second once a reading this many seconds newer is received, later readings of the second are dropped, it must cover the delay of the sensors and of INGEST_WORKERS (1 second)
+DEDUPLICATE_READINGS = False # if True, the readers group the readings by second, device and sensor again, only needed for the readings stored before data_pool.py aggregated them while receiving
+RAW_SCHEMA          = 'document' # 'document' stores a document for each reading in raw_data, 'bucket' a document of packed arrays for each sensor and BUCKET_SECONDS in raw_buckets, 'timeseries' a document for each reading in the time-series collection raw_series (MongoDB 5.0 or later), see migrate_raw.py to change it; MONGO_FILTERS is not supported with 'bucket'
+BUCKET_SECONDS      = 60 # the length of a bucket in seconds for the 'bucket' schema, at most 256
+HOT_RING            = True # if True, data_pool.py also publishes the readings to a ring buffer in shared memory, from which the processing scripts on the same server read them instead of MongoDB
+RING_PATH           = '/dev/shm/busq_readings.ring' # the file of the ring buffer
+RING_RECORDS        = 2**22 # the number of readings held by the ring buffer, 16 bytes each, it must cover READ_INTERVAL to replace the database reads
+RING_MAX_LAG        = 60 # the processing scripts read from MongoDB instead of the ring buffer if its newest reading is older than this number of seconds, e.g. when data_pool.py stopped
+PUBLISH_INTERVAL    = 1 # the interval in seconds between the publishes of the closed seconds to the ring buffer
+FLUSH_WORKERS       = 1 # the number of workers storing the readings received by data_pool.py, a single worker stores them in order
+FLUSH_MODE          = 'thread' # 'thread' or 'process', the type of the flush workers, always 'thread' when SPILL_LOG is enabled as the spill log has a single writer
+FLUSH_QUEUE_SIZE    = 4 # the maximum number of batches waiting to be stored, further batches are coalesced into the newest waiting batch
+FLUSH_MAX_ROWS      = 500000 # the maximum number of rows of a coalesced batch, the oldest waiting batch is shed beyond this
+FLUSH_TIMEOUT       = 20 # the time in seconds data_pool.py waits for the waiting batches to be stored when it is stopped, it must be shorter than the kill timeout of upstart
+
+CYCLE_POLICY        = 'skip' # the runs of the processing scripts and gen_filter_list.py are aligned to the boundaries of their cycles, 'skip' skips the boundaries missed by a run longer than the cycle, 'catchup' runs them without waiting
+MAX_CATCHUP         = 5 # the maximum number of missed boundaries run with 'catchup', the older ones are skipped
+CYCLE_RETRIES       = 3 # the maximum number of retries of a run failing with a transient MongoDB error
+CYCLE_BACKOFF       = 1 # the time waited before the first retry in seconds, doubled for each retry
+CONCURRENT_GATES    = True # if True, pipeline.py processes and uploads the gates in parallel threads
 
 SCRIPT_DIR          = os.path.dirname(os.path.abspath(__file__)) # The file directory of the script
 RESOURCES_DIR       = os.path.join(SCRIPT_DIR, 'resources') # The directory of the folder storing the resources
 
+NOISE_MODE          = 'state' # how gen_filter_list.py reads the readings of the past NOISE_LOOKBACK_DAYS: 'state' keeps the state of the devices in NOISE_STATE_PATH and reads only the new readings in each run, 'stream' reads them an hour at a time in each run, 'scan' reads them at once
+NOISE_LOOKBACK_DAYS = 3 # the number of days of readings gen_filter_list.py identifies the noise from
+NOISE_WORKERS       = 4 # the number of processes reading and summarizing the hours of readings in parallel for 'state' and 'stream', 0 reads them in gen_filter_list.py
+NOISE_STATE_PATH    = os.path.join(SCRIPT_DIR, 'noise_state.npz') # the file of the state of gen_filter_list.py
+
+METRICS_DIR         = os.path.join(SCRIPT_DIR, 'metrics') # the directory of the JSON lines of the cycles of the processing scripts and of their profiles
+METRICS_WINDOW      = 60 # the percentiles of the wall times of the stages are kept over and printed every this number of cycles
+METRICS_RETENTION   = 7 # the JSON lines are written to a file for each day, the files and the profiles older than this number of days are removed
+PROFILER            = None # None, 'cprofile' or 'pyinstrument', profiles each cycle of the processing scripts
+PROFILE_THRESHOLD   = 0.5 # the profile of a cycle is dumped to METRICS_DIR if it takes longer than this fraction of PROCESS_CYCLE
+
+SPILL_LOG           = True # if True, data_pool.py appends the readings to a local spill log and a background replayer stores them to MongoDB
+SPILL_DIR           = os.path.join(SCRIPT_DIR, 'spill') # the directory of the segments of the spill log
+SPILL_FSYNC         = 'interval' # 'always' fsyncs the spill log after each batch, 'interval' at most every SPILL_FSYNC_INTERVAL seconds, 'never' leaves it to the system
+SPILL_FSYNC_INTERVAL = 1 # the interval between the fsyncs of the spill log in seconds
+SPILL_SEGMENT_BYTES = 64*1024*1024 # a segment of the spill log is rotated once it reaches this size in bytes
+SPILL_SEGMENT_SECONDS = 60*10 # or once it is opened for this time in seconds
+SPILL_REPLAY_ROWS   = 50000 # the maximum number of readings stored to MongoDB at once by the replayer
+
+CLASSIFIER_BACKEND  = 'numpy' # 'numpy' runs the classification model on resources/model.npz exported by export_model.py without torch, 'torch' runs it on resources/model
+FEATURE_RANGE       = (-100, 0) # the pooled signal strengths are scaled from this fixed range to [0, 1] before classification, so the cached zones stay valid across cycles
+
 # a dictionary storing the sensor AP-ID corresponding to their MAC addresses
 SENSOR = {1:'E4956E480EC2', 2:'E4956E480EA6',3:'E4956E480DEE',4:'E4956E480ECA',5:'E4956E480E5A',6:'E4956E480E86',7:'E4956E480EB6',8:'E4956E4A4044',9:'E4956E480E42',10:'E4956E4A4048',11:'E4956E4A4054'}
 NORTH_GATE_RECEIVER = [SENSOR[i] for i in range(1,5)] # a list storing the MAC addresses of the sensors located in the North Gate
 SOUTH_GATE_RECEIVER = [SENSOR[i] for i in range(5,12)] # a list storing the MAC addresses of the sensors located in the South Gate
 
+# a dictionary storing the configuration of each gate processed by pipeline.py, a new gate can be added with its receivers and collections
+# zones maps the zones predicted by the classification model to the columns of the pplno collection, and model is the file of the model in the resources folder
+# the keys of qtd_current and qtd_boarded are the zones, None if the gate is not classified to zones
+GATES = {
+    'south': {'receivers':SOUTH_GATE_RECEIVER, 'zones':{1:'B91M',2:'M11',3:'M104',4:'B91P',0:'None'}, 'model':'model', 'pplno':'pplno_south',
+            'qtd_current':{1:'qtd_current_91m',2:'qtd_current_11',3:'qtd_current_104',4:'qtd_current_91p'},
+            'qtd_boarded':{1:'qtd_boarded_91m',2:'qtd_boarded_11',3:'qtd_boarded_104',4:'qtd_boarded_91p'}},
+    'north': {'receivers':NORTH_GATE_RECEIVER, 'pplno':'pplno_north',
+            'qtd_current':{None:'qtd_current_north'},
+            'qtd_boarded':{None:'qtd_boarded_north'}},
+}
+
 # DB_KEY is used to connect to MongoDB
 DB_KEY = "mongodb://localhost:27017"
 
 QTD_GROUP = ['0-5','5-10','10-15','15-20','20+'] # categories for queue time distribution
+QTD_BOUNDS = [5, 10, 15, 20] # the queue times in minutes where each category but the first starts
 
 # functions
 def load_dat(start, end, filenames):
@@ -51,55 +114,3 @@ def load_dat(start, end, filenames):
             f_time = int(name[:-4])
             if f_time>=start and f_time<=end:
                 yield pd.read_csv(os.path.join(DATA_DIR,date,name), names = ['Time','Target','Receiver','Strength'])
-
-
-def queue_dist(timedelta):
-    """Classify a time period to a queue time group
-
-    Parameters
-    ----------
-    path : Timedelta
-        The time period
-
-    Returns
-    -------
-    str
-        a label indicating the queue time group
-    """
-    global QTD_GROUP
-    if timedelta < pd.Timedelta(minutes=5):
-        return QTD_GROUP[0]
-    elif timedelta < pd.Timedelta(minutes=10):
-        return QTD_GROUP[1]
-    elif timedelta < pd.Timedelta(minutes=15):
-        return QTD_GROUP[2]
-    elif timedelta < pd.Timedelta(minutes=20):
-        return QTD_GROUP[3]
-    else:
-        return QTD_GROUP[4]
-
-def qtd_transformation(df, timestamp):
-    """Pivot a dataframe to generate the queue time distribution table
-
-    Parameters
-    ----------
-    df : DataFrame
-        The input dataframe with the target MAC addresses and their queue time labels
-    timestamp: datetime
-        The time value of the table
-    Returns
-    -------
-    Dataframe
-        a one-row dataframe with the number of people queuing for each of the queue time labels
-    """
-    global QTD_GROUP
-    df = df['Queue_Time'].value_counts().reset_index().transpose()
-    df = df.rename(columns=df.iloc[0]).drop(df.index[0]).reset_index(drop=True)
-    if df.empty:
-        df = pd.DataFrame({item:[0] for item in QTD_GROUP})
-    df['Time'] = timestamp
-    for item in QTD_GROUP:
-        if item not in df.columns:
-            df[item] = 0
-    df = df[['Time']+QTD_GROUP]
-    return df
\ No newline at end of file
@@ -1,68 +1,139 @@
 import socket
 import threading
-import json
-import pandas as pd
-import time
 import os
 import shutil
 import datetime
+import signal
 import config
-from base64 import b64encode
 import pymongo
+from pymongo.errors import BulkWriteError
+from buckets import create_collection, documents
+from aggregate import SecondMax, Emitter
+from datagram import MALFORMED, parse_datagrams
+from ring_buffer import RingWriter
+from ingest import IngestService, open_socket, kernel_drops, receive_batch
+from flush import FlushQueue
+from spill_log import SpillLog, Replayer
 
 
 DATA_DIR = os.path.join(os.path.dirname(__file__),'data')
 SENSOR_MAP = {v:k for k,v in config.SENSOR.items()}
 STORE_INTERVAL = 30 # seconds
+PUBLISH_INTERVAL = config.PUBLISH_INTERVAL
+HOT_RING = config.HOT_RING
+AGGREGATE_LATENESS = config.AGGREGATE_LATENESS
+TARGET_FORMAT = config.TARGET_FORMAT
+RAW_SCHEMA = config.RAW_SCHEMA
+BUCKET_SECONDS = config.BUCKET_SECONDS
+INGEST_WORKERS = config.INGEST_WORKERS
+UDP_RCVBUF = config.UDP_RCVBUF
+FLUSH_WORKERS = config.FLUSH_WORKERS
+FLUSH_MODE = config.FLUSH_MODE
+FLUSH_QUEUE_SIZE = config.FLUSH_QUEUE_SIZE
+FLUSH_MAX_ROWS = config.FLUSH_MAX_ROWS
+FLUSH_TIMEOUT = config.FLUSH_TIMEOUT
+SPILL_LOG = config.SPILL_LOG
+SPILL_DIR = config.SPILL_DIR
+COUNTS = ['received','parsed'] + MALFORMED + ['failed','kernel_dropped'] # failed counts the datagrams of the batches raising an error
+DUPLICATE_KEY = 11000 # the error code of MongoDB for a duplicate _id
 DB_KEY = config.DB_KEY
-COLLECTION = pymongo.MongoClient(DB_KEY)['fyp_2021_busq']['raw_data']
+COLLECTION = {} # the collection of the readings of each process, the MongoClient must not be shared by forked flush workers
+
+def raw_collection():
+    pid = os.getpid()
+    if pid not in COLLECTION:
+        COLLECTION[pid] = create_collection(pymongo.MongoClient(DB_KEY)['fyp_2021_busq'], RAW_SCHEMA, BUCKET_SECONDS)
+    return COLLECTION[pid]
 
 class UdpService:
 
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, save, publish=None):
         self.ip = ip
         self.port = port
-        self.df = []
-        self.interval_counter = time.time()
+        self.aggregator = SecondMax(AGGREGATE_LATENESS) # the strongest signal of each second, device and sensor not stored yet
+        self.emitter = Emitter(self.aggregator, save, STORE_INTERVAL, publish, PUBLISH_INTERVAL)
+        self.counts = dict.fromkeys(COUNTS, 0)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
         # udp connection
         try:
-            udp_threading = threading.Thread(target=self.server_udp)
+            udp_threading = threading.Thread(target=self.server_udp, daemon=True)
             udp_threading.start()
         except socket.error as e:
             pass
 
-    # set up udp server
+    # set up udp server, the datagrams waiting in the socket are received and parsed at once
     def server_udp(self):
-        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        udp_socket.bind((self.ip, self.port))
+        udp_socket = open_socket(self.ip, self.port, UDP_RCVBUF)
         while True:
+            datagrams = []
             try:
-                content, dest_info = udp_socket.recvfrom(1024)
-                raw_data = content.decode()
-                self.df.append(json.loads(raw_data))
-                
-                if time.time()-self.interval_counter >= STORE_INTERVAL:
-                    threading.Thread(target=self.save_file, args=(pd.DataFrame(self.df),)).start()
-                    self.df = []
-                    self.interval_counter = time.time()
+                datagrams = receive_batch(udp_socket, PUBLISH_INTERVAL, PUBLISH_INTERVAL) # the emitter ticks at least every 2*PUBLISH_INTERVAL seconds
+                columns = parse_datagrams(datagrams, SENSOR_MAP, self.counts)
+                with self.lock:
+                    self.counts['received'] += len(datagrams)
+                    self.counts['parsed'] += len(columns['Second'])
+                    self.aggregator.add_columns(columns)
+
+                    # only the closed seconds are published and stored
+                    if self.emitter.tick():
+                        drops = kernel_drops(udp_socket)
+                        if drops is not None:
+                            self.counts['kernel_dropped'] = drops
+                        print('{}: {}'.format(datetime.datetime.now(), ' '.join('{} {}'.format(name, self.counts[name]) for name in COUNTS)))
 
             except Exception as e:
-                pass
+                with self.lock:
+                    self.counts['failed'] += len(datagrams)
+                print('{}: {} datagrams failed: {!r}'.format(datetime.datetime.now(), len(datagrams), e))
+
+    def stop(self):
+        self.stopped.set()
+
+    # wait until stop is called, then store the data received since the last store
+    def run(self):
+        while not self.stopped.wait(1):
+            pass
+        with self.lock:
+            self.emitter.tick(final=True)
+
+# the readings are already aggregated to the strongest signal of each second, device and sensor while they are received
+def save_file(df):
+    if SPILL_LOG:
+        SPILL.append(df)
+    else:
+        insert_readings(df)
+
+# store the readings with the integer MAC addresses in the schema of RAW_SCHEMA, the readings whose _id is already stored are ignored
+def insert_readings(df):
+    if not len(df['Time']):
+        return
+    try:
+        raw_collection().insert_many(documents(df, RAW_SCHEMA, TARGET_FORMAT, BUCKET_SECONDS), ordered=False)
+    except BulkWriteError as e:
+        if e.details.get('writeConcernErrors') or any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+            raise
+
+if SPILL_LOG:
+    SPILL = SpillLog(SPILL_DIR, config.SPILL_SEGMENT_BYTES, config.SPILL_SEGMENT_SECONDS, config.SPILL_FSYNC, config.SPILL_FSYNC_INTERVAL)
+    REPLAYER = Replayer(SPILL_DIR, insert_readings, config.SPILL_REPLAY_ROWS)
+    REPLAYER.start()
+
+FLUSH = FlushQueue(save_file, FLUSH_WORKERS, FLUSH_QUEUE_SIZE, FLUSH_MAX_ROWS, 'thread' if SPILL_LOG else FLUSH_MODE) # the spill log is written by a single process
+RING = RingWriter(config.RING_PATH, config.RING_RECORDS) if HOT_RING else None # the readings are published to the processing scripts
+if INGEST_WORKERS > 0:
+    service = IngestService('0.0.0.0', 3650, INGEST_WORKERS, FLUSH.submit, STORE_INTERVAL, UDP_RCVBUF, SENSOR_MAP, AGGREGATE_LATENESS,
+                            RING.append if HOT_RING else None, PUBLISH_INTERVAL)
+else:
+    service = UdpService('0.0.0.0', 3650, FLUSH.submit, RING.append if HOT_RING else None)
 
-    def save_file(self, df):
-        df = df.rename(columns={'srvTime':'Time','txAddr':'Target','rxAddr':'Receiver','rssi':'Strength'})
-        df = df.assign(Time = pd.to_datetime(df['Time'],unit='ms').dt.tz_localize(tz='Etc/GMT+8').dt.tz_convert(tz=None).dt.floor('S'))
-        df = df.assign(Target = df['Target'].apply(lambda s: b64encode(bytes.fromhex(str(s))).decode()))
-        df = df.assign(Receiver = df['Receiver'].map(SENSOR_MAP))
-        df = df.assign(Strength = df['Strength'] + 100)
-        df = df.groupby(['Time','Target','Receiver'])['Strength'].max().reset_index()
-        if not df.empty:
-            dat = df.to_dict(orient='records')
-            i = 0
-            while i+1000 < len(dat):
-                COLLECTION.insert_many(dat[i:i+1000])
-                i += 1000
-            COLLECTION.insert_many(dat[i:])
-    
-UdpService('0.0.0.0', 3650)
+# store the buffered data before exiting when upstart stops or restarts the script
+signal.signal(signal.SIGTERM, lambda signum, frame: service.stop())
+service.run()
+if not FLUSH.close(FLUSH_TIMEOUT):
+    print('{}: the data is not stored within {} s'.format(datetime.datetime.now(), FLUSH_TIMEOUT))
+if SPILL_LOG: # the readings not stored to MongoDB yet are replayed after restart
+    SPILL.close()
+    REPLAYER.stop(FLUSH_TIMEOUT)
+if HOT_RING: # the file is kept for the processing scripts until data_pool.py creates a new one
+    RING.close()
@@ -0,0 +1,98 @@
+"""datagram.py
+
+This file contains the parser of the datagrams sent by the sensors, used by data_pool.py and ingest.py.
+The sensors send one json object for each reading, of which only srvTime, txAddr, rxAddr and rssi are
+used. A batch of datagrams is parsed at once into typed numpy columns of these four fields, the MAC
+addresses of the target devices as integers and the sensors as their AP-IDs, which are added to the
+aggregation of aggregate.py as a whole.
+
+The datagrams are parsed with `orjson` straight from the bytes if it is installed, otherwise with the
+json module of the standard library. The malformed datagrams are counted by their reason in MALFORMED
+instead of being ignored silently.
+
+This script requires that `numpy` be installed within the Python environment you are running this
+script in, and optionally `orjson`.
+"""
+
+import json
+import numpy as np
+from aggregate import STRENGTH_OFFSET
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    orjson = None
+    def loads(datagram):
+        """Parse a datagram with the json module, which only parses strings in python 3.5"""
+        return json.loads(datagram.decode())
+
+MALFORMED           = ['invalid_json','missing_field','invalid_value','unknown_sensor'] # the reasons of the malformed datagrams
+MAC_LIMIT           = 1 << 48
+RSSI_LIMIT          = 1 << 15 # the rssi is kept as int16
+
+
+def parse_datagrams(datagrams, sensors, malformed=None):
+    """Parse the datagrams into typed columns of the readings
+
+    Parameters
+    ----------
+    datagrams : list
+        the received datagrams in bytes
+
+    sensors : dict
+        a dictionary where the keys are the MAC addresses of the sensors and the values are their AP-IDs
+
+    malformed : dict
+        a dictionary where the keys are MALFORMED and the values are the numbers of malformed datagrams, which are incremented
+
+    Returns
+    -------
+    dict
+        a dictionary with the int64 Second (srvTime in seconds), the uint64 Target, the int16 Receiver (the AP-ID)
+        and the int64 Strength (rssi + STRENGTH_OFFSET) of each well-formed datagram
+    """
+    if malformed is None:
+        malformed = dict.fromkeys(MALFORMED, 0)
+
+    # --- the columns are filled in place up to the number of well-formed datagrams --- #
+    times = np.empty(len(datagrams), dtype=np.int64)
+    targets = np.empty(len(datagrams), dtype=np.uint64)
+    receivers = np.empty(len(datagrams), dtype=np.int16)
+    strengths = np.empty(len(datagrams), dtype=np.int16)
+    n = 0
+    for datagram in datagrams:
+        try:
+            reading = loads(datagram)
+        except ValueError: # including UnicodeDecodeError
+            malformed['invalid_json'] += 1
+            continue
+        try:
+            values = reading['srvTime'], reading['txAddr'], reading['rxAddr'], reading['rssi']
+        except (KeyError, TypeError): # a missing field or a json value other than an object
+            malformed['missing_field'] += 1
+            continue
+        try:
+            receiver = sensors[values[2]]
+        except (KeyError, TypeError):
+            malformed['unknown_sensor'] += 1
+            continue
+        try:
+            time, target, strength = int(values[0]), int(values[1], 16), int(values[3])
+        except (ValueError, TypeError):
+            malformed['invalid_value'] += 1
+            continue
+        if not 0 <= target < MAC_LIMIT or not -RSSI_LIMIT <= strength < RSSI_LIMIT:
+            malformed['invalid_value'] += 1
+            continue
+        try:
+            times[n] = time
+        except OverflowError: # beyond int64
+            malformed['invalid_value'] += 1
+            continue
+        targets[n] = target
+        receivers[n] = receiver
+        strengths[n] = strength
+        n += 1
+    return {'Second':times[:n] // 1000, 'Target':targets[:n], 'Receiver':receivers[:n],
+            'Strength':strengths[:n].astype(np.int64) + STRENGTH_OFFSET}
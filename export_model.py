@@ -0,0 +1,18 @@
+"""export_model.py
+
+This script exports the weightings of the classification model in resources/model to
+resources/model.npz, so that process_south.py can classify the data with the numpy backend
+without torch installed. It has to be run again whenever resources/model is replaced.
+
+This script requires that `numpy` and `torch` be installed within the Python
+environment you are running this script in.
+
+"""
+
+import os
+import config
+from classifier import export_model
+
+RESOURCES_DIR       = config.RESOURCES_DIR
+
+export_model(os.path.join(RESOURCES_DIR,'model'), os.path.join(RESOURCES_DIR,'model.npz'))
@@ -0,0 +1,216 @@
+"""flush.py
+
+This file contains the flush stage used by data_pool.py to store the received readings. Instead of
+starting a new thread for every batch, the batches wait in a bounded queue and are stored by a fixed
+pool of flush workers, which are threads or processes. With a single worker the batches are stored in
+the order they are received.
+
+When the queue is full, a new batch is first coalesced into the newest waiting batch, so that the
+readings are stored with fewer and larger inserts. Only if the coalesced batch would exceed the maximum
+number of rows, the oldest waiting batch is shed, i.e. dropped, and the shedding is reported. The
+queue depth and the latency of each flush are kept as metrics and printed after each flush.
+
+When the process is stopped, close waits for the waiting batches to be stored within a timeout.
+
+A batch is the dictionary of the numpy columns Time, Target, Receiver and Strength emitted by aggregate.py.
+
+This script requires that `numpy` be installed within the Python environment you are running
+this script in.
+"""
+
+import time
+import queue
+import signal
+import threading
+import multiprocessing as mp
+from collections import deque
+from datetime import datetime
+from aggregate import concat_columns
+
+
+def flush_worker(save, tasks, results):
+    """Store the batches taken from tasks and report the latency of each flush to results, the main loop of a flush worker
+
+    Parameters
+    ----------
+    save : function
+        stores a batch
+
+    tasks : Queue
+        the batches to be stored, None stops the worker
+
+    results : Queue
+        the latency in seconds, the number of rows and the error message (None if stored) of each flush
+    """
+    while True:
+        batch = tasks.get()
+        if batch is None:
+            return
+        start = time.time()
+        error = None
+        try:
+            save(batch)
+        except Exception as e:
+            error = str(e)
+        results.put((time.time() - start, len(batch['Time']), error))
+
+
+def process_flush_worker(save, tasks, results):
+    """Run flush_worker in a process which ignores SIGTERM, it is stopped by close once the batches are stored"""
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    flush_worker(save, tasks, results)
+
+
+class FlushQueue:
+    """
+    A class used to represent the bounded queue of the batches waiting to be stored and the pool of flush workers
+
+    ...
+
+    Attributes
+    ----------
+    n_workers : int
+        the number of flush workers
+    max_pending : int
+        the maximum number of batches waiting in the queue
+    max_rows : int
+        the maximum number of rows of a coalesced batch
+    mode : str
+        'thread' or 'process', the type of the flush workers
+    pending : deque
+        the batches waiting in the queue, the oldest first
+    in_flight : int
+        the number of batches being stored
+    metrics : dict
+        the counters of the flushed, coalesced, shed and failed batches and rows, and the latency of the flushes
+
+    Methods
+    -------
+    submit(batch)
+        adds a batch to the queue, coalescing or shedding batches if the queue is full
+    stats()
+        returns the metrics together with the queue depth
+    close(timeout)
+        waits for the waiting batches to be stored and stops the workers
+    """
+    def __init__(self, save, n_workers=1, max_pending=4, max_rows=500000, mode='thread'):
+        if mode not in ('thread', 'process'):
+            raise ValueError('Unknown flush mode: {}'.format(mode))
+        self.n_workers = n_workers
+        self.max_pending = max_pending
+        self.max_rows = max_rows
+        self.mode = mode
+        self.pending = deque()
+        self.in_flight = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.metrics = {'flushed_batches':0, 'flushed_rows':0, 'coalesced_batches':0, 'shed_batches':0, 'shed_rows':0,
+                        'failed_batches':0, 'failed_rows':0, 'last_latency':0.0, 'max_latency':0.0}
+
+        if mode == 'process':
+            context = mp.get_context('fork')
+            self.tasks, self.results = context.Queue(), context.Queue()
+            self.workers = [context.Process(target=process_flush_worker, args=(save, self.tasks, self.results), daemon=True) for _ in range(n_workers)]
+        else:
+            self.tasks, self.results = queue.Queue(), queue.Queue()
+            self.workers = [threading.Thread(target=flush_worker, args=(save, self.tasks, self.results), daemon=True) for _ in range(n_workers)]
+        for worker in self.workers:
+            worker.start()
+        threading.Thread(target=self.dispatch, daemon=True).start()
+        threading.Thread(target=self.collect, daemon=True).start()
+
+    def submit(self, batch):
+        """Add a batch to the queue, the batch is coalesced into the newest waiting batch or the oldest waiting batch is shed if the queue is full
+
+        Parameters
+        ----------
+        batch : dict
+            the readings to be stored
+        """
+        with self.condition:
+            if self.closed:
+                self.shed(batch, 'the flush queue is closed')
+                return
+            if len(self.pending) >= self.max_pending:
+                if len(self.pending[-1]['Time']) + len(batch['Time']) <= self.max_rows:
+                    self.pending[-1] = concat_columns([self.pending[-1], batch])
+                    self.metrics['coalesced_batches'] += 1
+                    return
+                self.shed(self.pending.popleft(), 'the flush queue is full')
+            self.pending.append(batch)
+            self.condition.notify_all()
+
+    def shed(self, batch, reason):
+        """Drop a batch and report it"""
+        self.metrics['shed_batches'] += 1
+        self.metrics['shed_rows'] += len(batch['Time'])
+        print('{}: shed {} rows as {}'.format(datetime.now(), len(batch['Time']), reason))
+
+    def dispatch(self):
+        """Pass the waiting batches to the workers in order, at most one batch for each worker at a time"""
+        while True:
+            with self.condition:
+                while not self.pending or self.in_flight >= self.n_workers:
+                    self.condition.wait()
+                batch = self.pending.popleft()
+                self.in_flight += 1
+            self.tasks.put(batch)
+
+    def collect(self):
+        """Update the metrics with the results of the workers"""
+        while True:
+            result = self.results.get()
+            if result is None:
+                return
+            latency, rows, error = result
+            with self.condition:
+                self.in_flight -= 1
+                if error is None:
+                    self.metrics['flushed_batches'] += 1
+                    self.metrics['flushed_rows'] += rows
+                else:
+                    self.metrics['failed_batches'] += 1
+                    self.metrics['failed_rows'] += rows
+                self.metrics['last_latency'] = latency
+                self.metrics['max_latency'] = max(self.metrics['max_latency'], latency)
+                depth = len(self.pending)
+                self.condition.notify_all()
+            if error is None:
+                print('{}: flushed {} rows in {:.3f} s, {} batches waiting'.format(datetime.now(), rows, latency, depth))
+            else:
+                print('{}: failed to flush {} rows in {:.3f} s: {}'.format(datetime.now(), rows, latency, error))
+
+    def stats(self):
+        """Return the metrics together with the number of batches and rows waiting in the queue and being stored"""
+        with self.condition:
+            stats = dict(self.metrics)
+            stats.update({'depth':len(self.pending), 'pending_rows':sum(len(batch['Time']) for batch in self.pending), 'in_flight':self.in_flight})
+        return stats
+
+    def close(self, timeout):
+        """Wait for the waiting batches to be stored and stop the workers
+
+        Parameters
+        ----------
+        timeout : float
+            the maximum time to wait in seconds
+
+        Returns
+        -------
+        bool
+            True if all batches are stored within the timeout
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            self.closed = True
+            while (self.pending or self.in_flight) and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            drained = not self.pending and not self.in_flight
+            while self.pending:
+                self.shed(self.pending.popleft(), 'the flush queue is not drained within {} s'.format(timeout))
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(max(deadline - time.time(), 0))
+        self.results.put(None)
+        return drained
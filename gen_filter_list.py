@@ -4,8 +4,20 @@ This script reads the sensor readings of the 3 days from the /data directory,
 it identifies the MAC addresses of the devices with the unwanted signals, then store them in 
 filter_list.txt in the /resources directory.
 
-This tool should run continuously and update filter_list.txt every hour
-in order to identify noises in real-time.
+This tool should run continuously and update filter_list.txt every half an hour
+in order to identify noises in real-time. The runs are scheduled by scheduler.py
+at the boundaries of PROCESS_CYCLE.
+
+NOISE_MODE in config.py selects how the readings of the past NOISE_LOOKBACK_DAYS are read.
+With 'state', the state of the devices in noise_state.py is updated only with the readings
+stored since the previous run, and the readings of all days are read only when the state is
+missing or too old. The saved state only holds the readings older than SETTLE_INTERVAL, the
+newer readings are read again and merged into a copy of the state in every run, so the readings
+stored up to SETTLE_INTERVAL late by data_pool.py, e.g. replayed from its spill log, are counted.
+The readings stored even later are not added to the state until it is built again. With 'stream', the readings of all days are read in every run, but an
+hour at a time, so the memory used is bounded by the readings of an hour. In both modes the
+hours are read and summarized by NOISE_WORKERS processes in parallel, and the summaries are
+merged in the order of time. With 'scan', the readings of all days are read at once.
 
 This script requires that `pandas` be installed within the Python
 environment you are running this script in.
@@ -15,84 +27,131 @@ environment you are running this script in.
 import os
 from datetime import datetime
 import time
+import multiprocessing as mp
 import config
-import pandas as pd
-from base64 import b64decode
-import json
+import numpy as np
 import pymongo
+from raw_loader import find_columns, decode_readings
+from buckets import COLLECTIONS, find_bucket_columns
+from mac_codec import oui
+from resource_cache import ResourceCache, publish
+from noise_state import NoiseState, summarize, sort_by_device, frequent_devices, long_staying_devices, LONG_STAY_HOURS
+from scheduler import CycleScheduler
 
 RESOURCES_DIR       = config.RESOURCES_DIR
-READ_INTERVAL       = 60*60*24*3
+READ_INTERVAL       = config.NOISE_LOOKBACK_DAYS*60*60*24
 PROCESS_CYCLE       = 60*30
-
-SENSOR              = config.SENSOR 
+DEDUPLICATE_READINGS = config.DEDUPLICATE_READINGS
+RAW_SCHEMA          = config.RAW_SCHEMA
+BUCKET_SECONDS      = config.BUCKET_SECONDS
+NOISE_MODE          = config.NOISE_MODE
+NOISE_WORKERS       = config.NOISE_WORKERS
+NOISE_STATE_PATH    = config.NOISE_STATE_PATH
+SETTLE_INTERVAL     = 60*60 # the readings are added to the saved state once they are this old, the newer readings are read again in every run
+CHUNK_SECONDS       = 60*60 # the readings are read and summarized an hour at a time
+CYCLE_POLICY        = config.CYCLE_POLICY
+MAX_CATCHUP         = config.MAX_CATCHUP
+CYCLE_RETRIES       = config.CYCLE_RETRIES
+CYCLE_BACKOFF       = config.CYCLE_BACKOFF
 
 DB_KEY = config.DB_KEY
 COLLECTION = pymongo.MongoClient(DB_KEY)['fyp_2021_busq']
-COLLECTION_RAW_DATA = COLLECTION['raw_data']
-
-while True:
-    try:
-        # --- define time interval --- #
-        start = time.time() - READ_INTERVAL
-        end = time.time() 
-
-        data = pd.DataFrame(COLLECTION_RAW_DATA.find({'Time':{'$gte':datetime.fromtimestamp(start),'$lte':datetime.fromtimestamp(end)}},{'_id':0}).sort('Time',pymongo.ASCENDING))
-        if data.empty:
-            time.sleep(PROCESS_CYCLE)
-            continue
-            
-        data = data.dropna()
-        data = pd.DataFrame(data.groupby(['Time','Target','Receiver']).max().reset_index())
-
-        # --- decode the MAC addresses of the target devices and the sensors --- #
-        data = data.assign(Target= data['Target'].apply(lambda s: b64decode(s.encode()).hex().upper()))
-        data = data.assign(Receiver = data['Receiver'].map(SENSOR))
-        data = data.assign(Strength = data['Strength']-100)
-
-        # --- filter existing noises to reduce the size of the dataset  --- #
-        with open(os.path.join(RESOURCES_DIR,"mac_prefix.txt"), "r") as fp:
-            mac_prefix = json.load(fp)
-
-        # data = data[(data['Target'].str[:6].isin(mac_prefix)) | (data['Target'].str[1] == '2') | (data['Target'].str[1] == '6') | (data['Target'].str[1] == 'A') | (data['Target'].str[1] == 'E')].reset_index(drop=True)
-        data = data[data['Target'].str[:6].isin(mac_prefix)].reset_index(drop=True) # Without Virtual MAC Address
-
-        second_filter = pd.DataFrame(data['Target'].value_counts())
-        data = data[~data['Target'].isin(second_filter[second_filter['Target']==1].index)]
-
-        # --- target 1: midnight data  --- #
-        midnight_data = data[(data['Time'].dt.hour >= 2) & (data['Time'].dt.hour <= 4)]
-        noise_target = midnight_data['Target'].unique().tolist()
-
-        data = data[~data['Target'].isin(noise_target)]
-
-        # --- target 2: frequently existing devices --- #
-        data['Date'] = data['Time'].dt.date
-        freq_df = data.groupby(['Date','Target']).agg({'Time':lambda x:x.dt.hour.unique().size}).reset_index()
-        freq_df = freq_df[freq_df['Time'] >= 6] # frequently existing devices
-        noise_target.extend(freq_df['Target'].unique().tolist())
-
-        data = data[~data['Target'].isin(noise_target)]
-
-        # --- target 3: long staying devices --- #
-        data = data[data['Time'] > data['Time'].max()-pd.Timedelta(hours=6)]
-        second_filter = pd.DataFrame(data['Target'].value_counts())
-        data = data[~data['Target'].isin(second_filter[second_filter['Target']<=10].index)] # for long staying device, more than 10 entries of record is expected
-        for target in data['Target'].unique().tolist():
-            time_diff = data[data['Target'] == target]['Time'].diff()
-            time_diff = time_diff[time_diff <= pd.Timedelta(minutes=30)]
-            if time_diff.sum() > pd.Timedelta(minutes=90): # filter signals that last for too long
-                noise_target.append(target)
-
-        # --- store the MAC addresses of the target to a list --- #
-        with open(os.path.join(RESOURCES_DIR, 'filter_list.txt'), 'w') as fp:
-            json.dump(noise_target, fp)
-
-        loop_time = time.time()-end
-        if loop_time < PROCESS_CYCLE:
-            time.sleep(PROCESS_CYCLE - loop_time)
- 
-    except Exception as e:
-        print(e)
-        time.sleep(PROCESS_CYCLE)
-        continue
+COLLECTION_RAW_DATA = COLLECTION[COLLECTIONS[RAW_SCHEMA]]
+
+MAC_PREFIX = ResourceCache(os.path.join(RESOURCES_DIR,"mac_prefix.txt"), key=oui) # parsed again only when the file is modified
+
+
+def read_readings(start, end):
+    """Read the readings within the time interval, start and end are included"""
+    if RAW_SCHEMA == 'bucket':
+        columns = find_bucket_columns(COLLECTION_RAW_DATA, start, end, bucket_seconds=BUCKET_SECONDS)
+    else:
+        columns = find_columns(COLLECTION_RAW_DATA, {'Time':{'$gte':start,'$lte':end}})
+    return decode_readings(columns, deduplicate=DEDUPLICATE_READINGS)
+
+
+def open_worker():
+    """Connect a worker process to the database instead of using the client of the parent process"""
+    global COLLECTION_RAW_DATA
+    COLLECTION_RAW_DATA = pymongo.MongoClient(DB_KEY)['fyp_2021_busq'][COLLECTIONS[RAW_SCHEMA]]
+
+
+def summarize_chunk(chunk):
+    """Read and summarize the readings within the chunk, the starting and ending (excluded) times in the seconds of the stored Time"""
+    return summarize(read_readings(datetime.utcfromtimestamp(chunk[0]), datetime.utcfromtimestamp(chunk[1] - 1))) # the stored Time is in whole seconds
+
+
+def update_state(state, now, pool=None):
+    """Add the readings since the end of the state up to now to the state, a new state is built if it is missing or too old"""
+    if state is None or state.end is None or state.end < now - READ_INTERVAL:
+        state = NoiseState()
+        state.end = now - READ_INTERVAL
+
+    # --- summarize the readings of each hour, in parallel if more than one hour is read, and merge them in order --- #
+    edges = [state.end] + list(range((state.end // CHUNK_SECONDS + 1)*CHUNK_SECONDS, now, CHUNK_SECONDS)) + [now]
+    chunks = [(chunk_start, chunk_end) for chunk_start, chunk_end in zip(edges[:-1], edges[1:]) if chunk_start < chunk_end]
+    summaries = pool.imap(summarize_chunk, chunks) if pool is not None and len(chunks) > 1 else map(summarize_chunk, chunks)
+    for chunk, summary in zip(chunks, summaries):
+        state.merge(summary)
+        state.end = chunk[1]
+    state.expire(now)
+    return state
+
+
+def run_cycle(end):
+    """Identify the noise devices within the READ_INTERVAL before end, a unix timestamp, and publish them to filter_list.txt"""
+    global state
+
+    # --- define time interval --- #
+    start = end - READ_INTERVAL
+
+    if NOISE_MODE != 'scan':
+        now = int(np.datetime64(datetime.fromtimestamp(end), 's').astype(np.int64)) # in the seconds of the stored Time
+        if NOISE_MODE == 'state':
+            # --- the readings of the past SETTLE_INTERVAL are merged into a copy, so the readings stored late by data_pool.py are counted in the next run --- #
+            state = update_state(state, now - SETTLE_INTERVAL, pool)
+            state.save(NOISE_STATE_PATH)
+            current = update_state(state.copy(), now, pool)
+        else:
+            current = update_state(None, now, pool)
+        noise_target = current.noise(MAC_PREFIX, now)
+        publish(os.path.join(RESOURCES_DIR, 'filter_list.txt'), noise_target)
+        print('{}: {} noise devices of {} devices in {:.3f} s'.format(datetime.now(), len(noise_target), len(current.targets), time.time() - end))
+        return
+
+    data = read_readings(datetime.fromtimestamp(start), datetime.fromtimestamp(end))
+    if data.empty:
+        return
+
+    # --- filter existing noises to reduce the size of the dataset  --- #
+    # data = data[MAC_PREFIX.contains(data['Target']) | ((oui(data['Target']) >> np.uint64(16)) & np.uint64(3) == 2)].reset_index(drop=True)
+    data = data[MAC_PREFIX.contains(data['Target'])].reset_index(drop=True) # Without Virtual MAC Address
+
+    second_filter = data['Target'].value_counts()
+    data = data[~data['Target'].isin(second_filter[second_filter==1].index)]
+
+    # --- target 1: midnight data  --- #
+    midnight_data = data[(data['Time'].dt.hour >= 2) & (data['Time'].dt.hour <= 4)]
+    noise_target = midnight_data['Target'].unique().tolist()
+
+    data = data[~data['Target'].isin(noise_target)]
+
+    # --- sort the readings by device and time once for the grouped passes of target 2 and 3 --- #
+    seconds, targets = sort_by_device(data['Time'].values.astype('datetime64[s]').astype(np.int64), data['Target'].values)
+
+    # --- target 2: frequently existing devices --- #
+    noise_target.extend(frequent_devices(seconds, targets).tolist())
+
+    # --- target 3: long staying devices --- #
+    remaining = ~np.isin(targets, np.array(noise_target, dtype=np.uint64))
+    if remaining.any():
+        recent = remaining & (seconds > seconds[remaining].max() - LONG_STAY_HOURS*60*60)
+        noise_target.extend(long_staying_devices(seconds[recent], targets[recent]).tolist())
+
+    # --- store the MAC addresses of the target to a list, replacing the file atomically --- #
+    publish(os.path.join(RESOURCES_DIR, 'filter_list.txt'), noise_target)
+
+
+pool = mp.get_context('fork').Pool(NOISE_WORKERS, initializer=open_worker) if NOISE_WORKERS and NOISE_MODE != 'scan' else None
+state = NoiseState.load(NOISE_STATE_PATH) if NOISE_MODE == 'state' else None
+CycleScheduler('gen_filter_list', PROCESS_CYCLE, CYCLE_POLICY, MAX_CATCHUP, CYCLE_RETRIES, CYCLE_BACKOFF).run(run_cycle)
@@ -0,0 +1,286 @@
+"""ingest.py
+
+This file contains the multi-process receiver used by data_pool.py when INGEST_WORKERS in config.py
+is larger than 0. Each worker process binds its own socket to the same port with SO_REUSEPORT, so
+the kernel spreads the incoming datagrams over the workers and the datagrams are received and parsed
+on multiple cores. Each socket is given a receive buffer of UDP_RCVBUF bytes to absorb bursts.
+
+A worker receives all datagrams waiting in its socket at once, up to BATCH_SIZE or the datagrams of
+BATCH_INTERVAL seconds, without blocking once the first one is received, parses them with
+datagram.py and keeps the strongest signal of each second, target device and sensor with aggregate.py. The aggregated
+readings of about BATCH_INTERVAL seconds are sent to the single writer in the main process as one
+batch. The writer merges the batches and passes the closed seconds to the publish function every
+PUBLISH_INTERVAL seconds and to the save function every STORE_INTERVAL seconds. When the service is stopped, the workers send the readings they hold
+and the writer passes all readings received so far to the save function before it returns.
+
+The numbers of received and parsed datagrams of each worker, the malformed datagrams by their reason
+and the readings dropped because the writer is not keeping up are counted in shared memory, together
+with the datagrams dropped by the kernel because the receive buffer of the socket is full, which are
+read from /proc/net/udp.
+
+This script requires that `numpy` be installed within the Python environment you are running
+this script in, and Linux 3.9 or later for SO_REUSEPORT.
+"""
+
+import os
+import time
+import signal
+import socket
+from queue import Empty, Full
+import multiprocessing as mp
+from datetime import datetime
+from aggregate import SecondMax, Emitter
+from datagram import MALFORMED, parse_datagrams
+
+COUNTERS            = ['received','parsed','dropped','kernel_dropped'] + MALFORMED
+BUFFER_SIZE         = 1024 # the maximum size of a datagram in bytes
+BATCH_SIZE          = 1024 # the maximum number of datagrams received at once
+BATCH_INTERVAL      = 1 # the parsed readings are sent to the writer at least every BATCH_INTERVAL seconds
+QUEUE_SIZE          = 256 # the maximum number of batches waiting for the writer
+
+
+def open_socket(ip, port, rcvbuf, reuseport=False):
+    """Bind a UDP socket with a receive buffer of rcvbuf bytes
+
+    SO_RCVBUFFORCE is tried first as SO_RCVBUF is capped by net.core.rmem_max,
+    which requires the CAP_NET_ADMIN capability.
+
+    Parameters
+    ----------
+    ip : str
+        the address to bind
+
+    port : int
+        the port to bind
+
+    rcvbuf : int
+        the size of the receive buffer in bytes
+
+    reuseport : bool
+        if True, other sockets can bind the same port with SO_REUSEPORT
+
+    Returns
+    -------
+    socket
+        the bound socket
+    """
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        udp_socket.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_RCVBUFFORCE', 33), rcvbuf)
+    except OSError:
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    udp_socket.bind((ip, port))
+    return udp_socket
+
+
+def kernel_drops(udp_socket):
+    """Return the number of datagrams dropped by the kernel for the socket, None if it is not found in /proc/net/udp"""
+    inode = str(os.fstat(udp_socket.fileno()).st_ino)
+    try:
+        with open('/proc/net/udp', 'r') as fp:
+            for line in fp.readlines()[1:]:
+                fields = line.split()
+                if fields[9] == inode:
+                    return int(fields[-1])
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+def receive_batch(udp_socket, timeout, interval):
+    """Wait for a datagram, then take the datagrams already waiting in the receive buffer without blocking
+
+    Parameters
+    ----------
+    udp_socket : socket
+        the bound socket
+
+    timeout : float
+        the time to wait for the first datagram in seconds
+
+    interval : float
+        the datagrams are taken until BATCH_SIZE datagrams or this many seconds after the first one
+
+    Returns
+    -------
+    list
+        the received datagrams in bytes, empty if none is received within timeout
+    """
+    datagrams = []
+    udp_socket.settimeout(timeout)
+    try:
+        datagrams.append(udp_socket.recv(BUFFER_SIZE))
+    except socket.timeout:
+        return datagrams
+    deadline = time.time() + interval
+    udp_socket.setblocking(False) # MSG_DONTWAIT still waits for the timeout of the socket
+    try:
+        while len(datagrams) < BATCH_SIZE and time.time() < deadline:
+            datagrams.append(udp_socket.recv(BUFFER_SIZE))
+    except BlockingIOError:
+        pass
+    return datagrams
+
+
+def receive(ip, port, rcvbuf, sensors, queue, counters, index):
+    """Receive, parse and send the datagrams in batches to the writer, the main loop of a worker process
+
+    Parameters
+    ----------
+    ip : str
+        the address to bind
+
+    port : int
+        the port to bind
+
+    rcvbuf : int
+        the size of the receive buffer in bytes
+
+    sensors : dict
+        a dictionary where the keys are the MAC addresses of the sensors and the values are their AP-IDs
+
+    queue : Queue
+        the queue of the batches sent to the writer
+
+    counters : Array
+        the shared counters, COUNTERS of the worker start at index*len(COUNTERS)
+
+    index : int
+        the index of the worker
+    """
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum)) # send the readings held before exiting
+    udp_socket = open_socket(ip, port, rcvbuf, reuseport=True)
+    base = index*len(COUNTERS)
+    aggregator = SecondMax(0) # the seconds are closed by the writer
+    malformed = dict.fromkeys(MALFORMED, 0)
+    sent = time.time()
+    while not stopping:
+        datagrams = receive_batch(udp_socket, BATCH_INTERVAL, BATCH_INTERVAL)
+        columns = parse_datagrams(datagrams, sensors, malformed)
+        aggregator.add_columns(columns)
+        counters[base+COUNTERS.index('received')] += len(datagrams)
+        counters[base+COUNTERS.index('parsed')] += len(columns['Second'])
+        for reason in MALFORMED:
+            counters[base+COUNTERS.index(reason)] = malformed[reason]
+
+        if time.time() - sent >= BATCH_INTERVAL:
+            items = aggregator.drain()
+            if len(items['Second']):
+                try:
+                    queue.put(items, timeout=BATCH_INTERVAL)
+                except Full: # the writer is not keeping up, the aggregated readings are counted as dropped
+                    counters[base+COUNTERS.index('dropped')] += len(items['Second'])
+            drops = kernel_drops(udp_socket)
+            if drops is not None:
+                counters[base+COUNTERS.index('kernel_dropped')] = drops
+            sent = time.time()
+
+    udp_socket.close()
+    items = aggregator.drain()
+    if len(items['Second']):
+        queue.put(items)
+
+
+class IngestService:
+    """
+    A class used to represent the worker processes receiving the datagrams and the single writer collecting them
+
+    ...
+
+    Attributes
+    ----------
+    ip : str
+        the address to bind
+    port : int
+        the port to bind
+    n_workers : int
+        the number of worker processes
+    save : function
+        called by the writer with the columns of the readings of the seconds closed in every store_interval seconds
+    store_interval : int
+        the interval between the calls of save in seconds
+    rcvbuf : int
+        the size of the receive buffer of each socket in bytes
+    sensors : dict
+        a dictionary where the keys are the MAC addresses of the sensors and the values are their AP-IDs
+    aggregator : SecondMax
+        the strongest signals merged by the writer, a second is closed once a reading lateness seconds newer is received
+    emitter : Emitter
+        passes the closed seconds to publish every publish_interval seconds and to save every store_interval seconds
+    queue : Queue
+        the batches sent by the workers to the writer
+    counters : Array
+        the shared counters of the workers
+
+    Methods
+    -------
+    start()
+        starts the worker processes
+    stats()
+        returns the total of each counter over the workers and the number of late readings
+    stop()
+        lets run return after the readings of the workers are passed to save
+    run()
+        merges the batches and emits the closed seconds until stop is called
+    """
+    def __init__(self, ip, port, n_workers, save, store_interval, rcvbuf, sensors, lateness, publish=None, publish_interval=1):
+        self.ip = ip
+        self.port = port
+        self.n_workers = n_workers
+        self.save = save
+        self.store_interval = store_interval
+        self.rcvbuf = rcvbuf
+        self.sensors = sensors
+        self.aggregator = SecondMax(lateness)
+        self.emitter = Emitter(self.aggregator, save, store_interval, publish, publish_interval)
+        self.context = mp.get_context('fork') # the workers must not import data_pool.py again
+        self.queue = self.context.Queue(QUEUE_SIZE)
+        self.counters = self.context.Array('q', n_workers*len(COUNTERS), lock=False)
+        self.workers = []
+        self.stopping = False
+
+    def start(self):
+        """Start the worker processes"""
+        for index in range(self.n_workers):
+            worker = self.context.Process(target=receive, args=(self.ip, self.port, self.rcvbuf, self.sensors, self.queue, self.counters, index), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stats(self):
+        """Return a dictionary where the keys are COUNTERS and late and the values are their totals over the workers and the late readings dropped by the writer"""
+        stats = {counter:sum(self.counters[index*len(COUNTERS)+i] for index in range(self.n_workers)) for i, counter in enumerate(COUNTERS)}
+        stats['late'] = self.aggregator.late
+        return stats
+
+    def stop(self):
+        """Let run return after the readings of the workers are passed to save, it can be called by a signal handler"""
+        self.stopping = True
+
+    def run(self):
+        """Merge the batches of the workers and emit the closed seconds to publish and save until stop is called"""
+        self.start()
+        while not self.stopping:
+            try:
+                self.aggregator.merge(self.queue.get(timeout=BATCH_INTERVAL))
+            except Empty:
+                pass
+
+            if self.emitter.tick():
+                stats = self.stats()
+                print('{}: {}'.format(datetime.now(), ' '.join('{} {}'.format(counter, stats[counter]) for counter in COUNTERS + ['late'])))
+
+        # --- collect the readings held by the workers, which exit after sending them --- #
+        for worker in self.workers:
+            worker.terminate()
+        deadline = time.time() + 2*BATCH_INTERVAL + 1
+        while time.time() < deadline:
+            try:
+                self.aggregator.merge(self.queue.get(timeout=BATCH_INTERVAL/10))
+            except Empty:
+                if not any(worker.is_alive() for worker in self.workers):
+                    break
+        self.emitter.tick(final=True)
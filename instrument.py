@@ -0,0 +1,262 @@
+"""instrument.py
+
+This file contains the instrumentation of the cycles of the processing pipeline. Each named stage of
+a cycle, e.g. the read from MongoDB, the decoding, the pivot table, the classification or the upload
+of a gate, is wrapped in stage(), which records the rows in and out, the wall time, the CPU time of
+its thread (of the process where the time of a thread is not available), and the current RSS of the
+process at the end of the stage and its change during the stage, read from /proc/self/statm. The
+change of the RSS includes the memory allocated by the other threads in the meantime, e.g. by the
+gates running in parallel. The stages of the gates running in parallel threads are added to the same
+cycle, while the nesting of the stages is kept for each thread.
+
+CycleMetrics records a cycle with all its stages as a JSON line in a file of the day of the cycle in
+METRICS_DIR, together with the peak RSS of the process and the traceback and the stage in progress if
+the cycle failed. The files and the profiles older than METRICS_RETENTION days are removed when the
+file of a new day is started. It also keeps the wall times of the past
+METRICS_WINDOW cycles to print their percentiles once every METRICS_WINDOW cycles. With PROFILER set,
+each cycle is profiled by cProfile or pyinstrument, and the profile is dumped to METRICS_DIR if the
+cycle takes longer than PROFILE_THRESHOLD of the cycle. Both profilers only see the thread running
+the cycle, so CONCURRENT_GATES should be False to profile the gates.
+
+This script requires that `numpy` be installed within the Python environment you are running this
+script in, and `pyinstrument` if PROFILER is 'pyinstrument'.
+"""
+
+import os
+import json
+import time
+import resource
+import threading
+import traceback
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+import numpy as np
+
+PERCENTILES         = [50, 90, 99]
+PROFILERS           = [None, 'cprofile', 'pyinstrument']
+PAGE_SIZE           = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096 # the unit of /proc/self/statm
+
+current = None # the records of the stages of the cycle in progress, None if no cycle is recorded
+lock = threading.Lock() # the stages of the gates running in parallel threads are added to the same cycle
+local = threading.local() # the stack of the stages in progress of each thread
+
+
+def thread_cpu():
+    """Return the CPU time of the calling thread in seconds, of the process where the thread time is not available"""
+    usage = resource.getrusage(resource.RUSAGE_THREAD if hasattr(resource, 'RUSAGE_THREAD') else resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def current_rss():
+    """Return the resident set size of the process in MB, None where /proc/self/statm is not available"""
+    try:
+        with open('/proc/self/statm', 'r') as fp:
+            return round(int(fp.read().split()[1]) * PAGE_SIZE / 2**20, 1)
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def peak_rss():
+    """Return the peak resident set size of the process in MB"""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) # in KB on Linux
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    """Record a named stage of the cycle in progress
+
+    The record yielded is added to the cycle when the stage ends, its rows_out should be set
+    by the stage. A stage started within another stage of the same thread records the name of
+    that stage as its parent. Nothing is recorded if no cycle is in progress.
+
+    Parameters
+    ----------
+    name : str
+        the name of the stage, prefixed by the name of the gate for the gate specific stages
+
+    rows_in : int
+        the number of rows passed to the stage
+
+    Yields
+    ------
+    dict
+        the record of the stage with the keys stage, parent, rows_in and rows_out, and wall, cpu, rss and rss_delta in MB once it ends
+    """
+    if not hasattr(local, 'stack'):
+        local.stack = []
+    record = {'stage':name, 'parent':local.stack[-1]['stage'] if local.stack else None, 'rows_in':rows_in, 'rows_out':None}
+    local.stack.append(record)
+    wall, cpu, rss = time.perf_counter(), thread_cpu(), current_rss()
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        record['wall'] = round(time.perf_counter() - wall, 6)
+        record['cpu'] = round(thread_cpu() - cpu, 6)
+        record['rss'] = current_rss()
+        record['rss_delta'] = None if rss is None or record['rss'] is None else round(record['rss'] - rss, 1)
+        local.stack.pop()
+        with lock:
+            if current is not None:
+                current.append(record)
+
+
+class CycleMetrics:
+    """
+    A class used to represent the metrics of the cycles of a processing script
+
+    ...
+
+    Attributes
+    ----------
+    name : str
+        the name of the script, used as the name of its files in directory
+    cycle : int
+        the length of the cycle in seconds
+    directory : str
+        the directory of the JSON lines and the profiles
+    window : int
+        the number of past cycles kept for the percentiles
+    profiler : str
+        None, 'cprofile' or 'pyinstrument'
+    threshold : float
+        the fraction of the cycle above which the profile of a cycle is dumped
+    retention : int
+        the number of days the files of the JSON lines and the profiles are kept
+    day : str
+        the day of the file the cycles are written to
+    history : dict
+        a dictionary where the keys are the stages, and 'cycle' for the whole cycle, and the values are the wall times of the past cycles
+    n_cycle : int
+        the number of cycles recorded
+
+    Methods
+    -------
+    record(end)
+        records the cycle ending at end and its stages
+    purge(end)
+        removes the files and the profiles older than retention days
+    percentiles()
+        returns the percentiles of the wall times of the past cycles
+    """
+    def __init__(self, name, cycle, directory, window=60, profiler=None, threshold=0.5, retention=7):
+        if profiler not in PROFILERS:
+            raise ValueError('Unknown profiler: {}'.format(profiler))
+        self.name = name
+        self.cycle = cycle
+        self.directory = directory
+        self.window = window
+        self.profiler = profiler
+        self.threshold = threshold
+        self.retention = retention
+        self.day = None
+        self.history = {}
+        self.n_cycle = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def start_profiler(self):
+        """Start and return a profiler of the configured kind, None if profiling is off"""
+        if self.profiler == 'cprofile':
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        if self.profiler == 'pyinstrument':
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+            return profiler
+        return None
+
+    def dump_profile(self, profiler, end):
+        """Stop the profiler and write its profile to the directory, return the path of the profile"""
+        path = os.path.join(self.directory, '{}_{}'.format(self.name, datetime.fromtimestamp(end).strftime('%Y%m%d_%H%M%S')))
+        if self.profiler == 'cprofile':
+            path += '.prof' # read with python -m pstats or snakeviz
+            profiler.dump_stats(path)
+        else:
+            path += '.html'
+            with open(path, 'w') as f:
+                f.write(profiler.output_html())
+        return path
+
+    def purge(self, end):
+        """Remove the files of the JSON lines and the profiles of the script older than retention days before end"""
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename.startswith(self.name + '_') and os.path.getmtime(path) < end - self.retention*24*60*60:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(e)
+
+    @contextmanager
+    def record(self, end):
+        """Record the cycle ending at end and its stages
+
+        Parameters
+        ----------
+        end : float
+            the ending time of the time interval of the cycle as a unix timestamp
+
+        Yields
+        ------
+        list
+            the records of the stages of the cycle
+        """
+        global current
+        stages = current = []
+        error = None
+        profiler = self.start_profiler()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield stages
+        except Exception:
+            error = traceback.format_exc()
+            raise
+        finally:
+            with lock:
+                current = None
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            if profiler is not None:
+                if self.profiler == 'cprofile':
+                    profiler.disable()
+                else:
+                    profiler.stop()
+
+            # --- write the cycle as a JSON line to the file of its day --- #
+            line = {'Time':datetime.fromtimestamp(end).isoformat(), 'name':self.name, 'wall':round(wall, 6), 'cpu':round(cpu, 6),
+                    'rss':current_rss(), 'peak_rss':peak_rss(), 'stages':stages, 'error':error}
+            day = datetime.fromtimestamp(end).strftime('%Y%m%d')
+            if day != self.day:
+                self.day = day
+                self.purge(end)
+            with open(os.path.join(self.directory, '{}_{}.jsonl'.format(self.name, day)), 'a') as f:
+                f.write(json.dumps(line) + '\n')
+
+            # --- keep the wall times of the past cycles --- #
+            for name, seconds in [('cycle', wall)] + [(record['stage'], record['wall']) for record in stages]:
+                if name not in self.history:
+                    self.history[name] = deque(maxlen=self.window)
+                self.history[name].append(seconds)
+            self.n_cycle += 1
+
+            if profiler is not None and wall > self.threshold*self.cycle:
+                print('{}: {} cycle took {:.1f} s, profile dumped to {}'.format(datetime.now(), self.name, wall, self.dump_profile(profiler, end)))
+            if self.n_cycle % self.window == 0:
+                print('{}: {} p{} wall times of the past {} cycles: {}'.format(datetime.now(), self.name, '/p'.join(str(p) for p in PERCENTILES), self.window,
+                      ', '.join('{} {}'.format(name, '/'.join('{:.3f}'.format(value) for value in values)) for name, values in self.percentiles())))
+
+    def percentiles(self):
+        """Return the PERCENTILES of the wall times of the past cycles
+
+        Returns
+        -------
+        list
+            a tuple of the name and the percentiles in seconds for the whole cycle and each stage, the slowest first
+        """
+        result = [(name, np.percentile(np.asarray(seconds), PERCENTILES).tolist()) for name, seconds in self.history.items()]
+        return sorted(result, key=lambda item: item[1][-1], reverse=True)
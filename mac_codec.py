@@ -0,0 +1,153 @@
+"""mac_codec.py
+
+This file contains the vectorized conversions of MAC addresses shared by data_pool.py,
+gen_filter_list.py and the processing scripts. A MAC address is represented as an unsigned 64-bit
+integer holding its 48 bits, so the devices can be compared, grouped and matched by their OUI
+without handling strings. The conversions from and to the 12-digit hexadecimal strings received
+from the sensors and written to filter_list.txt, and from and to the base64 strings stored in the
+raw_data collection by the previous versions of data_pool.py, run on numpy arrays of bytes instead
+of one python call for each address.
+
+This script requires that `numpy` be installed within the Python environment you are running
+this script in.
+"""
+
+import numpy as np
+
+MAC_BITS            = 48
+OUI_BITS            = 24
+HEX_DIGITS          = b'0123456789ABCDEF'
+BASE64_DIGITS       = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+
+HEX_VALUE = np.full(256, -1, dtype=np.int64)
+HEX_VALUE[list(HEX_DIGITS)] = np.arange(16)
+HEX_VALUE[list(HEX_DIGITS.lower())] = np.arange(16)
+BASE64_VALUE = np.full(256, -1, dtype=np.int64)
+BASE64_VALUE[list(BASE64_DIGITS)] = np.arange(64)
+
+
+def as_bytes(values):
+    """Return the strings or bytes as a 2D array with one row of characters for each value"""
+    values = np.asarray(values)
+    if values.dtype.kind == 'U':
+        values = np.char.encode(values, 'ascii')
+    elif values.dtype.kind == 'O':
+        values = np.array([value.encode() if isinstance(value, str) else value for value in values], dtype=bytes)
+    values = values.astype(bytes)
+    width = max(values.dtype.itemsize, 1)
+    return np.frombuffer(values.tobytes(), dtype=np.uint8).reshape(len(values), width)
+
+
+def decode_digits(values, table, bits):
+    """Decode the digits of each value with the lookup table, ignoring the null bytes padded to the shorter values"""
+    chars = as_bytes(values)
+    digits = table[chars]
+    padding = chars == 0
+    if ((digits < 0) & ~padding).any():
+        raise ValueError('Invalid MAC address: {}'.format(np.asarray(values)[((digits < 0) & ~padding).any(axis=1)][0]))
+    result = np.zeros(len(chars), dtype=np.uint64)
+    for column in range(chars.shape[1]):
+        result = np.where(padding[:, column], result, (result << np.uint64(bits)) | digits[:, column].astype(np.uint64))
+    return result
+
+
+def hex_to_int(values):
+    """Convert hexadecimal MAC addresses or prefixes to integers
+
+    Parameters
+    ----------
+    values : array_like
+        the hexadecimal strings, e.g. 'E4956E480EC2' or the OUI 'E4956E'
+
+    Returns
+    -------
+    ndarray
+        the uint64 value of each string
+    """
+    return decode_digits(values, HEX_VALUE, 4)
+
+
+def int_to_hex(values, width=12):
+    """Convert integers to hexadecimal MAC addresses
+
+    Parameters
+    ----------
+    values : array_like
+        the integer MAC addresses
+
+    width : int
+        the number of hexadecimal digits, 12 for MAC addresses and 6 for OUIs
+
+    Returns
+    -------
+    ndarray
+        the upper case hexadecimal string of each value
+    """
+    values = np.asarray(values, dtype=np.uint64).reshape(-1)
+    shifts = np.arange(width-1, -1, -1, dtype=np.uint64) * np.uint64(4)
+    digits = (values[:, None] >> shifts) & np.uint64(0xF)
+    chars = np.frombuffer(HEX_DIGITS, dtype=np.uint8)[digits.astype(np.intp)]
+    return np.ascontiguousarray(chars).view('S{}'.format(width)).ravel().astype('U{}'.format(width))
+
+
+def b64_to_int(values):
+    """Convert base64 encoded MAC addresses to integers
+
+    Parameters
+    ----------
+    values : array_like
+        the base64 encoding of the 6 bytes of each MAC address, e.g. '5JVuSA7C'
+
+    Returns
+    -------
+    ndarray
+        the uint64 value of each MAC address
+    """
+    return decode_digits(values, BASE64_VALUE, 6)
+
+
+def int_to_b64(values):
+    """Convert integers to base64 encoded MAC addresses
+
+    Parameters
+    ----------
+    values : array_like
+        the integer MAC addresses
+
+    Returns
+    -------
+    ndarray
+        the base64 encoding of the 6 bytes of each MAC address
+    """
+    values = np.asarray(values, dtype=np.uint64).reshape(-1)
+    shifts = np.arange(MAC_BITS//6-1, -1, -1, dtype=np.uint64) * np.uint64(6)
+    digits = (values[:, None] >> shifts) & np.uint64(0x3F)
+    chars = np.frombuffer(BASE64_DIGITS, dtype=np.uint8)[digits.astype(np.intp)]
+    return np.ascontiguousarray(chars).view('S{}'.format(MAC_BITS//6)).ravel().astype('U{}'.format(MAC_BITS//6))
+
+
+def to_int(values):
+    """Convert MAC addresses stored either as base64 strings or as integers to integers
+
+    Parameters
+    ----------
+    values : list
+        the Target values of the raw_data documents
+
+    Returns
+    -------
+    ndarray
+        the uint64 value of each MAC address
+    """
+    encoded = np.array([isinstance(value, (str, bytes)) for value in values], dtype=bool)
+    result = np.zeros(len(values), dtype=np.uint64)
+    if encoded.any():
+        result[encoded] = b64_to_int([value for value in values if isinstance(value, (str, bytes))])
+    if not encoded.all():
+        result[~encoded] = np.array([value for value in values if not isinstance(value, (str, bytes))], dtype=np.int64).astype(np.uint64)
+    return result
+
+
+def oui(values):
+    """Return the OUI, i.e. the first 3 bytes, of each integer MAC address"""
+    return np.asarray(values, dtype=np.uint64) >> np.uint64(MAC_BITS - OUI_BITS)
@@ -0,0 +1,100 @@
+"""migrate_raw.py
+
+This script copies the readings stored in raw_data to the collection of another storage schema of buckets.py,
+'bucket' or 'timeseries', which is given as the first argument or read from RAW_SCHEMA in config.py.
+
+Set RAW_SCHEMA in config.py and restart data_pool.py first, so the new readings are stored in the new collection,
+then run this script to copy the older readings up to the last reading in raw_data. The readings are copied an
+hour at a time and the readings of the same second, device and sensor stored by the previous versions of
+data_pool.py are merged to the strongest one. The hour being copied is removed from the new collection before it
+is copied, so the script can be run again after it is interrupted (deleting from a time-series collection
+requires MongoDB 5.1 or later). The copied documents are marked as Migrated and only these are removed, so the
+documents stored by data_pool.py since it switched over are kept, including the ones of the bucket in which it
+switched over. The storage sizes of both collections are printed at the end, after which raw_data can be dropped.
+
+This script requires that `pandas` and `pymongo` be installed within the Python environment you are running
+this script in.
+"""
+
+import sys
+import time
+from datetime import datetime, timedelta
+import pandas as pd
+import pymongo
+import config
+from raw_loader import find_columns
+from buckets import COLLECTIONS, RETENTION, create_collection, documents
+
+SCHEMA              = sys.argv[1] if len(sys.argv) > 1 else config.RAW_SCHEMA
+TARGET_FORMAT       = config.TARGET_FORMAT
+BUCKET_SECONDS      = config.BUCKET_SECONDS
+CHUNK_SECONDS       = 60*60 // BUCKET_SECONDS * BUCKET_SECONDS # the readings are copied about an hour at a time, the chunks never split a bucket
+
+DB_KEY = config.DB_KEY
+
+
+def migrate(source, target, schema, start, end):
+    """Copy the readings within the time interval from raw_data to the collection of the schema
+
+    Parameters
+    ----------
+    source : Collection
+        the raw_data collection
+
+    target : Collection
+        the collection of the schema
+
+    schema : str
+        'bucket' or 'timeseries'
+
+    start : datetime
+        the starting time, included
+
+    end : datetime
+        the ending time, excluded
+
+    Returns
+    -------
+    int
+        the number of readings copied
+    """
+    copied = 0
+    chunk_start = pd.Timestamp(start).floor('{}s'.format(CHUNK_SECONDS)).to_pydatetime()
+    while chunk_start < end:
+        chunk_end = min(chunk_start + timedelta(seconds=CHUNK_SECONDS), end)
+        interval = {'Time':{'$gte':chunk_start,'$lt':chunk_end}}
+        readings = pd.DataFrame(find_columns(source, interval))
+        readings = readings.groupby(['Time','Target','Receiver'])['Strength'].max().reset_index()
+        target.delete_many(dict(interval, Migrated=True)) # the documents stored by data_pool.py are kept
+        if len(readings):
+            docs = documents(readings, schema, TARGET_FORMAT, BUCKET_SECONDS)
+            for doc in docs:
+                doc['Migrated'] = True
+            target.insert_many(docs, ordered=False)
+        copied += len(readings)
+        print('{}: copied {} readings from {} to {}'.format(datetime.now(), len(readings), chunk_start, chunk_end))
+        chunk_start = chunk_end
+    return copied
+
+
+def storage(database, name):
+    """Return the number of documents and the storage and index sizes in bytes of a collection"""
+    stats = database.command('collStats', name)
+    return {key:stats.get(key) for key in ['count','size','storageSize','totalIndexSize']}
+
+
+if __name__ == '__main__':
+    if SCHEMA not in COLLECTIONS or SCHEMA == 'document':
+        raise ValueError("The schema must be 'bucket' or 'timeseries': {}".format(SCHEMA))
+    database = pymongo.MongoClient(DB_KEY)['fyp_2021_busq']
+    source = database[COLLECTIONS['document']]
+    target = create_collection(database, SCHEMA, BUCKET_SECONDS)
+
+    # --- copy the readings up to the last reading stored in raw_data before data_pool.py switched over --- #
+    last = source.find_one({}, {'Time':1}, sort=[('Time',pymongo.DESCENDING)])
+    end = last['Time'] + timedelta(seconds=1) if last is not None else datetime.now() # the stored Time is in whole seconds
+    begin = time.time()
+    copied = migrate(source, target, SCHEMA, end - timedelta(seconds=RETENTION), end)
+    print('{}: copied {} readings in {:.1f} s'.format(datetime.now(), copied, time.time() - begin))
+    for name in [COLLECTIONS['document'], COLLECTIONS[SCHEMA]]:
+        print('{}: {}'.format(name, storage(database, name)))
@@ -182,7 +182,7 @@ class raw_data(Document):
     Strength = IntField()
 
     meta = {
-        "indexes": [{'fields': ['Time'], 'expireAfterSeconds': 633600}],
+        "indexes": [{'fields': ['Time'], 'expireAfterSeconds': 633600}, {'fields': ['Receiver','Time']}],
         "ordering": ["-Time"]
     }
 
@@ -0,0 +1,346 @@
+"""noise_state.py
+
+This file contains the state of the devices kept by gen_filter_list.py to identify the noise without
+reading the readings of the past READ_INTERVAL in every run. The state is updated only with the readings
+stored since the previous run, and the noise is derived from the state of all devices at once:
+
+- the devices seen between 02:00 and 04:59, from the time of the latest reading of each device in these hours
+- the devices seen in FREQUENT_HOURS or more distinct hours of a day, from a 24-bit bitmap of the hours
+  each device is seen in, for each of the past N_DAYS days
+- the devices staying longer than LONG_STAY seconds within the past LONG_STAY_HOURS hours, from the sum of
+  the intervals of at most GAP seconds between the consecutive readings of each device and the number of
+  its readings, for each of the past hours
+
+The devices with a single reading within READ_INTERVAL or with an OUI not in mac_prefix.txt are never noise.
+The days and the hours are kept in rings of slots shared by all devices, a slot is cleared when it is
+reused for a new day or hour, so READ_INTERVAL and LONG_STAY_HOURS start at a whole hour, and the readings
+of each device are counted for whole days. The devices are kept as sorted integer MAC addresses, each with
+a row in every array, about 100 bytes each, and the devices not seen within READ_INTERVAL are dropped.
+
+The readings are first reduced by summarize to a partial aggregate of each device and hour, i.e. the number
+of its readings, its first and last reading and the sum of the intervals between its readings within the
+hour, which is merged into the state in the order of time. The intervals across the hours are added when
+the hours are merged, so the readings can be summarized an hour at a time in separate processes.
+
+The state is saved to NOISE_STATE_PATH after each run, so gen_filter_list.py continues from it after a
+restart. The times are the seconds of the Time stored in the database.
+
+This script requires that `numpy` be installed within the Python environment you are running this
+script in.
+"""
+
+import os
+from datetime import datetime
+import numpy as np
+import config
+
+READ_INTERVAL       = config.NOISE_LOOKBACK_DAYS*60*60*24 # the noise is identified from the readings of the past NOISE_LOOKBACK_DAYS days
+N_DAYS              = READ_INTERVAL // (60*60*24) + 1 # the number of dates READ_INTERVAL touches
+MIDNIGHT_HOURS      = (2, 4) # the devices seen from 02:00 to 04:59 are noise
+FREQUENT_HOURS      = 6 # the devices seen in this many distinct hours of a day are noise
+LONG_STAY_HOURS     = 6 # the long staying devices are identified within the past 6 hours
+N_HOURS             = LONG_STAY_HOURS + 1 # the past hours and the current hour
+LONG_STAY_READINGS  = 10 # for a long staying device, more than 10 readings are expected
+LONG_STAY           = 60*90 # the devices staying longer than 90 minutes are noise
+GAP                 = 60*30 # the intervals longer than 30 minutes between the readings of a device are not counted as staying
+
+NEVER               = np.iinfo(np.int64).min
+HOURS_MASK          = (1 << 24) - 1
+POPCOUNT            = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+SUMMARY_FIELDS      = [('Target',np.uint64),('Hour',np.int64),('Count',np.int64),('First',np.int64),('Last',np.int64),('Dwell',np.int64)]
+DEVICE_FIELDS       = [('hours',np.uint32,N_DAYS),('counts',np.uint32,N_DAYS),('midnight',np.int64,None),('last',np.int64,None),
+                       ('dwell',np.uint32,N_HOURS),('readings',np.uint32,N_HOURS)]
+
+
+def group_reduce(ufunc, index, values):
+    """Reduce the values of each index with ufunc, return the unique indices and the reduced values"""
+    order = np.argsort(index, kind='mergesort')
+    index = index[order]
+    if not len(index):
+        return index, values[order]
+    start = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+    return index[start], ufunc.reduceat(values[order], start)
+
+
+def sort_by_device(time, target):
+    """Sort the readings by device and time, the sorted readings are shared by frequent_devices and long_staying_devices
+
+    Parameters
+    ----------
+    time : ndarray
+        the time of each reading in seconds
+
+    target : ndarray
+        the integer MAC address of each reading
+
+    Returns
+    -------
+    ndarray
+        the sorted times
+    ndarray
+        the sorted MAC addresses
+    """
+    order = np.lexsort((time, target))
+    return time[order], target[order]
+
+
+def frequent_devices(time, target):
+    """Return the devices seen in FREQUENT_HOURS or more distinct hours of a day, from the readings sorted by sort_by_device"""
+    if not len(time):
+        return target[:0]
+    hour = time // (60*60)
+    new_hour = np.r_[True, (target[1:] != target[:-1]) | (hour[1:] != hour[:-1])]
+    hour, target = hour[new_hour], target[new_hour]
+    day = hour // 24
+    new_day = np.flatnonzero(np.r_[True, (target[1:] != target[:-1]) | (day[1:] != day[:-1])])
+    hours = np.diff(np.r_[new_day, len(hour)])
+    return np.unique(target[new_day][hours >= FREQUENT_HOURS])
+
+
+def long_staying_devices(time, target):
+    """Return the devices with more than LONG_STAY_READINGS readings whose intervals of at most GAP seconds
+    sum to more than LONG_STAY seconds, from the readings sorted by sort_by_device"""
+    if not len(time):
+        return target[:0]
+    first = np.r_[True, target[1:] != target[:-1]]
+    device = np.cumsum(first) - 1
+    interval = np.r_[0, np.diff(time)]
+    interval[first | (interval > GAP)] = 0
+    readings, dwell = np.bincount(device), np.bincount(device, weights=interval)
+    return target[first][(readings > LONG_STAY_READINGS) & (dwell > LONG_STAY)]
+
+
+def summarize(data):
+    """Reduce the readings to the partial aggregate of each device and hour merged by NoiseState.merge
+
+    Parameters
+    ----------
+    data : DataFrame
+        the readings with the columns Time and Target as returned by raw_loader.decode_readings
+
+    Returns
+    -------
+    dict
+        the columns of SUMMARY_FIELDS sorted by Target and Hour: the number of readings, the time of the first and
+        the last reading, and the sum of the intervals of at most GAP seconds between the readings within the hour
+    """
+    time, target = sort_by_device(data['Time'].values.astype('datetime64[s]').astype(np.int64), data['Target'].values.astype(np.uint64))
+    if not len(time):
+        return {field:np.zeros(0, dtype=dtype) for field, dtype in SUMMARY_FIELDS}
+    hour = time // (60*60)
+    new = np.r_[True, (target[1:] != target[:-1]) | (hour[1:] != hour[:-1])]
+    start = np.flatnonzero(new)
+    interval = np.r_[0, np.diff(time)]
+    interval[new | (interval > GAP)] = 0
+    return {'Target':target[start], 'Hour':hour[start], 'Count':np.diff(np.r_[start, len(time)]), 'First':time[start],
+            'Last':time[np.r_[start[1:], len(time)] - 1], 'Dwell':np.bincount(np.cumsum(new) - 1, weights=interval).astype(np.int64)}
+
+
+class NoiseState:
+    """
+    A class used to represent the state of the devices used to identify the noise
+
+    ...
+
+    Attributes
+    ----------
+    targets : ndarray
+        the sorted integer MAC addresses of the devices
+    hours : ndarray
+        the bitmap of the hours each device is seen in for each day slot
+    counts : ndarray
+        the number of readings of each device for each day slot
+    midnight : ndarray
+        the time of the latest reading of each device within MIDNIGHT_HOURS
+    last : ndarray
+        the time of the latest reading of each device
+    dwell : ndarray
+        the sum of the intervals of at most GAP seconds ending with a reading of each device for each hour slot
+    readings : ndarray
+        the number of readings of each device for each hour slot
+    day_slots : ndarray
+        the day held by each day slot, -1 if unused
+    hour_slots : ndarray
+        the hour held by each hour slot, -1 if unused
+    end : int
+        the time up to which the readings are added, excluded, None if nothing is added
+
+    Methods
+    -------
+    add(data)
+        updates the state with the readings
+    merge(summary)
+        updates the state with the partial aggregates of the readings
+    copy()
+        returns a copy of the state, to which newer readings can be added without changing the state
+    expire(now)
+        drops the devices not seen within READ_INTERVAL
+    noise(mac_prefix, now)
+        returns the MAC addresses of the noise
+    save(path)
+        saves the state to a .npz file
+    matches()
+        returns True if the arrays have the shapes of the current N_DAYS and N_HOURS
+    load(path)
+        loads the state from a .npz file, None if the file does not exist or does not match
+    """
+    def __init__(self):
+        self.targets = np.zeros(0, dtype=np.uint64)
+        for field, dtype, width in DEVICE_FIELDS:
+            setattr(self, field, np.zeros(0 if width is None else (0, width), dtype=dtype))
+        self.day_slots = np.full(N_DAYS, -1, dtype=np.int64)
+        self.hour_slots = np.full(N_HOURS, -1, dtype=np.int64)
+        self.end = None
+
+    def insert(self, targets):
+        """Add rows for the new devices, keeping the devices sorted"""
+        merged = np.union1d(self.targets, targets)
+        position = np.searchsorted(merged, self.targets)
+        for field, dtype, width in DEVICE_FIELDS:
+            values = np.full(len(merged) if width is None else (len(merged), width), NEVER if width is None else 0, dtype=dtype)
+            values[position] = getattr(self, field)
+            setattr(self, field, values)
+        self.targets = merged
+
+    def advance(self, slots, columns, latest):
+        """Clear the slots reused for the days or hours up to latest"""
+        for unit in range(max(latest - len(slots) + 1, slots.max() + 1), latest + 1):
+            slot = unit % len(slots)
+            slots[slot] = unit
+            for values in columns:
+                values[:, slot] = 0
+
+    def add(self, data):
+        """Update the state with the readings, all newer than the readings already added
+
+        Parameters
+        ----------
+        data : DataFrame
+            the readings with the columns Time and Target as returned by raw_loader.decode_readings
+        """
+        self.merge(summarize(data))
+
+    def merge(self, summary):
+        """Update the state with the partial aggregates of the devices
+
+        Parameters
+        ----------
+        summary : dict
+            the partial aggregates returned by summarize, all newer than the readings already merged
+        """
+        target, hour, count, last = summary['Target'], summary['Hour'], summary['Count'], summary['Last']
+        if not len(target):
+            return
+        new = np.setdiff1d(np.unique(target), self.targets, assume_unique=True)
+        if len(new):
+            self.insert(new)
+        self.advance(self.day_slots, [self.hours, self.counts], int(hour.max()) // 24)
+        self.advance(self.hour_slots, [self.dwell, self.readings], int(hour.max()))
+        index = np.searchsorted(self.targets, target)
+
+        # --- the hours and the number of readings of each day, the readings older than the day slots are dropped --- #
+        day = hour // 24
+        day_slot = day % N_DAYS
+        kept = self.day_slots[day_slot] == day
+        cell = index[kept]*N_DAYS + day_slot[kept]
+        self.counts += np.bincount(cell, weights=count[kept], minlength=self.counts.size).reshape(self.counts.shape).astype(np.uint32)
+        cell, bits = group_reduce(np.bitwise_or, cell, np.left_shift(1, hour[kept] % 24).astype(np.uint32))
+        self.hours.ravel()[cell] |= bits
+
+        # --- the latest reading within MIDNIGHT_HOURS --- #
+        midnight = (hour % 24 >= MIDNIGHT_HOURS[0]) & (hour % 24 <= MIDNIGHT_HOURS[1])
+        device, latest = group_reduce(np.maximum, index[midnight], last[midnight])
+        self.midnight[device] = np.maximum(self.midnight[device], latest)
+
+        # --- the intervals within each hour and from the previous reading of the device to its first reading in the hour --- #
+        first = np.r_[True, index[1:] != index[:-1]]
+        previous = np.r_[NEVER, last[:-1]]
+        previous[first] = self.last[index[first]]
+        seen = previous != NEVER
+        interval = np.zeros(len(target), dtype=np.int64)
+        interval[seen] = summary['First'][seen] - previous[seen]
+        interval[(interval > GAP) | (interval < 0)] = 0
+        hour_slot = hour % N_HOURS
+        kept = self.hour_slots[hour_slot] == hour
+        cell = index[kept]*N_HOURS + hour_slot[kept]
+        self.dwell += np.bincount(cell, weights=(summary['Dwell'] + interval)[kept], minlength=self.dwell.size).reshape(self.dwell.shape).astype(np.uint32)
+        self.readings += np.bincount(cell, weights=count[kept], minlength=self.readings.size).reshape(self.readings.shape).astype(np.uint32)
+        device, latest = group_reduce(np.maximum, index, last)
+        self.last[device] = np.maximum(self.last[device], latest)
+
+    def copy(self):
+        """Return a copy of the state, e.g. to add the readings which may still be stored late"""
+        state = NoiseState()
+        for field in ['targets','day_slots','hour_slots'] + [field for field, dtype, width in DEVICE_FIELDS]:
+            setattr(state, field, getattr(self, field).copy())
+        state.end = self.end
+        return state
+
+    def expire(self, now):
+        """Drop the devices not seen within READ_INTERVAL before now"""
+        kept = self.last >= now - READ_INTERVAL
+        self.targets = self.targets[kept]
+        for field, dtype, width in DEVICE_FIELDS:
+            setattr(self, field, getattr(self, field)[kept])
+
+    def noise(self, mac_prefix, now):
+        """Identify the noise from the state
+
+        Parameters
+        ----------
+        mac_prefix : ResourceCache
+            the OUIs in mac_prefix.txt
+
+        now : int
+            the current time in the seconds of the stored Time
+
+        Returns
+        -------
+        ndarray
+            the sorted integer MAC addresses of the noise
+        """
+        start = now - READ_INTERVAL
+        start_day, start_hour = start // (60*60*24), start // (60*60) % 24
+        days = self.day_slots >= start_day
+        mask = np.where(self.day_slots == start_day, (HOURS_MASK << start_hour) & HOURS_MASK, HOURS_MASK) * days
+        hours = np.ascontiguousarray(self.hours & mask.astype(np.uint32))
+        valid = mac_prefix.contains(self.targets) & ((self.counts * days).sum(axis=1) > 1)
+
+        midnight = self.midnight >= start
+        frequent = (POPCOUNT[hours.view(np.uint8)].reshape(len(hours), N_DAYS, 4).sum(axis=2) >= FREQUENT_HOURS).any(axis=1)
+        recent = self.hour_slots >= now // (60*60) - LONG_STAY_HOURS
+        long_stay = ((self.readings * recent).sum(axis=1) > LONG_STAY_READINGS) & ((self.dwell * recent).sum(axis=1) > LONG_STAY)
+        return self.targets[valid & (midnight | frequent | long_stay)]
+
+    def save(self, path):
+        """Save the state to a .npz file, replacing the file atomically"""
+        arrays = {field:getattr(self, field) for field in ['targets','day_slots','hour_slots'] + [field for field, dtype, width in DEVICE_FIELDS]}
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            np.savez(fp, end=np.array(-1 if self.end is None else self.end), **arrays)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, path)
+
+    def matches(self):
+        """Return True if the slots and the arrays of the devices have the shapes of the current N_DAYS and N_HOURS"""
+        if self.day_slots.shape != (N_DAYS,) or self.hour_slots.shape != (N_HOURS,) or self.targets.ndim != 1:
+            return False
+        return all(getattr(self, field).shape == ((len(self.targets),) if width is None else (len(self.targets), width))
+                   for field, dtype, width in DEVICE_FIELDS)
+
+    @classmethod
+    def load(cls, path):
+        """Load the state from a .npz file, None if the file does not exist or does not match N_DAYS and N_HOURS,
+        e.g. after NOISE_LOOKBACK_DAYS is changed, so the state is built again from the readings"""
+        if not os.path.exists(path):
+            return None
+        state = cls()
+        with np.load(path) as arrays:
+            for field in arrays.files:
+                setattr(state, field, arrays[field])
+        if not state.matches():
+            print('{}: the noise state in {} does not match {} days and {} hours, it is built again'.format(datetime.now(), path, N_DAYS, N_HOURS))
+            return None
+        state.end = None if int(state.end) < 0 else int(state.end)
+        return state
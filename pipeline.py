@@ -0,0 +1,324 @@
+"""pipeline.py
+
+This file contains the processing pipeline shared by process_south.py, process_north.py and
+process_gates.py. The pipeline reads and decodes the sensor readings of the past READ_INTERVAL
+once in each cycle, applies the filters common to all gates, and then passes the readings to
+each gate configured in GATES of config.py. Each gate filters the readings of its own sensors,
+classifies them to zones if it has a classification model, counts the people and derives the
+queue time distributions, and uploads the results to its own collections. The stages of each cycle
+are recorded by instrument.py.
+
+This script requires that `pandas`, `numpy` and `pymongo` be installed within the Python
+environment you are running this script in.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import pymongo
+import config
+from mac_codec import oui
+from resource_cache import ResourceCache
+from window import SlidingWindow, replace_targets
+from buckets import COLLECTIONS
+from ring_buffer import RingReader
+from sessions import sessionize, occupancy, queue_time_distribution
+from scheduler import CycleScheduler, run_concurrently
+from instrument import CycleMetrics, stage
+
+READ_INTERVAL       = config.READ_INTERVAL
+PROCESS_CYCLE       = config.PROCESS_CYCLE
+INCREMENTAL_MODE    = config.INCREMENTAL_MODE
+LATE_INTERVAL       = config.LATE_INTERVAL
+REFRESH_INTERVAL    = config.REFRESH_INTERVAL
+MONGO_FILTERS       = config.MONGO_FILTERS
+RAW_SCHEMA          = config.RAW_SCHEMA
+HOT_RING            = config.HOT_RING
+WEAK_SIGNAL         = config.WEAK_SIGNAL
+CYCLE_POLICY        = config.CYCLE_POLICY
+MAX_CATCHUP         = config.MAX_CATCHUP
+CYCLE_RETRIES       = config.CYCLE_RETRIES
+CYCLE_BACKOFF       = config.CYCLE_BACKOFF
+CONCURRENT_GATES    = config.CONCURRENT_GATES
+METRICS_DIR         = config.METRICS_DIR
+METRICS_WINDOW      = config.METRICS_WINDOW
+METRICS_RETENTION   = config.METRICS_RETENTION
+PROFILER            = config.PROFILER
+PROFILE_THRESHOLD   = config.PROFILE_THRESHOLD
+
+RESOURCES_DIR       = config.RESOURCES_DIR
+CLASSIFIER_BACKEND  = config.CLASSIFIER_BACKEND
+FEATURE_RANGE       = config.FEATURE_RANGE
+
+
+class Gate:
+    """
+    A class used to represent the gate specific stages of the pipeline
+
+    ...
+
+    Attributes
+    ----------
+    name : str
+        the name of the gate
+    receivers : list
+        the MAC addresses of the sensors located in the gate
+    zones : dict
+        a dictionary where the keys are the zones and the values are the column names in the pplno collection,
+        None if the gate is not classified to zones
+    zone_cache : ZoneCache
+        the cached classifier of the gate, None if the gate is not classified to zones
+    pplno : Collection
+        the collection storing the no. of people
+    qtd_current : dict
+        a dictionary where the keys are the zones and the values are the collections storing the queue time distribution of current waiting passengers
+    qtd_boarded : dict
+        a dictionary where the keys are the zones and the values are the collections storing the queue time distribution of boarded passengers
+
+    Methods
+    -------
+    process(data, touched, server_time, noise_target, mac_prefix)
+        derives the no. of people and the queue time distributions from the readings
+    upload(pplno, qtd)
+        uploads the records which are not uploaded yet
+    """
+    def __init__(self, name, database, receivers, pplno, qtd_current, qtd_boarded, zones=None, model=None):
+        self.name = name
+        self.receivers = list(receivers)
+        self.zones = zones
+        self.zone_cache = None
+        if model is not None:
+            from classifier import ZoneClassifier, ZoneCache
+            path = os.path.join(RESOURCES_DIR, model + ('.npz' if CLASSIFIER_BACKEND == 'numpy' else ''))
+            classifier = ZoneClassifier(path, n_feature = len(self.receivers), n_zone = len(qtd_current), backend = CLASSIFIER_BACKEND)
+            self.zone_cache = ZoneCache(classifier, self.receivers, FEATURE_RANGE)
+        self.pplno = database[pplno]
+        self.qtd_current = {zone:database[collection] for zone, collection in qtd_current.items()}
+        self.qtd_boarded = {zone:database[collection] for zone, collection in qtd_boarded.items()}
+
+        self.gate_cache = None # the pivoted readings of the previous cycles
+        self.grouped_cache = None # the pooled readings of the previous cycles
+        self.session_cache = None # the sessions of each device in the previous cycles
+
+    def process(self, data, touched, server_time, noise_target, mac_prefix):
+        """Derive the no. of people and the queue time distributions from the readings
+
+        Parameters
+        ----------
+        data : DataFrame
+            the readings of the devices in touched with the columns Time, Target, Receiver and Strength
+
+        touched : set
+            the integer MAC addresses of the devices with new, late or expired readings
+
+        server_time : datetime
+            the time of the latest reading
+
+        noise_target : ResourceCache
+            the MAC addresses in filter_list.txt
+
+        mac_prefix : ResourceCache
+            the OUIs in mac_prefix.txt
+
+        Returns
+        -------
+        DataFrame
+            the no. of people in every 5 seconds
+        dict
+            a dictionary where the keys are 'current' and 'boarded' and the values are dictionaries of the queue time distribution record of each zone
+        """
+        # --- get only the data of the gate --- #
+        with stage(self.name + '.filter', len(data)) as record:
+            gate_data = data[data['Receiver'].isin(self.receivers)]
+
+            # --- filter weak signals --- #
+            weak_target = gate_data.groupby(['Target'])['Strength'].max().reset_index()
+            weak_target = weak_target[weak_target['Strength'] < WEAK_SIGNAL]['Target'].tolist()
+            gate_data = gate_data[~gate_data['Target'].isin(weak_target)]
+            record['rows_out'] = len(gate_data)
+
+        # --- assign a column for each sensor --- #
+        with stage(self.name + '.pivot', len(gate_data)) as record:
+            if not gate_data.empty:
+                gate_data = pd.pivot_table(gate_data,index=['Time','Target'],columns='Receiver',values='Strength',fill_value=-100).reset_index()
+                for sensor in self.receivers:
+                    if sensor not in gate_data:
+                        gate_data[sensor] = -100
+                gate_data.columns.name = None
+            else:
+                gate_data = pd.DataFrame(columns=['Time','Target']+self.receivers).astype({'Time':'datetime64[ns]','Target':np.uint64})
+
+            # --- filter signal which appear only once --- #
+            second_filter = gate_data['Target'].value_counts()
+            gate_data = gate_data[~gate_data['Target'].isin(second_filter[second_filter==1].index)]
+            record['rows_out'] = len(gate_data)
+
+        # --- replace the data of the devices with new or expired readings --- #
+        with stage(self.name + '.sessionize', len(gate_data)) as record:
+            self.gate_cache = replace_targets(self.gate_cache, gate_data, touched)
+            self.session_cache = replace_targets(self.session_cache, sessionize(gate_data), touched)
+            if self.zone_cache is not None:
+                gate_data = gate_data.assign(Time_I = gate_data['Time'].dt.floor('2min'))
+                grouped = gate_data.groupby(['Time_I','Target'])[self.receivers].mean().reset_index()
+                self.grouped_cache = replace_targets(self.grouped_cache, grouped, touched)
+            record['rows_out'] = len(self.session_cache)
+
+        # --- filter data in the list --- #
+        with stage(self.name + '.noise', len(self.gate_cache)) as record:
+            # gate_data = gate_data[mac_prefix.contains(gate_data['Target']) | ((oui(gate_data['Target']) >> np.uint64(16)) & np.uint64(3) == 2)].reset_index(drop=True) # with virtual mac, the second hex digit is 2, 6, A or E
+            valid = ~noise_target.contains(self.gate_cache['Target']) & mac_prefix.contains(self.gate_cache['Target']) # without virtual mac
+            gate_data = self.gate_cache[valid].reset_index(drop=True)
+            sessions = self.session_cache[self.session_cache['Target'].isin(gate_data['Target'])]
+            record['rows_out'] = len(gate_data)
+
+        # --- classify the pooled data and assign a zone to each session --- #
+        if self.zone_cache is not None:
+            with stage(self.name + '.classify', len(self.grouped_cache)) as record:
+                grouped = self.grouped_cache[self.grouped_cache['Target'].isin(gate_data['Target'])].reset_index(drop=True)
+                grouped = grouped.fillna(0)
+                grouped[self.receivers] = grouped[self.receivers].astype(int)
+                grouped['Zone'] = self.zone_cache.classify(grouped)
+                record['predicted'] = self.zone_cache.n_predicted # the buckets not found in the cache
+                record['inference'] = round(self.zone_cache.classifier.inference_time, 6) if self.zone_cache.n_predicted else 0.0
+
+                gate_data = gate_data.assign(Time_I = gate_data['Time'].dt.floor('2min'))
+                gate_data = gate_data[['Time','Target','Time_I']].merge(grouped[['Time_I','Target','Zone']],how='left')
+                zone_count = gate_data.groupby(['Target','Zone']).size().reset_index(name='Count')
+                zone_mode = zone_count.sort_values(['Count','Zone'],ascending=[False,True]).drop_duplicates('Target').set_index('Target')['Zone']
+                sessions = sessions.assign(Zone = sessions['Target'].map(zone_mode))
+                record['rows_out'] = len(grouped)
+
+        # --- count the queue times of current waiting and boarded passengers --- #
+        with stage(self.name + '.qtd', len(sessions)):
+            qtd = queue_time_distribution(sessions, server_time, server_time - pd.Timedelta(seconds=PROCESS_CYCLE),
+                                          zones=None if self.zone_cache is None else list(self.qtd_current))
+        if sessions.empty:
+            pplno = pd.DataFrame({'Time':pd.date_range((server_time-timedelta(seconds=READ_INTERVAL)).floor('5s'), server_time.floor('5s'), freq='5s')})
+            for column in (['Target'] if self.zones is None else list(self.zones.values())):
+                pplno[column] = 0
+            return pplno, qtd
+
+        # --- count the sessions in each zone --- #
+        with stage(self.name + '.occupancy', len(sessions)) as record:
+            pplno = occupancy(sessions, server_time, zones=self.zones)
+            record['rows_out'] = len(pplno)
+        return pplno, qtd
+
+    def upload(self, pplno, qtd):
+        """Upload the records which are not uploaded yet
+
+        Parameters
+        ----------
+        pplno : DataFrame
+            the no. of people in every 5 seconds
+
+        qtd : dict
+            the queue time distributions returned by process
+        """
+        with stage(self.name + '.upload', len(pplno)) as uploaded:
+            # --- filter records that already uploaded to DB --- #
+            previous_pplno = pd.DataFrame(self.pplno.find({'Time':{'$gte':datetime.now()-timedelta(hours=1)}},{'_id':0,'Time':1}).sort('Time',pymongo.DESCENDING).limit(720))
+            if not previous_pplno.empty:
+                pplno = pplno[~pplno['Time'].isin(previous_pplno['Time'])].reset_index(drop=True)
+
+            records = []
+            for status, collections in [('current', self.qtd_current), ('boarded', self.qtd_boarded)]:
+                for zone, collection in collections.items():
+                    record = qtd[status][zone]
+                    previous_durations = pd.DataFrame(collection.find({'Time':{'$gte':datetime.now()-timedelta(hours=1)}},{'_id':0}).sort('Time',pymongo.DESCENDING).limit(60))
+                    if not previous_durations.empty:
+                        if record['Time'] in previous_durations['Time'].to_list():
+                            continue
+                    records.append((record, collection))
+
+            # --- upload records to DB --- #
+            if not pplno.empty:
+                dat = pplno.to_dict(orient='records')
+                i = 0
+                while i+1000 < len(dat):
+                    self.pplno.insert_many(dat[i:i+1000])
+                    i += 1000
+                self.pplno.insert_many(dat[i:])
+
+            for record, collection in records:
+                collection.insert_one(record)
+            uploaded['rows_out'] = len(pplno) + len(records)
+
+
+class Pipeline:
+    """
+    A class used to represent the processing pipeline of one or more gates sharing one read of the raw data
+
+    ...
+
+    Attributes
+    ----------
+    window : SlidingWindow
+        the readings of the past READ_INTERVAL
+    gates : list
+        the gates to be processed
+    noise_target : ResourceCache
+        the MAC addresses in filter_list.txt, parsed again only when the file is modified
+    mac_prefix : ResourceCache
+        the OUIs in mac_prefix.txt, parsed again only when the file is modified
+    executor : ThreadPoolExecutor
+        the threads processing the gates in parallel, None if the gates are processed one after another
+    scheduler : CycleScheduler
+        the schedule of the cycles aligned to the wall clock
+    metrics : CycleMetrics
+        the metrics of the stages of each cycle
+
+    Methods
+    -------
+    process(end)
+        reads the new readings and processes all gates once
+    run()
+        processes all gates at every boundary of PROCESS_CYCLE
+    """
+    def __init__(self, gate_names, db_key=config.DB_KEY):
+        database = pymongo.MongoClient(db_key)['fyp_2021_busq']
+        self.gates = [Gate(name, database, **config.GATES[name]) for name in gate_names]
+        self.window = SlidingWindow(database[COLLECTIONS[RAW_SCHEMA]], READ_INTERVAL, LATE_INTERVAL, {gate.name:gate.receivers for gate in self.gates},
+                                    incremental=INCREMENTAL_MODE, aggregate=MONGO_FILTERS, ring=RingReader(config.RING_PATH, config.RING_MAX_LAG) if HOT_RING else None, refresh_interval=REFRESH_INTERVAL)
+        self.noise_target = ResourceCache(os.path.join(RESOURCES_DIR,"filter_list.txt"))
+        self.mac_prefix = ResourceCache(os.path.join(RESOURCES_DIR,"mac_prefix.txt"), key=oui)
+        self.executor = ThreadPoolExecutor(len(self.gates)) if CONCURRENT_GATES and len(self.gates) > 1 else None
+        self.scheduler = CycleScheduler('+'.join(gate_names), PROCESS_CYCLE, CYCLE_POLICY, MAX_CATCHUP, CYCLE_RETRIES, CYCLE_BACKOFF)
+        self.metrics = CycleMetrics('+'.join(gate_names), PROCESS_CYCLE, METRICS_DIR, METRICS_WINDOW, PROFILER, PROFILE_THRESHOLD, METRICS_RETENTION)
+
+    def process(self, end):
+        """Read the new readings and process all gates once
+
+        Parameters
+        ----------
+        end : float
+            the ending time of the time interval as a unix timestamp
+
+        Returns
+        -------
+        bool
+            False if no data exists within the time interval
+        """
+        with self.metrics.record(end):
+            # --- read the new data within the time interval and update the data kept in memory --- #
+            touched = self.window.update(end)
+            data = self.window.data
+            if data.empty:
+                return False
+            server_time = self.window.watermark # the latest reading read so far, so the uploaded minutes never move backwards
+
+            # --- get only the data of the devices with new or expired readings, the signal strength is filtered by the database query --- #
+            with stage('select', len(data)) as record:
+                data = data[data['Target'].isin(touched)]
+                record['rows_out'] = len(data)
+
+            # --- gate specific stages, the gates are independent of each other --- #
+            run_concurrently(self.executor, [lambda gate=gate: gate.upload(*gate.process(data, touched, server_time, self.noise_target, self.mac_prefix)) for gate in self.gates])
+            self.window.commit() # the devices stay pending for the next cycle if a gate failed
+            return True
+
+    def run(self):
+        """Process all gates at every boundary of PROCESS_CYCLE, the time interval ends at the boundary"""
+        self.scheduler.run(self.process)
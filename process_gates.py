@@ -0,0 +1,19 @@
+"""process_gates.py
+
+This script processes the sensor readings of all gates configured in GATES of config.py. The readings
+of the past 30 minutes are read from the database and decoded once in each cycle and shared by all gates,
+instead of being read separately by process_south.py and process_north.py. The results are uploaded to
+the same collections as the ones of process_south.py and process_north.py, so it should run in place of them.
+
+This tool should run continuously and undergo the filtering and classification procedures every 60 seconds
+in order to get the real-time results.
+
+This script requires that `pandas`, `numpy` and `pymongo` be installed within the Python
+environment you are running this script in, and `torch` if CLASSIFIER_BACKEND is 'torch'.
+
+"""
+
+import config
+from pipeline import Pipeline
+
+Pipeline(list(config.GATES.keys())).run()
@@ -0,0 +1,194 @@
+"""raw_loader.py
+
+This file contains the columnar loader used by every reader of the raw_data collection. Instead of
+building a python dictionary for each sensor reading with `find`, the readings are streamed as raw
+BSON batches with `find_raw_batches` or `aggregate_raw_batches` and decoded straight into typed numpy
+columns: datetime64 Time, uint64 Target, int8 Receiver and int16 Strength. The MAC addresses of the
+target devices are converted by mac_codec.py, whether they are stored as base64 strings or as integers.
+
+As all readings are written by data_pool.py, the documents of a batch usually share the same layout,
+i.e. the same fields of the same types and sizes in the same order. Such a batch is viewed as a 2D
+array with one row for each document and each field is sliced out of its fixed byte offset. The
+batches with documents of different layouts, e.g. missing fields, are decoded document by document.
+
+This script requires that `numpy`, `pandas` and `pymongo` be installed within the Python
+environment you are running this script in.
+"""
+
+import numpy as np
+import pandas as pd
+import bson
+import config
+from mac_codec import b64_to_int, to_int
+
+COLUMNS = ['Time','Target','Receiver','Strength']
+DTYPES = {'Time':'datetime64[ns]', 'Target':np.uint64, 'Receiver':np.int8, 'Strength':np.int16}
+
+VALUE_SIZE = {0x01:8, 0x07:12, 0x08:1, 0x09:8, 0x0A:0, 0x10:4, 0x12:8} # the size of the BSON types with fixed-size values
+VALUE_DTYPE = {0x01:'<f8', 0x08:'u1', 0x09:'<i8', 0x10:'<i4', 0x12:'<i8'}
+STRING = 0x02
+DATETIME = 0x09
+
+
+def empty_readings():
+    """Return an empty dataframe of decoded readings with the columns Time, Target, Receiver and Strength"""
+    return pd.DataFrame({'Time':pd.Series(dtype='datetime64[ns]'), 'Target':pd.Series(dtype=DTYPES['Target']),
+                        'Receiver':pd.Series(dtype=object), 'Strength':pd.Series(dtype=DTYPES['Strength'])})[COLUMNS]
+
+
+def parse_layout(buf):
+    """Parse the layout of the first document of a raw BSON batch
+
+    Parameters
+    ----------
+    buf : ndarray
+        the raw BSON batch as an array of bytes
+
+    Returns
+    -------
+    tuple
+        the length of the document, a dictionary where the keys are the fields and the values are
+        the BSON type, offset and size of their values, and the offsets of the bytes describing the
+        layout, i.e. the document length, the types, the field names and the string lengths.
+        None if the document contains a type without a fixed-size value other than strings
+    """
+    length = int(buf[:4].view('<i4')[0])
+    fields = {}
+    structure = list(range(4))
+    offset = 4
+    while offset < length - 1:
+        kind = int(buf[offset])
+        name_end = offset + 1 + bytes(buf[offset+1:length]).index(b'\x00')
+        name = bytes(buf[offset+1:name_end]).decode()
+        structure.extend(range(offset, name_end+1))
+        offset = name_end + 1
+        if kind == STRING:
+            size = int(buf[offset:offset+4].view('<i4')[0])
+            structure.extend(range(offset, offset+4))
+            fields[name] = (kind, offset+4, size-1) # without the trailing null byte
+            offset += 4 + size
+        elif kind in VALUE_SIZE:
+            fields[name] = (kind, offset, VALUE_SIZE[kind])
+            offset += VALUE_SIZE[kind]
+        else:
+            return None
+    return length, fields, np.array(structure)
+
+
+def decode_batch(raw, fields):
+    """Decode a raw BSON batch into a numpy array for each field
+
+    Parameters
+    ----------
+    raw : bytes
+        the concatenated BSON documents
+
+    fields : list
+        the fields to be decoded, the documents without any of them are dropped
+
+    Returns
+    -------
+    dict
+        a dictionary where the keys are the fields and the values are their raw values,
+        int64 milliseconds for datetimes and fixed-width bytes for strings except Target,
+        which is converted to integer MAC addresses
+    """
+    buf = np.frombuffer(raw, dtype=np.uint8)
+    layout = parse_layout(buf) if len(buf) else None
+    if layout is not None and len(buf) % layout[0] == 0 and all(field in layout[1] for field in fields):
+        length, layout, structure = layout
+        docs = buf.reshape(-1, length)
+        if (docs[:, structure] == docs[0, structure]).all(): # all documents share the layout of the first one
+            columns = {}
+            for field in fields:
+                kind, offset, size = layout[field]
+                values = np.ascontiguousarray(docs[:, offset:offset+size])
+                columns[field] = values.view('S{}'.format(size) if kind == STRING else VALUE_DTYPE[kind]).ravel()
+            if 'Target' in columns:
+                columns['Target'] = b64_to_int(columns['Target']) if layout['Target'][0] == STRING else columns['Target'].astype(np.uint64)
+            return columns
+
+    # --- decode the documents one by one --- #
+    docs = [doc for doc in bson.decode_all(raw) if all(doc.get(field) is not None for field in fields)]
+    columns = {}
+    for field in fields:
+        values = [doc[field] for doc in docs]
+        if field == 'Time':
+            columns[field] = np.array(values, dtype='datetime64[ms]').astype(np.int64)
+        elif field == 'Target':
+            columns[field] = to_int(values)
+        else:
+            columns[field] = np.array(values)
+    return columns
+
+
+def decode_batches(batches, fields=COLUMNS):
+    """Decode the raw BSON batches into a typed numpy column for each field
+
+    Parameters
+    ----------
+    batches : iterable
+        the raw BSON batches returned by find_raw_batches or aggregate_raw_batches
+
+    fields : list
+        the fields to be decoded, the documents without any of them are dropped
+
+    Returns
+    -------
+    dict
+        a dictionary where the keys are the fields and the values are numpy arrays, Time is converted to
+        datetime64 and the other fields are cast to DTYPES
+    """
+    decoded = [decode_batch(raw, fields) for raw in batches]
+    columns = {}
+    for field in fields:
+        values = [batch[field] for batch in decoded]
+        if field == 'Time':
+            values = np.concatenate(values or [np.zeros(0, dtype=np.int64)]).astype('datetime64[ms]')
+        elif field == 'Target':
+            values = np.concatenate(values or [np.zeros(0, dtype=np.uint64)])
+        else:
+            values = np.concatenate(values or [np.zeros(0, dtype=np.int64)])
+        columns[field] = values.astype(DTYPES[field]) if field in DTYPES else values
+    return columns
+
+
+def find_columns(collection, query, fields=COLUMNS):
+    """Read the documents matching the query as a typed numpy column for each field"""
+    projection = dict({'_id':0}, **{field:1 for field in fields})
+    return decode_batches(collection.find_raw_batches(query, projection), fields)
+
+
+def aggregate_columns(collection, pipeline, fields=COLUMNS):
+    """Read the documents returned by the aggregation pipeline as a typed numpy column for each field"""
+    return decode_batches(collection.aggregate_raw_batches(pipeline, allowDiskUse=True), fields)
+
+
+def decode_readings(columns, deduplicate=True):
+    """Decode the raw columns of the sensor readings
+
+    Parameters
+    ----------
+    columns : dict
+        the raw columns Time, Target, Receiver and Strength returned by find_columns or aggregate_columns
+
+    deduplicate : bool
+        if True, only the strongest reading of each Time, Target and Receiver is kept
+
+    Returns
+    -------
+    DataFrame
+        the readings with the integer MAC addresses of the target devices, the MAC addresses of the sensors
+        and the signal strengths
+    """
+    if not len(columns['Time']):
+        return empty_readings()
+
+    data = pd.DataFrame({field:columns[field] for field in COLUMNS})
+    if deduplicate:
+        data = data.groupby(['Time','Target','Receiver']).max().reset_index()
+
+    # --- decode the MAC addresses of the sensors and the signal strengths --- #
+    data = data.assign(Receiver = data['Receiver'].map(config.SENSOR))
+    data = data.assign(Strength = (data['Strength']-100).astype(DTYPES['Strength']))
+    return data[COLUMNS]
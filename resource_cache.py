@@ -0,0 +1,124 @@
+"""resource_cache.py
+
+This file contains the cache of the MAC address lists in the /resources directory, i.e. filter_list.txt
+and mac_prefix.txt. Each file is parsed only when it is modified: the modification time and size of the
+file are checked in every cycle, the file is read and hashed only if either of them is changed, and it is
+parsed again only if its content is changed. The MAC addresses or OUIs are kept as a sorted array of
+integers, so the membership of a whole column of integer MAC addresses is tested with a binary search.
+
+gen_filter_list.py publishes filter_list.txt with publish, which writes a temporary file and renames it,
+so the readers never read a partially written file.
+
+This script requires that `numpy` be installed within the Python environment you are running
+this script in.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+from mac_codec import hex_to_int, int_to_hex
+
+
+class ResourceCache:
+    """
+    A class used to represent a list of MAC addresses or OUIs in a json file, loaded only when it is modified
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        the path of the json file
+    key : function
+        applied to the integer MAC addresses before they are tested, e.g. oui for a list of OUIs
+    values : ndarray
+        the sorted unique integers in the file
+    stat : tuple
+        the modification time and size of the file when it was read
+    digest : str
+        the hash of the content of the file when it was parsed
+
+    Methods
+    -------
+    load()
+        parses the file if it is modified since it was parsed
+    contains(values)
+        returns whether each integer MAC address is in the file
+    """
+    def __init__(self, path, key=None):
+        self.path = path
+        self.key = key
+        self.values = np.zeros(0, dtype=np.uint64)
+        self.stat = None
+        self.digest = None
+        self.load()
+
+    def load(self):
+        """Parse the file if it is modified since it was parsed
+
+        Returns
+        -------
+        bool
+            True if the file is parsed
+        """
+        stat = os.stat(self.path)
+        stat = (stat.st_mtime, stat.st_size)
+        if stat == self.stat:
+            return False
+        with open(self.path, 'rb') as fp:
+            content = fp.read()
+        self.stat = stat
+        digest = hashlib.sha1(content).hexdigest()
+        if digest == self.digest:
+            return False
+        self.values = np.unique(hex_to_int(json.loads(content.decode())))
+        self.digest = digest
+        return True
+
+    def contains(self, values):
+        """Test whether each integer MAC address is in the file, the file is parsed again if it is modified
+
+        Parameters
+        ----------
+        values : array_like
+            the integer MAC addresses, e.g. the Target column of the readings
+
+        Returns
+        -------
+        ndarray
+            True for each MAC address in the file
+        """
+        try:
+            self.load()
+        except Exception as e: # keep the loaded values if the file cannot be read
+            print(e)
+        values = np.asarray(values, dtype=np.uint64)
+        if self.key is not None:
+            values = self.key(values)
+        if not len(self.values):
+            return np.zeros(len(values), dtype=bool)
+        index = np.minimum(np.searchsorted(self.values, values), len(self.values)-1)
+        return self.values[index] == values
+
+
+def publish(path, values, width=12):
+    """Write the integer MAC addresses to a json file of hexadecimal strings, replacing the file atomically
+
+    Parameters
+    ----------
+    path : str
+        the path of the json file
+
+    values : array_like
+        the integer MAC addresses
+
+    width : int
+        the number of hexadecimal digits, 12 for MAC addresses and 6 for OUIs
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        json.dump(int_to_hex(values, width).tolist(), fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,227 @@
+"""ring_buffer.py
+
+This file contains the memory-mapped ring buffer shared by data_pool.py and the processing scripts on the
+same server. data_pool.py appends the readings of the closed seconds to the ring every PUBLISH_INTERVAL
+seconds, and the processing scripts map the same file read-only and read the readings of the past
+READ_INTERVAL from it instead of from the database, so no database query is on the path from receiving
+a reading to processing it. MongoDB remains the durable store, and the readings are read from the
+database whenever the ring does not hold all readings of the requested interval, e.g. in the first
+cycles after data_pool.py is restarted, or when its newest reading is more than max_lag seconds older
+than the end of the interval, e.g. when data_pool.py stopped writing to it.
+
+The file is a header followed by RING_RECORDS records of 16 bytes: the second of the reading (as the
+stored Time), the integer MAC address of the target device, the AP-ID of the sensor and the RSSI. The
+header holds the total number of records written (the head), from which the slot of each record is
+its number modulo the capacity, and the range of seconds the ring holds completely. A single writer
+reserves the slots it is going to overwrite, writes the records and then moves the head, and a reader
+checks the reservation after copying the records it selected, discarding the ones overwritten in the
+meantime. The records are selected on
+the mapped memory without copying the ring.
+
+This script requires that `numpy` be installed within the Python environment you are running this
+script in.
+"""
+
+import os
+import mmap
+import numpy as np
+from raw_loader import DTYPES
+
+MAGIC               = b'RDRB'
+HEADER              = np.dtype([('magic','S4'),('record_size','<u4'),('capacity','<u8'),('head','<u8'),('reserved','<u8'),('start','<i8'),('newest','<i8')])
+HEADER_SIZE         = 64 # the records start at a cache line
+RECORD              = np.dtype([('Time','<u4'),('Receiver','u1'),('Strength','i1'),('padding','<u2'),('Target','<u8')])
+STRENGTH_OFFSET     = 100 # the stored signal strengths are rssi + STRENGTH_OFFSET
+NEVER               = np.iinfo(np.int64).max
+
+
+def to_seconds(times):
+    """Convert datetime64 values or a datetime to the seconds stored in the ring"""
+    return np.asarray(times, dtype='datetime64[ns]').astype('datetime64[s]').astype(np.int64)
+
+
+class RingWriter:
+    """
+    A class used to represent the ring buffer written by data_pool.py
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        the path of the file of the ring, e.g. in /dev/shm
+    capacity : int
+        the number of records held by the ring
+    header : ndarray
+        the header mapped from the file
+    records : ndarray
+        the records mapped from the file
+
+    Methods
+    -------
+    append(readings)
+        appends the readings to the ring
+    close()
+        unmaps the file
+    """
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+
+        # --- create a new file and rename it, the readers map the new file at their next read --- #
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.truncate(HEADER_SIZE + capacity*RECORD.itemsize)
+        self.fp = open(tmp_path, 'r+b')
+        self.mmap = mmap.mmap(self.fp.fileno(), 0)
+        self.header = np.ndarray(1, dtype=HEADER, buffer=self.mmap)
+        self.records = np.ndarray(capacity, dtype=RECORD, buffer=self.mmap, offset=HEADER_SIZE)
+        self.header[0] = (MAGIC, RECORD.itemsize, capacity, 0, 0, NEVER, -1) # nothing is held until the first append
+        os.replace(tmp_path, path)
+
+    def append(self, readings):
+        """Append the readings to the ring
+
+        Parameters
+        ----------
+        readings : dict
+            the columns Time, Target, Receiver and Strength of the readings of the closed seconds as stored in raw_data,
+            the seconds must be later than the seconds already appended
+        """
+        if not len(readings['Time']):
+            return
+        seconds = to_seconds(readings['Time'])
+        if len(seconds) > self.capacity: # only the newest readings fit in the ring
+            readings, seconds = {field:np.asarray(values)[-self.capacity:] for field, values in readings.items()}, seconds[-self.capacity:]
+        head = int(self.header['head'][0])
+        n = len(seconds)
+        if int(self.header['start'][0]) == NEVER:
+            self.header['start'] = seconds.min()
+
+        # --- the seconds of the overwritten records are no longer held completely --- #
+        if head + n > self.capacity:
+            slots = np.arange(max(head - self.capacity, 0), head + n - self.capacity) % self.capacity
+            self.header['start'] = max(int(self.header['start'][0]), int(self.records['Time'][slots].max()) + 1)
+
+        # --- reserve the slots, write the records and then move the head --- #
+        self.header['reserved'] = head + n
+        slots = np.arange(head, head + n) % self.capacity
+        records = np.zeros(n, dtype=RECORD)
+        records['Time'] = seconds
+        records['Target'] = np.asarray(readings['Target'])
+        records['Receiver'] = np.asarray(readings['Receiver'])
+        records['Strength'] = np.asarray(readings['Strength']) - STRENGTH_OFFSET
+        self.records[slots] = records
+        self.header['newest'] = max(int(self.header['newest'][0]), int(seconds.max()))
+        self.header['head'] = head + n
+
+    def close(self):
+        """Unmap the file, which is kept for the readers"""
+        del self.header, self.records
+        self.mmap.close()
+        self.fp.close()
+
+
+class RingReader:
+    """
+    A class used to represent the ring buffer mapped read-only by the processing scripts
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        the path of the file of the ring
+    inode : int
+        the inode of the mapped file, the file is mapped again when data_pool.py creates a new one
+    max_lag : int
+        the ring is behind if its newest reading is more than max_lag seconds older than the end of the requested interval
+
+    Methods
+    -------
+    columns(start, end, receivers=None, strength_below=None)
+        returns the readings within the time interval if the ring holds all of them
+    """
+    def __init__(self, path, max_lag=60):
+        self.path = path
+        self.max_lag = max_lag
+        self.inode = None
+        self.mmap = None
+
+    def open(self):
+        """Map the file if it is new, return False if it does not exist"""
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return False
+        if inode != self.inode:
+            if self.mmap is not None:
+                del self.header, self.records
+                self.mmap.close()
+            with open(self.path, 'rb') as fp:
+                self.mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self.header = np.ndarray(1, dtype=HEADER, buffer=self.mmap)
+            if self.header['magic'][0] != MAGIC or self.header['record_size'][0] != RECORD.itemsize:
+                raise ValueError('{} is not a ring buffer of readings'.format(self.path))
+            self.capacity = int(self.header['capacity'][0])
+            self.records = np.ndarray(self.capacity, dtype=RECORD, buffer=self.mmap, offset=HEADER_SIZE)
+            self.inode = inode
+        return True
+
+    def columns(self, start, end, receivers=None, strength_below=None):
+        """Read the readings within the time interval if the ring holds all of them
+
+        Parameters
+        ----------
+        start : datetime
+            the starting time
+
+        end : datetime
+            the ending time
+
+        receivers : list
+            the AP-IDs of the sensors to be read, None to read all sensors
+
+        strength_below : int
+            if given, only the readings with a stored signal strength below it are kept
+
+        Returns
+        -------
+        dict
+            the raw columns Time, Target, Receiver and Strength as returned by raw_loader.find_columns,
+            None if the ring does not hold all readings since start or is behind end
+        """
+        if not self.open():
+            return None
+        start, end = int(to_seconds(start)), int(to_seconds(end))
+        head = int(self.header['head'][0])
+        if start < int(self.header['start'][0]) or int(self.header['newest'][0]) < end - self.max_lag:
+            return None
+
+        # --- select the records on the mapped memory, in at most two slices split at the end of the ring --- #
+        numbers, selected = [], []
+        first = max(head - self.capacity, 0)
+        while first < head:
+            slot = first % self.capacity
+            last = min(head, first + self.capacity - slot)
+            view = self.records[slot:slot + last - first]
+            keep = (view['Time'] >= start) & (view['Time'] <= end)
+            if receivers is not None:
+                keep &= np.isin(view['Receiver'], receivers)
+            if strength_below is not None:
+                keep &= view['Strength'].astype(np.int16) + STRENGTH_OFFSET < strength_below
+            index = np.flatnonzero(keep)
+            numbers.append(first + index)
+            selected.append(view[index])
+            first = last
+        numbers = np.concatenate(numbers or [np.zeros(0, dtype=np.int64)])
+        records = np.concatenate(selected or [np.zeros(0, dtype=RECORD)])
+
+        # --- drop the records overwritten while they were copied --- #
+        if start < int(self.header['start'][0]):
+            return None
+        records = records[numbers >= int(self.header['reserved'][0]) - self.capacity]
+        return {'Time':records['Time'].astype('datetime64[s]').astype(DTYPES['Time']),
+                'Target':records['Target'].astype(DTYPES['Target']),
+                'Receiver':records['Receiver'].astype(DTYPES['Receiver']),
+                'Strength':records['Strength'].astype(DTYPES['Strength']) + STRENGTH_OFFSET}
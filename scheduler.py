@@ -0,0 +1,153 @@
+"""scheduler.py
+
+This file contains the scheduler of the cycles of the processing scripts and gen_filter_list.py. Instead
+of sleeping for the rest of the cycle after each run, the runs are scheduled at the boundaries of the
+wall clock, e.g. at every minute for a cycle of 60 seconds, so the cycles do not drift, and each run
+gets the time of its boundary as the end of the time interval it processes.
+
+A run longer than the cycle is an overrun, which is counted and printed. The boundaries missed by an
+overrun are either skipped, the next run being at the next boundary, or caught up with, the missed
+boundaries being run one after another without waiting, at most MAX_CATCHUP of them. A run failing with
+a transient MongoDB error is retried after a short backoff, doubling from CYCLE_BACKOFF seconds, as long
+as the retry starts before the next boundary. Other errors are printed with their traceback, and the next
+run is at the next boundary instead of a full cycle later.
+
+run_concurrently runs independent stages, e.g. the gates of pipeline.py, in a pool of threads.
+
+This script requires that `pymongo` be installed within the Python environment you are running this
+script in.
+"""
+
+import time
+import traceback
+from datetime import datetime
+from pymongo.errors import ConnectionFailure, ExecutionTimeout
+
+TRANSIENT_ERRORS    = (ConnectionFailure, ExecutionTimeout) # including AutoReconnect, NetworkTimeout and ServerSelectionTimeoutError
+POLICIES            = ['skip','catchup']
+
+
+def run_concurrently(executor, functions):
+    """Run the functions in the executor and return their results in order
+
+    Parameters
+    ----------
+    executor : ThreadPoolExecutor
+        the pool of threads, None runs the functions one after another
+
+    functions : list
+        the functions without arguments
+
+    Returns
+    -------
+    list
+        the result of each function, the first exception raised by a function is raised again
+    """
+    if executor is None:
+        return [function() for function in functions]
+    futures = [executor.submit(function) for function in functions]
+    return [future.result() for future in futures]
+
+
+class CycleScheduler:
+    """
+    A class used to represent the schedule of the runs of a cycle aligned to the wall clock
+
+    ...
+
+    Attributes
+    ----------
+    name : str
+        the name of the script printed with the messages
+    cycle : int
+        the length of the cycle in seconds
+    policy : str
+        'skip' to skip the boundaries missed by an overrun, 'catchup' to run them without waiting
+    max_catchup : int
+        the maximum number of missed boundaries caught up with, the older ones are skipped
+    retries : int
+        the maximum number of retries after a transient MongoDB error
+    backoff : float
+        the time waited before the first retry in seconds, doubled for each retry
+    stats : dict
+        the numbers of runs, overruns, skipped boundaries, retries and failed runs, and the duration of the last run
+
+    Methods
+    -------
+    run(task)
+        runs the task at every boundary of the cycle, forever
+    run_once(task, end)
+        runs the task once, retrying it after a transient MongoDB error
+    """
+    def __init__(self, name, cycle, policy='skip', max_catchup=5, retries=3, backoff=1):
+        if policy not in POLICIES:
+            raise ValueError('Unknown cycle policy: {}'.format(policy))
+        self.name = name
+        self.cycle = cycle
+        self.policy = policy
+        self.max_catchup = max_catchup
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = {'runs':0, 'overruns':0, 'skipped':0, 'retries':0, 'failed':0, 'last_duration':0.0}
+
+    def run_once(self, task, end):
+        """Run the task once, retrying it after a transient MongoDB error before the next boundary
+
+        Parameters
+        ----------
+        task : function
+            the task of a cycle, called with the end of the time interval as a unix timestamp
+
+        end : float
+            the boundary of the run
+
+        Returns
+        -------
+        object
+            the value returned by the task, None if it failed
+        """
+        self.stats['runs'] += 1
+        for attempt in range(self.retries + 1):
+            try:
+                return task(end)
+            except TRANSIENT_ERRORS as e:
+                delay = self.backoff * 2**attempt
+                if attempt == self.retries or time.time() + delay >= end + self.cycle:
+                    self.stats['failed'] += 1
+                    print('{}: {} cycle at {} failed after {} retries: {!r}'.format(datetime.now(), self.name, datetime.fromtimestamp(end), attempt, e))
+                    return None
+                self.stats['retries'] += 1
+                print('{}: {} cycle at {} is retried in {} s: {!r}'.format(datetime.now(), self.name, datetime.fromtimestamp(end), delay, e))
+                time.sleep(delay)
+            except Exception:
+                self.stats['failed'] += 1
+                print('{}: {} cycle at {} failed\n{}'.format(datetime.now(), self.name, datetime.fromtimestamp(end), traceback.format_exc()), end='')
+                return None
+
+    def run(self, task):
+        """Run the task at every boundary of the cycle, forever
+
+        Parameters
+        ----------
+        task : function
+            the task of a cycle, called with the boundary as the end of the time interval as a unix timestamp
+        """
+        end = (time.time() // self.cycle + 1) * self.cycle
+        while True:
+            time.sleep(max(end - time.time(), 0))
+            started = time.time()
+            self.run_once(task, end)
+            finished = time.time()
+            self.stats['last_duration'] = finished - started
+
+            # --- the boundaries passed during the run are missed --- #
+            end += self.cycle
+            missed = int((finished - end) // self.cycle) + 1 if finished >= end else 0
+            if finished - started > self.cycle:
+                self.stats['overruns'] += 1
+            if missed and finished // self.cycle > started // self.cycle: # the runs catching up are late from their start
+                skipped = missed if self.policy == 'skip' else max(missed - self.max_catchup, 0)
+                end += skipped * self.cycle
+                self.stats['skipped'] += skipped
+                print('{}: {} cycle took {:.1f} s, {} boundaries missed and {} skipped ({})'.format(datetime.now(), self.name, finished - started, missed, skipped,
+                      ' '.join('{} {}'.format(key, self.stats[key]) for key in ['runs','overruns','skipped','retries','failed'])))
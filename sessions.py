@@ -0,0 +1,183 @@
+"""sessions.py
+
+This file contains the functions used by process_south.py and process_north.py to split the
+readings of the target devices into continuous sessions, and to count the people and derive the
+queue times from the sessions. All devices are handled in one pass with grouped differences instead
+of looping over the devices one by one, and each session is kept as a single interval instead of
+being upsampled to one row per second.
+
+A session starts at the first reading of a device and ends at its last reading plus a departure
+buffer of DEPARTURE_FACTOR times the mean interval between the readings of the device. The readings
+are split into separate sessions if two readings are more than INTERVAL_THRESHOLD seconds apart.
+Devices whose readings last shorter than MIN_DURATION seconds are dropped.
+
+This script requires that `pandas` and `numpy` be installed within the Python
+environment you are running this script in.
+"""
+
+import numpy as np
+import pandas as pd
+import config
+
+INTERVAL_THRESHOLD  = 1800 # if the time interval of two signals from the same device is more than half an hour, then they are not continuous
+MIN_DURATION        = 60 # filter signals that last for too short
+DEPARTURE_FACTOR    = 3 # the departure buffer is 3 times the mean time interval of the signals
+QTD_GROUP           = config.QTD_GROUP
+QTD_BOUNDS          = config.QTD_BOUNDS
+
+SECOND = 10**9 # one second in nanoseconds
+
+
+def sessionize(data):
+    """Split the readings of each device into continuous sessions
+
+    Parameters
+    ----------
+    data : DataFrame
+        the readings with the columns Time and Target, one row for each Time and Target
+
+    Returns
+    -------
+    DataFrame
+        one row for each session with the columns Target, Start and End
+    """
+    if data.empty:
+        return pd.DataFrame({'Target':pd.Series(dtype=data['Target'].dtype), 'Start':pd.Series(dtype='datetime64[ns]'), 'End':pd.Series(dtype='datetime64[ns]')})
+
+    data = data[['Target','Time']].sort_values(['Target','Time'], kind='mergesort')
+    target = data['Target'].values
+    time = data['Time'].values.astype('datetime64[ns]').astype(np.int64)
+
+    # --- statistics of each device --- #
+    first = np.r_[True, target[1:] != target[:-1]]
+    device_start = np.flatnonzero(first)
+    device_end = np.r_[device_start[1:], len(time)] - 1
+    count = device_end - device_start + 1
+    duration = time[device_end] - time[device_start]
+    departure_buffer = DEPARTURE_FACTOR * (duration // np.maximum(count-1, 1))
+    valid = duration >= MIN_DURATION*SECOND
+
+    # --- split the readings at long time intervals --- #
+    time_diff = np.r_[0, np.diff(time)]
+    split = first | (time_diff > INTERVAL_THRESHOLD*SECOND)
+    session_start = np.flatnonzero(split)
+    session_end = np.r_[session_start[1:], len(time)] - 1
+
+    valid = np.repeat(valid, count)[session_start]
+    departure_buffer = np.repeat(departure_buffer, count)[session_end]
+    return pd.DataFrame({'Target':target[session_start][valid],
+                        'Start':pd.to_datetime(time[session_start][valid]),
+                        'End':pd.to_datetime(time[session_end][valid] + departure_buffer[valid])})
+
+
+def occupancy(sessions, server_time, zones=None, freq=5):
+    """Count the sessions covering each second and sample the counts every freq seconds
+
+    The counts are derived from the cumulative sum over the starts and ends of the sessions,
+    so the memory used depends on the length of the time interval instead of the total length
+    of the sessions. Each sample takes the counts of the first second within the freq seconds
+    that is covered by any session, samples without such a second are 0.
+
+    Parameters
+    ----------
+    sessions : DataFrame
+        the sessions with the columns Target, Start and End, and the column Zone if zones is given
+
+    server_time : datetime
+        the time of the latest reading, the sessions are cut at this time
+
+    zones : dict
+        a dictionary where the keys are the zones and the values are the column names of the counts,
+        if None, all sessions are counted in the column Target
+
+    freq : int
+        the sampling interval in seconds
+
+    Returns
+    -------
+    DataFrame
+        the counts with the column Time and a column for each zone
+    """
+    columns = ['Target'] if zones is None else list(zones.values())
+    server = np.datetime64(server_time, 's').astype(np.int64)
+    start = sessions['Start'].values.astype('datetime64[s]').astype(np.int64)
+    end = np.minimum(sessions['End'].values.astype('datetime64[s]').astype(np.int64), server)
+    if zones is None:
+        zone = np.zeros(len(sessions), dtype=np.int64)
+    else:
+        zone = pd.Index(list(zones.keys())).get_indexer(sessions['Zone'])
+
+    first = start.min() // freq * freq
+    change = np.zeros((server - first + 2, len(columns)), dtype=np.int64)
+    np.add.at(change, (start - first, zone), 1)
+    np.add.at(change, (end - first + 1, zone), -1)
+    count = np.cumsum(change, axis=0)[:-1]
+
+    covered = count.sum(axis=1) > 0
+    covered[-1] = True # the time of the latest reading is always sampled
+    second = np.flatnonzero(covered)
+    sample = second // freq
+    second = second[np.r_[True, sample[1:] != sample[:-1]]]
+
+    result = np.zeros((server // freq - first // freq + 1, len(columns)), dtype=np.int64)
+    result[second // freq] = count[second]
+    result = pd.DataFrame(result, columns=columns)
+    result.insert(0, 'Time', pd.to_datetime((first + freq*np.arange(len(result))).astype('datetime64[s]')))
+    return result
+
+
+def queue_time_distribution(sessions, server_time, current_since, zones=None):
+    """Count the queue times of the current and boarded devices of each zone in QTD_GROUP
+
+    The first appearance, the last appearance and the zone of each device are reduced from its sessions
+    in one sorted pass, the queue times are binned to QTD_GROUP with one searchsorted on QTD_BOUNDS, and
+    the devices of all statuses and zones are counted with one bincount.
+
+    Parameters
+    ----------
+    sessions : DataFrame
+        the sessions with the columns Target, Start and End, and the column Zone if zones is given
+
+    server_time : datetime
+        the time of the latest reading, the sessions are cut at this time
+
+    current_since : datetime
+        the devices last appearing since this time are still queuing, the other devices have boarded
+
+    zones : list
+        the zones to be counted, the zone of a device is taken from its first session,
+        if None, all devices are counted in the zone None
+
+    Returns
+    -------
+    dict
+        a dictionary where the keys are 'current' and 'boarded' and the values are dictionaries of the record of each zone,
+        with the Time (server_time floored to the minute) and the number of devices in each group of QTD_GROUP
+    """
+    keys = [None] if zones is None else list(zones)
+    server = np.datetime64(server_time, 's').astype(np.int64)
+    target = sessions['Target'].values
+    order = np.argsort(target, kind='mergesort')
+    target = target[order]
+    start = sessions['Start'].values.astype('datetime64[s]').astype(np.int64)[order]
+    end = np.minimum(sessions['End'].values.astype('datetime64[s]').astype(np.int64)[order], server)
+
+    # --- reduce the sessions of each device --- #
+    device_start = np.flatnonzero(np.r_[True, target[1:] != target[:-1]]) if len(target) else np.zeros(0, dtype=np.int64)
+    first = np.minimum.reduceat(start, device_start) if len(target) else start
+    last = np.maximum.reduceat(end, device_start) if len(target) else end
+    if zones is None:
+        zone = np.zeros(len(device_start), dtype=np.int64)
+    else:
+        zone = pd.Index(keys).get_indexer(sessions['Zone'].values[order][device_start])
+
+    # --- bin the queue times and count the devices of each status and zone --- #
+    group = np.searchsorted(np.asarray(QTD_BOUNDS)*60, last - first, side='right')
+    boarded = (last < np.datetime64(current_since, 's').astype(np.int64)).astype(np.int64)
+    counted = zone >= 0
+    cell = (boarded[counted]*len(keys) + zone[counted])*len(QTD_GROUP) + group[counted]
+    counts = np.bincount(cell, minlength=2*len(keys)*len(QTD_GROUP)).reshape(2, len(keys), len(QTD_GROUP)).tolist()
+
+    minute = pd.Timestamp(server_time).floor('min').to_pydatetime()
+    return {status:{key:dict([('Time',minute)] + list(zip(QTD_GROUP, counts[index][i]))) for i, key in enumerate(keys)}
+            for index, status in enumerate(['current','boarded'])}
@@ -0,0 +1,323 @@
+"""simulate.py
+
+This script simulates the 11 sensors in SENSOR of config.py to load-test data_pool.py and the processing
+scripts without the deployed sensors. It should run against a test server, as the simulated readings are
+stored like real ones.
+
+Devices arrive at the queues of the south and north gates as a Poisson process, queue for a time drawn
+from the distribution over QTD_GROUP in QUEUE_TIME_WEIGHTS and leave. Besides them, passers-by are heard
+for less than a minute, and static devices, e.g. of the shops, are heard during the whole run. Each device
+sends a probe every PROBE_INTERVAL seconds on average, which is heard by the sensors of its gate with a
+signal strength given by a log-distance path loss model with shadowing, if it is stronger than SENSITIVITY.
+The rate of the arrivals and of the static devices is multiplied by --rate, from 1 for the traffic of the
+default model up to 100.
+
+With --mode udp, the readings are sent to data_pool.py as datagrams in the format of the sensors. A marker
+device heard by the first sensor every second is looked up in the database to measure the latency from
+sending a reading to its storage, and the readings stored during the run are compared with the readings
+sent to find the readings lost. With --mode mongo, the readings are aggregated and stored directly to the
+collection of RAW_SCHEMA every STORE_INTERVAL seconds, as data_pool.py would, e.g. to load the processing
+scripts, and the time used by each store is reported.
+
+The number of datagrams sent per second is reported every REPORT_INTERVAL seconds together with the
+seconds in which the simulator could not send all of its datagrams in time.
+
+Usage:
+    python simulate.py --rate 10 --duration 600
+    python simulate.py --mode mongo --rate 1 --duration 3600
+
+This script requires that `numpy`, `pandas` and `pymongo` be installed within the Python environment you
+are running this script in.
+"""
+
+import json
+import time
+import socket
+import argparse
+import threading
+from datetime import datetime
+import numpy as np
+import pymongo
+import config
+from mac_codec import hex_to_int
+from aggregate import SecondMax, Emitter, TIME_OFFSET, STRENGTH_OFFSET
+from buckets import create_collection, documents, find_bucket_columns
+from raw_loader import find_columns
+
+QTD_GROUP           = config.QTD_GROUP
+RAW_SCHEMA          = config.RAW_SCHEMA
+BUCKET_SECONDS      = config.BUCKET_SECONDS
+TARGET_FORMAT       = config.TARGET_FORMAT
+DB_KEY              = config.DB_KEY
+RESOURCES_DIR       = config.RESOURCES_DIR
+
+# --- the model of the traffic at 1x --- #
+SENSOR_SPACING      = 5 # the sensors of a gate are placed along its queue every SENSOR_SPACING metres
+GATE_SENSORS        = {'south':[SENSOR_ID for SENSOR_ID in range(5,12)], 'north':[SENSOR_ID for SENSOR_ID in range(1,5)]}
+ARRIVALS            = {'south':6, 'north':3} # the number of devices joining each queue per minute
+QUEUE_TIME_WEIGHTS  = [0.35, 0.3, 0.17, 0.1, 0.08] # the share of the devices in each group of QTD_GROUP
+QUEUE_TIME_RANGES   = [(0, 5), (5, 10), (10, 15), (15, 20), (20, 30)] # the queue times of each group in minutes
+PASSERS_BY          = {'south':20, 'north':10} # the number of devices passing by each gate per minute
+PASSING_TIME        = (5, 40) # the time a passer-by is heard in seconds
+STATIC_DEVICES      = {'south':20, 'north':10} # the number of devices heard during the whole run
+RANDOMIZED_SHARE    = 0.3 # the share of the devices with a randomized (locally administered) MAC address
+PROBE_INTERVAL      = 5 # the mean interval between the probes of a device in seconds
+TX_POWER            = -40 # the signal strength at 1 metre in dBm
+PATH_LOSS_EXPONENT  = 2.7
+SHADOWING           = 4 # the standard deviation of the signal strength in dB
+SENSITIVITY         = -95 # the weakest signal heard by a sensor in dBm
+
+PORT                = 3650
+REPORT_INTERVAL     = 10 # seconds
+STORE_INTERVAL      = 30 # the interval between the stores of the mongo mode in seconds, as data_pool.py
+MARKER              = 0x02AB5EED0001 # the MAC address of the marker device, heard by MARKER_RECEIVER every second
+MARKER_RECEIVER     = 1
+DRAIN_TIME          = STORE_INTERVAL + config.AGGREGATE_LATENESS + 15 # the time the marker is sent after the run for the last readings to be stored in seconds
+
+
+class Population:
+    """
+    A class used to represent the simulated devices around the gates
+
+    ...
+
+    Attributes
+    ----------
+    rate : float
+        the multiple of the arrivals and static devices of the model
+    rng : RandomState
+        the random generator
+    devices : dict
+        a dictionary where the keys are mac, gate, x, y, leave and probe, and the values are arrays over the devices
+        present, the probe being the time of the next probe
+
+    Methods
+    -------
+    step(now)
+        moves the population to the second and returns the readings heard by the sensors in it
+    """
+    def __init__(self, rate, seed=0):
+        self.rate = rate
+        self.rng = np.random.RandomState(seed)
+        self.ouis = hex_to_int(json.load(open(RESOURCES_DIR + '/mac_prefix.txt')))
+        self.gates = sorted(GATE_SENSORS)
+        self.sensors = {gate:np.array(GATE_SENSORS[gate]) for gate in self.gates}
+        self.positions = {gate:np.arange(len(GATE_SENSORS[gate]))*SENSOR_SPACING for gate in self.gates}
+        self.devices = {field:np.zeros(0, dtype=dtype) for field, dtype in [('mac',np.uint64),('gate',np.int64),('x',float),('y',float),('leave',float),('probe',float)]}
+        self.started = None
+
+    def macs(self, n):
+        """Draw n MAC addresses with the OUIs of mac_prefix.txt or randomized"""
+        macs = self.ouis[self.rng.randint(len(self.ouis), size=n)] << np.uint64(24) | self.rng.randint(0, 1 << 24, n).astype(np.uint64)
+        randomized = self.rng.rand(n) < RANDOMIZED_SHARE
+        macs[randomized] = self.rng.randint(0, 1 << 47, randomized.sum()).astype(np.uint64) | np.uint64(0x020000000000)
+        return macs
+
+    def add(self, now, gate, n, stay):
+        """Add n devices to the gate staying for the given times in seconds"""
+        if not n:
+            return
+        span = self.positions[self.gates[gate]][-1]
+        devices = {'mac':self.macs(n), 'gate':np.full(n, gate), 'x':self.rng.uniform(-SENSOR_SPACING, span + SENSOR_SPACING, n),
+                   'y':self.rng.normal(0, 2, n), 'leave':now + np.broadcast_to(stay, n), 'probe':now + self.rng.exponential(PROBE_INTERVAL, n)}
+        self.devices = {field:np.concatenate([self.devices[field], devices[field]]) for field in self.devices}
+
+    def queue_times(self, n):
+        """Draw n queue times in seconds from QUEUE_TIME_WEIGHTS"""
+        groups = self.rng.choice(len(QTD_GROUP), size=n, p=QUEUE_TIME_WEIGHTS)
+        low, high = np.array(QUEUE_TIME_RANGES).T
+        return self.rng.uniform(low[groups], high[groups])*60
+
+    def step(self, now):
+        """Move the population to the second and return the readings heard in it
+
+        Parameters
+        ----------
+        now : float
+            the unix timestamp of the second
+
+        Returns
+        -------
+        ndarray
+            the time in milliseconds, the MAC address of the device, the AP-ID of the sensor and the signal strength of each reading
+        """
+        if self.started is None: # the static devices and the devices already queuing when the simulation starts
+            self.started = now
+            for gate, name in enumerate(self.gates):
+                self.add(now, gate, self.rng.poisson(STATIC_DEVICES[name]*self.rate), np.inf)
+                queuing = self.rng.poisson(ARRIVALS[name]*self.rate*np.dot(QUEUE_TIME_WEIGHTS, np.mean(QUEUE_TIME_RANGES, axis=1)))
+                self.add(now, gate, queuing, self.queue_times(queuing)*self.rng.rand(queuing))
+
+        for gate, name in enumerate(self.gates):
+            arrivals = self.rng.poisson(ARRIVALS[name]*self.rate/60)
+            self.add(now, gate, arrivals, self.queue_times(arrivals))
+            passers = self.rng.poisson(PASSERS_BY[name]*self.rate/60)
+            self.add(now, gate, passers, self.rng.uniform(PASSING_TIME[0], PASSING_TIME[1], passers))
+        present = self.devices['leave'] > now
+        self.devices = {field:values[present] for field, values in self.devices.items()}
+
+        # --- the probes sent in the second are heard by the sensors of the gate in range --- #
+        probing = np.flatnonzero(self.devices['probe'] < now + 1)
+        self.devices['probe'][probing] += self.rng.exponential(PROBE_INTERVAL, len(probing))
+        readings = []
+        for gate, name in enumerate(self.gates):
+            devices = probing[self.devices['gate'][probing] == gate]
+            distance = np.hypot(self.devices['x'][devices][:, None] - self.positions[name][None, :], self.devices['y'][devices][:, None])
+            rssi = TX_POWER - 10*PATH_LOSS_EXPONENT*np.log10(np.maximum(distance, 1)) + self.rng.normal(0, SHADOWING, distance.shape)
+            device, sensor = np.nonzero(rssi >= SENSITIVITY)
+            readings.append(np.stack([int(now*1000) + self.rng.randint(0, 1000, len(device)), self.devices['mac'][devices][device].astype(np.int64),
+                                      self.sensors[name][sensor], np.round(rssi[device, sensor])], axis=1).astype(np.int64))
+        readings.append(marker(now))
+        return np.concatenate(readings)
+
+
+def marker(now):
+    """Return the reading of the marker device in the second"""
+    return np.array([[int(now*1000), MARKER, MARKER_RECEIVER, TX_POWER]], dtype=np.int64)
+
+
+def datagrams(readings):
+    """Encode the readings as the datagrams of the sensors"""
+    return [('{{"srvTime":{},"txAddr":"{:012X}","rxAddr":"{}","rssi":{}}}'.format(t, mac, config.SENSOR[rx], rssi)).encode()
+            for t, mac, rx, rssi in readings.tolist()]
+
+
+def unique_keys(readings):
+    """Return the number of readings of different seconds, devices and sensors, i.e. the readings to be stored"""
+    keys = (readings[:, 1].astype(np.uint64) << np.uint64(4)) | readings[:, 2].astype(np.uint64)
+    return len(np.unique(np.stack([readings[:, 0] // 1000, keys.view(np.int64)], axis=1), axis=0))
+
+
+def stored_columns(collection, start, end, receivers=None):
+    """Read the stored readings within the time interval in any schema"""
+    if RAW_SCHEMA == 'bucket':
+        return find_bucket_columns(collection, start, end, receivers, BUCKET_SECONDS)
+    query = {'Time':{'$gte':start,'$lte':end}}
+    if receivers is not None:
+        query['Receiver'] = {'$in':receivers}
+    return find_columns(collection, query)
+
+
+def stored_time(seconds):
+    """Convert unix seconds to the Time stored by data_pool.py"""
+    return datetime.utcfromtimestamp(seconds + TIME_OFFSET)
+
+
+class LatencyProbe:
+    """
+    A class used to represent the thread polling the database for the readings of the marker device
+
+    ...
+
+    Attributes
+    ----------
+    collection : Collection
+        the collection of RAW_SCHEMA
+    sent : dict
+        a dictionary where the keys are the seconds of the marker readings and the values are the times they are sent
+    latencies : list
+        the time from sending to finding each marker reading in seconds
+    """
+    def __init__(self, collection, start):
+        self.collection = collection
+        self.start = start
+        self.sent = {}
+        self.latencies = []
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Poll the database every second and match the new marker readings with their sending times"""
+        while not self.stopping.wait(1):
+            try:
+                columns = stored_columns(self.collection, stored_time(self.start), stored_time(time.time() + 1), [MARKER_RECEIVER])
+            except Exception as e:
+                print('{}: failed to poll the database: {}'.format(datetime.now(), e))
+                continue
+            found = time.time()
+            seconds = (columns['Time'][columns['Target'] == MARKER].astype('datetime64[s]').astype(np.int64) - TIME_OFFSET).tolist()
+            for second in seconds:
+                if second in self.sent:
+                    self.latencies.append(found - self.sent.pop(second))
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+
+def report_latency(latencies):
+    """Print the percentiles of the latencies"""
+    if latencies:
+        print('latency from sending to storage: p50 {:.1f} s  p90 {:.1f} s  p99 {:.1f} s  max {:.1f} s  ({} marker readings)'.format(
+            *np.percentile(latencies, [50, 90, 99]), max(latencies), len(latencies)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate the sensors to load-test data_pool.py and the processing scripts')
+    parser.add_argument('--mode', choices=['udp','mongo'], default='udp', help='send datagrams to data_pool.py or store to MongoDB directly')
+    parser.add_argument('--rate', type=float, default=1, help='the multiple of the traffic of the model, 1 to 100')
+    parser.add_argument('--duration', type=int, default=600, help='the length of the run in seconds')
+    parser.add_argument('--host', default='127.0.0.1', help='the address of data_pool.py')
+    parser.add_argument('--port', type=int, default=PORT, help='the port of data_pool.py')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if not 1 <= args.rate <= 100:
+        parser.error('the rate must be from 1 to 100: {}'.format(args.rate))
+
+    database = pymongo.MongoClient(DB_KEY)['fyp_2021_busq']
+    collection = create_collection(database, RAW_SCHEMA, BUCKET_SECONDS)
+    population = Population(args.rate, args.seed)
+    if args.mode == 'udp':
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    else:
+        store_times = []
+        def store(readings):
+            begin = time.time()
+            collection.insert_many(documents(readings, RAW_SCHEMA, TARGET_FORMAT, BUCKET_SECONDS), ordered=False)
+            store_times.append(time.time() - begin)
+            print('{}: stored {} readings in {:.3f} s'.format(datetime.now(), len(readings['Time']), store_times[-1]))
+        aggregator = SecondMax(0)
+        emitter = Emitter(aggregator, store, STORE_INTERVAL)
+
+    start = int(time.time()) + 1
+    probe = LatencyProbe(collection, start) if args.mode == 'udp' else None
+    sent = expected = behind = 0
+    window_sent, window_start = 0, time.time()
+    for second in range(start, start + args.duration):
+        time.sleep(max(second - time.time(), 0))
+        if time.time() >= second + 1: # the previous second is not sent in time
+            behind += 1
+        readings = population.step(second)
+        expected += unique_keys(readings)
+        if args.mode == 'udp':
+            for datagram in datagrams(readings):
+                udp_socket.sendto(datagram, (args.host, args.port))
+            probe.sent[second] = time.time()
+        else:
+            aggregator.add_columns({'Second':readings[:, 0] // 1000, 'Target':readings[:, 1].astype(np.uint64),
+                                    'Receiver':readings[:, 2], 'Strength':readings[:, 3] + STRENGTH_OFFSET})
+            emitter.tick()
+        sent += len(readings)
+        window_sent += len(readings)
+        if time.time() - window_start >= REPORT_INTERVAL:
+            print('{}: {:.0f} datagrams/s, {} devices present, {} seconds behind'.format(
+                datetime.now(), window_sent/(time.time() - window_start), len(population.devices['mac']), behind))
+            window_sent, window_start = 0, time.time()
+
+    # --- wait for the last readings to be stored and compare them with the readings sent --- #
+    if args.mode == 'udp': # data_pool.py closes a second only when newer readings arrive
+        for second in range(start + args.duration, start + args.duration + DRAIN_TIME):
+            time.sleep(max(second - time.time(), 0))
+            udp_socket.sendto(datagrams(marker(second))[0], (args.host, args.port))
+            probe.sent[second] = time.time()
+        probe.stop()
+    else:
+        emitter.tick(final=True)
+    stored = len(stored_columns(collection, stored_time(start), stored_time(start + args.duration - 1))['Time'])
+    print('sent {} datagrams in {} s ({:.0f} datagrams/s), {} seconds behind'.format(sent, args.duration, sent/args.duration, behind))
+    print('readings to be stored {}, stored {}, lost {} ({:.2%})'.format(expected, stored, expected - stored, 1 - stored/max(expected, 1)))
+    if args.mode == 'udp':
+        report_latency(probe.latencies)
+    else:
+        print('store time: p50 {:.3f} s  max {:.3f} s'.format(np.median(store_times), max(store_times)) if store_times else 'nothing stored')
@@ -0,0 +1,319 @@
+"""spill_log.py
+
+This file contains the write-ahead spill log used by data_pool.py. Each batch of readings is appended
+to a local append-only log before it is stored in the database, so the readings are kept on disk while
+MongoDB is slow or unavailable, and the flush stage keeps accepting the readings at the rate of the disk.
+
+The log is split into segments, each segment is a file of records. A record holds one batch as a header
+(a magic number, the length and CRC32 of the payload and the id of the batch) and a payload of packed
+rows of Time in milliseconds, the integer Target, Receiver and Strength. The log is written by a single
+process, and a segment is rotated once it reaches segment_bytes bytes or segment_seconds seconds. The
+segment being written ends with .open, it is renamed to .log when it is rotated or closed.
+
+The replayer drains the log into the database in the background with bulk inserts. Each row is given
+the id (batch id << ROW_BITS) + row, where the batch ids are increasing timestamps in milliseconds, so
+replaying a row which is already stored after a crash is a duplicate key which is ignored. The offset
+acknowledged by the database in each segment is kept in the checkpoint file, and the rotated segments
+are deleted once they are completely acknowledged.
+
+This script requires that `numpy` be installed within the Python environment you are running
+this script in.
+"""
+
+import os
+import json
+import time
+import zlib
+import struct
+import threading
+from datetime import datetime
+import numpy as np
+from aggregate import concat_columns
+
+MAGIC               = b'RDWL'
+HEADER              = struct.Struct('<4sIIQ') # the magic number, the length and CRC32 of the payload, and the batch id
+ROW_DTYPE           = np.dtype([('Time','<i8'),('Target','<u8'),('Receiver','i1'),('Strength','<i2')]) # packed, 19 bytes per row
+ROW_BITS            = 20 # the ids of the rows of a batch are (batch id << ROW_BITS) + row
+OPEN, SEALED        = '.open', '.log'
+CHECKPOINT          = 'checkpoint.json'
+
+
+def encode_batch(readings, batch_id):
+    """Encode the readings with the columns Time, Target, Receiver and Strength to a record"""
+    rows = np.empty(len(readings['Time']), dtype=ROW_DTYPE)
+    rows['Time'] = np.asarray(readings['Time']).astype('datetime64[ms]').astype(np.int64)
+    rows['Target'] = np.asarray(readings['Target']).astype(np.uint64)
+    rows['Receiver'] = np.asarray(readings['Receiver'])
+    rows['Strength'] = np.asarray(readings['Strength'])
+    payload = rows.tobytes()
+    return HEADER.pack(MAGIC, len(payload), zlib.crc32(payload) & 0xFFFFFFFF, batch_id) + payload
+
+
+def decode_batch(payload, batch_id):
+    """Decode the payload of a record to the readings with the columns _id, Time, Target, Receiver and Strength"""
+    rows = np.frombuffer(payload, dtype=ROW_DTYPE)
+    return {'_id':(np.int64(batch_id) << ROW_BITS) + np.arange(len(rows), dtype=np.int64),
+            'Time':rows['Time'].astype('datetime64[ms]').astype('datetime64[ns]'), 'Target':rows['Target'].copy(),
+            'Receiver':rows['Receiver'].astype(np.int64), 'Strength':rows['Strength'].astype(np.int64)}
+
+
+def read_records(path, offset):
+    """Read the complete records of a segment after the offset
+
+    Parameters
+    ----------
+    path : str
+        the path of the segment
+
+    offset : int
+        the offset of the first record to read
+
+    Returns
+    -------
+    list
+        the batch id, the payload and the offset after each complete and valid record
+    bool
+        True if the segment ends with an incomplete or invalid record
+    """
+    records = []
+    with open(path, 'rb') as fp:
+        fp.seek(offset)
+        data = fp.read()
+    position = 0
+    while len(data) - position >= HEADER.size:
+        magic, length, crc, batch_id = HEADER.unpack_from(data, position)
+        payload = data[position+HEADER.size:position+HEADER.size+length]
+        if magic != MAGIC or len(payload) < length or zlib.crc32(payload) & 0xFFFFFFFF != crc:
+            return records, True
+        position += HEADER.size + length
+        records.append((batch_id, payload, offset + position))
+    return records, position < len(data)
+
+
+class SpillLog:
+    """
+    A class used to represent the segments of the spill log written by data_pool.py
+
+    ...
+
+    Attributes
+    ----------
+    directory : str
+        the directory of the segments
+    segment_bytes : int
+        a segment is rotated once it reaches this size in bytes
+    segment_seconds : float
+        a segment is rotated once it is opened for this time in seconds
+    fsync : str
+        'always' to fsync after each batch, 'interval' to fsync at most every fsync_interval seconds, 'never' to leave it to the system
+    fsync_interval : float
+        the interval between the fsyncs in seconds for the 'interval' policy
+    segment : file
+        the segment being written, None if no segment is open
+    batch_id : int
+        the id of the latest batch
+
+    Methods
+    -------
+    recover()
+        seals the segments left open by a previous run
+    append(readings)
+        appends a batch of readings to the log
+    rotate()
+        closes the segment being written
+    close()
+        closes the segment being written, the batches are flushed to the disk
+    """
+    def __init__(self, directory, segment_bytes, segment_seconds, fsync='interval', fsync_interval=1):
+        if fsync not in ('always', 'interval', 'never'):
+            raise ValueError('Unknown fsync policy: {}'.format(fsync))
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.segment = None
+        self.batch_id = 0
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+    def recover(self):
+        """Seal the segments left open by a previous run and continue the batch ids after their latest batch"""
+        for name in os.listdir(self.directory):
+            if name.endswith(OPEN):
+                os.replace(os.path.join(self.directory, name), os.path.join(self.directory, name[:-len(OPEN)] + SEALED))
+            if name.endswith(OPEN) or name.endswith(SEALED):
+                records, _ = read_records(os.path.join(self.directory, name[:-len(OPEN)] + SEALED if name.endswith(OPEN) else name), 0)
+                self.batch_id = max([self.batch_id] + [batch_id for batch_id, _, _ in records])
+
+    def next_batch_id(self):
+        """Return a new batch id, the current time in milliseconds unless it is not larger than the latest batch id"""
+        self.batch_id = max(self.batch_id + 1, int(time.time()*1000))
+        return self.batch_id
+
+    def open(self):
+        """Open a new segment named after the time it is opened"""
+        self.path = os.path.join(self.directory, '{:020d}{}'.format(max(self.batch_id + 1, int(time.time()*1000)), OPEN))
+        self.segment = open(self.path, 'ab')
+        self.opened = time.time()
+        self.synced = time.time()
+
+    def append(self, readings):
+        """Append a batch of readings to the log
+
+        Parameters
+        ----------
+        readings : dict
+            the columns Time, Target, Receiver and Strength of the readings, split into records of at most 2**ROW_BITS rows
+        """
+        if not len(readings['Time']):
+            return
+        with self.lock:
+            if self.segment is not None and (self.segment.tell() >= self.segment_bytes or time.time() - self.opened >= self.segment_seconds):
+                self.rotate()
+            if self.segment is None:
+                self.open()
+            for first in range(0, len(readings['Time']), 2**ROW_BITS):
+                self.segment.write(encode_batch({field:values[first:first+2**ROW_BITS] for field, values in readings.items()}, self.next_batch_id()))
+            self.segment.flush()
+            if self.fsync == 'always' or (self.fsync == 'interval' and time.time() - self.synced >= self.fsync_interval):
+                os.fsync(self.segment.fileno())
+                self.synced = time.time()
+
+    def rotate(self):
+        """Close the segment being written and rename it to .log"""
+        if self.segment is None:
+            return
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.segment.close()
+        os.replace(self.path, self.path[:-len(OPEN)] + SEALED)
+        self.segment = None
+
+    def close(self):
+        """Close the segment being written, the batches are flushed to the disk"""
+        with self.lock:
+            self.rotate()
+
+
+class Replayer:
+    """
+    A class used to represent the background thread draining the spill log into the database
+
+    ...
+
+    Attributes
+    ----------
+    directory : str
+        the directory of the segments
+    write : function
+        stores a dataframe of readings with the columns _id, Time, Target, Receiver and Strength,
+        the rows whose _id is already stored must be ignored
+    batch_rows : int
+        the maximum number of rows stored at once
+    retry_interval : float
+        the time to wait in seconds after the database fails
+    checkpoint : dict
+        a dictionary where the keys are the segments and the values are the offsets acknowledged by the database
+    lag : int
+        the number of rows read from the log but not stored yet
+
+    Methods
+    -------
+    replay()
+        stores the records which are not acknowledged yet and deletes the acknowledged segments
+    start()
+        starts the background thread
+    stop(timeout)
+        stops the background thread
+    """
+    def __init__(self, directory, write, batch_rows=50000, retry_interval=5):
+        self.directory = directory
+        self.write = write
+        self.batch_rows = batch_rows
+        self.retry_interval = retry_interval
+        self.checkpoint = {}
+        self.lag = 0
+        self.stopping = threading.Event()
+        self.thread = None
+        path = os.path.join(directory, CHECKPOINT)
+        if os.path.exists(path):
+            with open(path, 'r') as fp:
+                self.checkpoint = json.load(fp)
+
+    def save_checkpoint(self):
+        """Write the checkpoint to a temporary file and rename it"""
+        path = os.path.join(self.directory, CHECKPOINT)
+        with open(path + '.tmp', 'w') as fp:
+            json.dump(self.checkpoint, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(path + '.tmp', path)
+
+    def segments(self):
+        """Return the names of the segments in the order of their first batch ids"""
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(OPEN) or name.endswith(SEALED))
+
+    def replay(self):
+        """Store the records which are not acknowledged yet and delete the acknowledged segments
+
+        Returns
+        -------
+        int
+            the number of rows stored
+        """
+        stored = 0
+        names = self.segments()
+        for name in names:
+            key = name.rsplit('.', 1)[0] # a segment keeps its checkpoint when it is renamed to .log
+            path = os.path.join(self.directory, name)
+            offset = self.checkpoint.get(key, 0)
+            try:
+                records, torn = read_records(path, offset)
+            except FileNotFoundError: # the segment is renamed while it is read
+                continue
+            while records:
+                batch, rows = [], 0
+                while records and (not batch or rows + len(records[0][1])//ROW_DTYPE.itemsize <= self.batch_rows):
+                    batch_id, payload, end = records.pop(0)
+                    batch.append(decode_batch(payload, batch_id))
+                    rows += len(batch[-1]['Time'])
+                self.lag = rows + sum(len(payload)//ROW_DTYPE.itemsize for _, payload, _ in records)
+                self.write(concat_columns(batch))
+                stored += rows
+                self.checkpoint[key] = end
+                self.save_checkpoint()
+            self.lag = 0
+
+            if name.endswith(SEALED):
+                if torn:
+                    print('{}: dropped the incomplete record at the end of {}'.format(datetime.now(), name))
+                os.remove(path)
+                self.checkpoint.pop(key, None)
+                self.save_checkpoint()
+        for key in list(self.checkpoint): # the segments deleted before their checkpoint is removed
+            if key + OPEN not in names and key + SEALED not in names:
+                self.checkpoint.pop(key)
+        return stored
+
+    def run(self):
+        """Replay the log until stop is called, waiting retry_interval seconds after each failure"""
+        while not self.stopping.is_set():
+            try:
+                if not self.replay():
+                    self.stopping.wait(1)
+            except Exception as e: # the database is not available, the records are replayed again later
+                print('{}: failed to replay the spill log: {}'.format(datetime.now(), e))
+                self.stopping.wait(self.retry_interval)
+
+    def start(self):
+        """Start the background thread"""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout):
+        """Stop the background thread after the current insert, the records not stored are replayed after restart"""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
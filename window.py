@@ -0,0 +1,253 @@
+"""window.py
+
+This file contains the sliding window used by process_south.py and process_north.py to keep
+the sensor readings of the past READ_INTERVAL in memory. Instead of reading the whole interval
+from the database in every cycle, only the readings newer than the latest timestamp already
+held in memory (the watermark) are read, and readings older than the interval are dropped.
+
+As data_pool.py stores the readings every STORE_INTERVAL seconds, readings may arrive in the
+database after newer readings are already read. Hence the readings within LATE_INTERVAL before
+the watermark are read again in every cycle and replace the ones held in memory. Readings stored even
+later, e.g. replayed from the spill log of data_pool.py after an outage of MongoDB, are picked up by
+reading the whole window from MongoDB again every REFRESH_INTERVAL seconds.
+
+The devices with changed readings are kept as pending until the cycle processing them succeeds, so a
+failed or retried cycle processes them again.
+
+Only the readings of the sensors of the processed gates with a signal strength below 0 are read,
+backed by the compound index on Receiver and Time. When the whole window is read in every cycle,
+the weak signal and single reading filters can also run in MongoDB as an aggregation pipeline.
+The readings are decoded into typed columns by raw_loader.py, or unpacked by buckets.py when they
+are stored in buckets (RAW_SCHEMA). When data_pool.py publishes the readings to the ring buffer of
+ring_buffer.py on the same server, the readings are read from the ring instead, as long as it holds
+all readings of the requested interval. The read and the decoding are recorded as the stages read and
+decode of the cycle by instrument.py.
+
+This script requires that `pandas` and `pymongo` be installed within the Python
+environment you are running this script in.
+"""
+
+from datetime import datetime, timedelta
+import pandas as pd
+import pymongo
+import config
+from raw_loader import empty_readings, find_columns, aggregate_columns, decode_readings
+from buckets import find_bucket_columns
+from instrument import stage
+
+SENSOR_ID = {v:k for k,v in config.SENSOR.items()} # a dictionary storing the AP-ID of each sensor MAC address
+DEDUPLICATE_READINGS = config.DEDUPLICATE_READINGS
+RAW_SCHEMA = config.RAW_SCHEMA
+BUCKET_SECONDS = config.BUCKET_SECONDS
+
+
+class SlidingWindow:
+    """
+    A class used to represent the sensor readings of the past READ_INTERVAL held in memory
+
+    ...
+
+    Attributes
+    ----------
+    collection : Collection
+        the MongoDB collection storing the raw sensor readings
+    read_interval : int
+        the length of the window in seconds
+    late_interval : int
+        the readings within late_interval seconds before the watermark are read again in every cycle
+    incremental : bool
+        if False, the whole window is read again in every cycle
+    gates : dict
+        a dictionary where the keys are the gates and the values are the MAC addresses of their sensors,
+        only the readings of these sensors are read
+    aggregate : bool
+        if True and incremental is False, the weak signal and single reading filters of each gate run in MongoDB,
+        except for the readings stored in buckets
+    ring : RingReader
+        the ring buffer published by data_pool.py, None to read the readings from MongoDB only
+    refresh_interval : int
+        the window before the readings read again in each cycle is read from MongoDB again every refresh_interval seconds,
+        None to never read it again
+    data : DataFrame
+        the decoded readings within the window with the columns Time, Target, Receiver and Strength
+    watermark : datetime
+        the timestamp of the latest reading read so far, it never moves backwards
+    refreshed : float
+        the unix timestamp of the end of the last read of the whole window
+    pending : set
+        the MAC addresses of the devices with changed readings which are not processed yet
+
+    Methods
+    -------
+    fetch(start, end)
+        fetches the raw columns of the readings within the time interval
+    read(start, end)
+        reads and decodes the readings within the time interval
+    update(end)
+        reads the new readings, drops the expired ones and returns the devices whose readings are changed
+    commit()
+        marks the pending devices as processed
+    """
+    def __init__(self, collection, read_interval, late_interval, gates, incremental=True, aggregate=False, ring=None, refresh_interval=None):
+        self.collection = collection
+        self.read_interval = read_interval
+        self.late_interval = late_interval
+        self.gates = gates
+        self.incremental = incremental
+        self.aggregate = aggregate and not incremental and RAW_SCHEMA != 'bucket' # the filters need all readings of a device within the window
+        self.ring = ring
+        self.refresh_interval = refresh_interval
+        self.data = empty_readings()
+        self.watermark = None
+        self.refreshed = None
+        self.pending = set()
+        self.collection.create_index([('Receiver',pymongo.ASCENDING),('Time',pymongo.ASCENDING)])
+
+    def receivers(self):
+        """Return the AP-IDs of the sensors of the gates"""
+        return [SENSOR_ID[receiver] for gate in self.gates.values() for receiver in gate]
+
+    def query(self, start, end):
+        """Return the query of the readings of the sensors of the gates within the time interval"""
+        return {'Receiver':{'$in':self.receivers()}, 'Time':{'$gte':start,'$lte':end}, 'Strength':{'$lt':100}}
+
+    def pipeline(self, start, end):
+        """Return the aggregation pipeline which reads the readings within the time interval and filters
+        the devices with weak signals or a single reading in each gate"""
+        gate = {'$switch':{'branches':[{'case':{'$in':['$_id.Receiver',[SENSOR_ID[receiver] for receiver in receivers]]}, 'then':name}
+                                        for name, receivers in self.gates.items()]}}
+        if DEDUPLICATE_READINGS:
+            readings = {'$group':{'_id':{'Time':'$Time','Target':'$Target','Receiver':'$Receiver'}, 'Strength':{'$max':'$Strength'}}}
+        else: # data_pool.py stores a single reading of each second, device and sensor
+            readings = {'$project':{'_id':{'Time':'$Time','Target':'$Target','Receiver':'$Receiver'}, 'Strength':1}}
+        return [{'$match':self.query(start, end)},
+                readings,
+                {'$addFields':{'Gate':gate}},
+                {'$group':{'_id':{'Target':'$_id.Target','Gate':'$Gate'}, 'Max':{'$max':'$Strength'}, 'Times':{'$addToSet':'$_id.Time'},
+                            'Readings':{'$push':{'Time':'$_id.Time','Target':'$_id.Target','Receiver':'$_id.Receiver','Strength':'$Strength'}}}},
+                {'$match':{'Max':{'$gte':config.WEAK_SIGNAL+100}, 'Times.1':{'$exists':True}}},
+                {'$unwind':'$Readings'},
+                {'$replaceRoot':{'newRoot':'$Readings'}}]
+
+    def fetch(self, start, end, ring=True):
+        """Fetch the raw columns of the readings within the time interval, and whether they should be deduplicated"""
+        if ring and self.ring is not None:
+            columns = self.ring.columns(start, end, self.receivers(), strength_below=100)
+            if columns is not None: # the ring holds all readings since start
+                return columns, False
+        if self.aggregate: # the readings are already grouped by the aggregation pipeline
+            return aggregate_columns(self.collection, self.pipeline(start, end)), False
+        if RAW_SCHEMA == 'bucket':
+            return find_bucket_columns(self.collection, start, end, self.receivers(), BUCKET_SECONDS, strength_below=100), DEDUPLICATE_READINGS
+        return find_columns(self.collection, self.query(start, end)), DEDUPLICATE_READINGS
+
+    def read(self, start, end, ring=True):
+        """Read and decode all readings within the time interval defined by start and end
+
+        Parameters
+        ----------
+        start : datetime
+            the starting time
+
+        end : datetime
+            the ending time
+
+        ring : bool
+            if False, the readings are read from MongoDB even if the ring buffer holds them
+
+        Returns
+        -------
+        DataFrame
+            the decoded readings with the columns Time, Target, Receiver and Strength
+        """
+        with stage('read') as record:
+            columns, deduplicate = self.fetch(start, end, ring)
+            record['rows_out'] = len(columns['Time'])
+        with stage('decode', len(columns['Time'])) as record:
+            data = decode_readings(columns, deduplicate=deduplicate)
+            record['rows_out'] = len(data)
+        return data
+
+    def update(self, end):
+        """Move the window to end and return the devices whose readings are changed
+
+        Parameters
+        ----------
+        end : float
+            the ending time of the window as a unix timestamp
+
+        Returns
+        -------
+        set
+            the MAC addresses of the devices with new, late or expired readings, including the pending
+            devices of the previous cycles which failed
+        """
+        refresh = self.refresh_interval is not None and (self.refreshed is None or end - self.refreshed >= self.refresh_interval)
+        if refresh:
+            self.refreshed = end
+        start = datetime.fromtimestamp(end - self.read_interval)
+        end = datetime.fromtimestamp(end)
+
+        if not self.incremental or self.watermark is None:
+            touched = set(self.data['Target'])
+            self.data = self.read(start, end)
+            touched.update(self.data['Target'])
+        else:
+            tail_start = max(self.watermark - timedelta(seconds=self.late_interval), start)
+            tail = self.read(tail_start, end)
+
+            expired = self.data['Time'] < start
+            replaced = self.data['Time'] >= tail_start
+
+            # --- a refresh reads the window before the tail from MongoDB again to pick up the readings stored later than LATE_INTERVAL --- #
+            if refresh:
+                stored = self.read(start, tail_start, ring=False)
+                stored = stored[stored['Time'] < tail_start]
+                head = self.data[~(expired | replaced)]
+                if not stored.empty: # MongoDB lags the ring buffer, the readings held newer than the latest one stored are kept
+                    held = head[head['Time'] > stored['Time'].max()] # the readings of a second are stored together
+                    head = replace_targets(stored, held, set())
+                tail = replace_targets(head, tail, set())
+                replaced = ~expired
+            # readings found in only one of the old and new tails are new or late readings
+            changed = pd.concat([self.data[replaced], tail]).drop_duplicates(keep=False)
+            touched = set(self.data.loc[expired, 'Target'])
+            touched.update(changed['Target'])
+
+            self.data = replace_targets(self.data[~(expired | replaced)], tail, set())
+
+        if not self.data.empty: # the watermark never moves backwards, e.g. when the ring buffer is behind and MongoDB is read
+            self.watermark = self.data['Time'].max() if self.watermark is None else max(self.watermark, self.data['Time'].max())
+        self.pending.update(touched)
+        return set(self.pending)
+
+    def commit(self):
+        """Mark the pending devices as processed once all gates are processed without an error"""
+        self.pending.clear()
+
+
+def replace_targets(cached, fresh, targets):
+    """Replace the rows of the given devices in a cached dataframe by freshly derived rows
+
+    Parameters
+    ----------
+    cached : DataFrame
+        the dataframe derived in the previous cycles, None in the first cycle
+
+    fresh : DataFrame
+        the rows derived from the current readings of the given devices
+
+    targets : set
+        the MAC addresses of the devices to be replaced
+
+    Returns
+    -------
+    DataFrame
+        the updated dataframe
+    """
+    if cached is None or cached.empty:
+        return fresh.reset_index(drop=True)
+    cached = cached[~cached['Target'].isin(targets)]
+    if fresh.empty: # avoid concatenating empty frames, which may turn the datetime columns to objects
+        return cached.reset_index(drop=True)
+    return pd.concat([cached, fresh], ignore_index=True)